@@ -25,6 +25,36 @@ use base 'Class::Accessor';
 
 __PACKAGE__->mk_accessors(qw(work_dir staging_dir output_dir app params));
 
+#
+# kSNP4 sizing policy limits, shared by preflight and run.
+#
+use constant MIN_KSNP_CPU => 2;
+use constant MAX_KSNP_CPU => 32;
+use constant GENOMES_PER_CPU => 8;
+use constant BASES_PER_CPU => 250_000_000;
+# Used when a genome's length is not known before download
+use constant DEFAULT_GENOME_LENGTH => 5_000_000;
+# Genome IDs per data API query when looking up genome group lengths
+use constant GENOME_QUERY_CHUNK => 250;
+# Files of a previous job's output folder that extend-snp-analysis reads; the
+# kSNPdist files are optional and only let it reuse previous distances
+use constant PREVIOUS_OUTPUT_FILES => qw(
+    All_SNPs/SNPs_all.tsv
+    All_SNPs/SNPs_all_matrix.fasta
+    Intermediate_Files/optimum_k.txt
+    All_SNPs/all_kSNPdist.report
+    All_SNPs/all_kSNPdist.matrix
+    Core_SNPs/core_kSNPdist.report
+    Core_SNPs/core_kSNPdist.matrix
+    Majority_SNPs/majority_kSNPdist.report
+    Majority_SNPs/majority_kSNPdist.matrix
+);
+# Concurrent workspace uploads in save_output_files
+use constant UPLOAD_WORKERS => 8;
+# Fixed preflight memory and runtime; only the CPU request follows the input size
+use constant PREFLIGHT_MEMORY => "32G";
+use constant PREFLIGHT_RUNTIME => 60 * 60 * 12;
+
 sub new
 {
     my($class) = @_;
@@ -172,7 +202,11 @@ sub run
     warn "Snakemake found at $snakemake\n";
     system($snakemake, "--version");
 
-    $config_vars{cores} = $ENV{P3_ALLOCATED_CPU} // 2;
+    # Use exactly the cores the scheduler granted; the sizing policy only
+    # applies when running outside the scheduler.
+    my($genome_count, $total_bases) = staged_genome_summary($raw_fasta_dir);
+    $config_vars{cores} = $ENV{P3_ALLOCATED_CPU} // ksnp_cpu_policy($genome_count, $total_bases);
+    print STDERR "Sizing: $genome_count genomes, $total_bases bases, $config_vars{cores} cores\n";
     $config_vars{snakemake} = $snakemake;
     $config_vars{workflow_dir} = $wf_dir;
     $config_vars{input_data_dir} = $staging_dir;
@@ -180,53 +214,142 @@ sub run
     $config_vars{work_data_dir} = $work_dir;
     $config_vars{clean_data_dir} = $clean_fasta_dir;
     $config_vars{raw_fasta_dir} = $raw_fasta_dir;
+    # Kchooser4 results are cached across jobs only when the deployment provides a cache directory
+    $config_vars{kchooser_cache_dir} = $ENV{WGSNP_KCHOOSER_CACHE_DIR} if $ENV{WGSNP_KCHOOSER_CACHE_DIR};
+    $config_vars{kchooser_cache_max_bytes} = $ENV{WGSNP_KCHOOSER_CACHE_MAX_BYTES} if $ENV{WGSNP_KCHOOSER_CACHE_MAX_BYTES};
+    # Likewise rendered tree images are shared across jobs only when the deployment provides a directory
+    $config_vars{tree_svg_cache_dir} = $ENV{WGSNP_TREE_SVG_CACHE_DIR} if $ENV{WGSNP_TREE_SVG_CACHE_DIR};
+    $config_vars{tree_svg_cache_max_bytes} = $ENV{WGSNP_TREE_SVG_CACHE_MAX_BYTES} if $ENV{WGSNP_TREE_SVG_CACHE_MAX_BYTES};
+    # Without a shared directory, files already uploaded are only skipped within this job
+    $config_vars{upload_state_dir} = $ENV{WGSNP_UPLOAD_STATE_DIR} if $ENV{WGSNP_UPLOAD_STATE_DIR};
 
     # add the params to the config file
     $config_vars{params} = $params;
 
+    # An incremental run extends a previous job's outputs instead of rerunning kSNP4
+    my @snakefiles = ("prep_ksnp_snakefile", "run_ksnp_snakefile");
+    if ($params->{previous_output_path})
+    {
+        # Fetch only what the extension reads, not the VCFs, trees and images
+        my $previous_dir = "$staging_dir/previous_output/" . basename($params->{previous_output_path});
+        for my $file (PREVIOUS_OUTPUT_FILES)
+        {
+            make_path(dirname("$previous_dir/$file"));
+            my @cp = ("p3-cp", "ws:$params->{previous_output_path}/$file", "$previous_dir/$file");
+            print STDERR "Fetching previous output: @cp\n";
+            # extend-snp-analysis reports any required file that is missing
+            IPC::Run::run(\@cp) or print STDERR "Could not fetch $file from the previous output ($?)\n";
+        }
+        $config_vars{previous_output_dir} = $previous_dir;
+        @snakefiles = ("incremental_snakefile");
+    }
+
     # write config to current working directory to avoid finding tmp dir
     my $top = getcwd;
     write_file("$top/config.json", JSON::XS->new->pretty->canonical->encode(\%config_vars));
 
     print STDERR "Check point 1: Starting snakemake....\n";
 
-    my @cmd = (
-        $snakemake,
-        "--cores",
-        $config_vars{cores},
-        "--use-singularity",
-        "--verbose",
-        "--printshellcmds",
-        "--keep-going",
-        "--snakefile",
-        "$wf_dir/snakefile/prep_ksnp_snakefile"
-    );
-    print STDERR "Run: @cmd\n";
-
-    my $ok = IPC::Run::run(\@cmd);
-    if (!$ok)
+    for my $snakefile (@snakefiles)
     {
-     die "Snakemake prep_ksnp_snakefile command failed $?: @cmd";
+        my @cmd = (
+            $snakemake,
+            "--cores",
+            $config_vars{cores},
+            "--use-singularity",
+            "--verbose",
+            "--printshellcmds",
+            "--keep-going",
+            "--snakefile",
+            "$wf_dir/snakefile/$snakefile"
+        );
+        print STDERR "Run: @cmd\n";
+
+        my $ok = IPC::Run::run(\@cmd);
+        if (!$ok)
+        {
+         die "Snakemake $snakefile command failed $?: @cmd";
+        }
     }
+}
+
+#
+# CPU count for kSNP4 given the number of genomes and total input bases.
+# kSNP4 spreads its per-genome k-mer work across CPUs, so both the genome
+# count and the bases it has to scan raise the request.
+#
+sub ksnp_cpu_policy
+{
+    my($genome_count, $total_bases) = @_;
+
+    my $cpu = int(($genome_count + GENOMES_PER_CPU - 1) / GENOMES_PER_CPU);
+    my $cpu_for_bases = int(($total_bases + BASES_PER_CPU - 1) / BASES_PER_CPU);
+    $cpu = $cpu_for_bases if $cpu_for_bases > $cpu;
+    $cpu = MIN_KSNP_CPU if $cpu < MIN_KSNP_CPU;
+    $cpu = MAX_KSNP_CPU if $cpu > MAX_KSNP_CPU;
+    return $cpu;
+}
+
+#
+# Genome count and total length for the job inputs before anything is downloaded.
+# Dies if the data API or workspace lookup fails.
+#
+sub input_genome_summary
+{
+    my($app, $params) = @_;
 
-        my @cmd2 = (
-        $snakemake,
-        "--cores",
-        $config_vars{cores},
-        "--use-singularity",
-        "--verbose",
-        "--printshellcmds",
-        "--keep-going",
-        "--snakefile",
-        "$wf_dir/snakefile/run_ksnp_snakefile"
-    );
-    print STDERR "Run: @cmd2\n";
-
-    my $ok2 = IPC::Run::run(\@cmd2);
-    if (!$ok2)
+    if ($params->{input_genome_type} eq 'genome_group')
+    {
+        my $api = P3DataAPI->new;
+        my @genome_ids = $api->retrieve_patric_ids_from_genome_group($params->{input_genome_group});
+        my $total_bases = 0;
+        my %lengths;
+        # Chunked so large groups stay within the API's query length limits
+        for (my $i = 0; $i < @genome_ids; $i += GENOME_QUERY_CHUNK)
+        {
+            my $last = $i + GENOME_QUERY_CHUNK - 1;
+            $last = $#genome_ids if $last > $#genome_ids;
+            for my $genome ($api->query("genome",
+                                        ["in", "genome_id", "(" . join(",", @genome_ids[$i .. $last]) . ")"],
+                                        ["select", "genome_id,genome_length"]))
+            {
+                $lengths{$genome->{genome_id}} = $genome->{genome_length};
+            }
+        }
+        $total_bases += $lengths{$_} // DEFAULT_GENOME_LENGTH for @genome_ids;
+        return (scalar @genome_ids, $total_bases);
+    }
+    if ($params->{input_genome_type} eq 'genome_fasta' && $params->{input_genome_fasta})
     {
-     die "Snakemake prep_ksnp_snakefile command failed $?: @cmd2";
+        # Only the file size is known before download; estimate the genome
+        # count from it.
+        my $res = $app->workspace->get({ objects => [$params->{input_genome_fasta}], metadata_only => 1 });
+        my $total_bases = $res->[0]->[0]->[6] // 0;
+        my $genome_count = int(($total_bases + DEFAULT_GENOME_LENGTH - 1) / DEFAULT_GENOME_LENGTH);
+        return ($genome_count, $total_bases);
     }
+    return (0, 0);
+}
+
+#
+# Genome count and total file size of the downloaded raw FASTA files.
+#
+sub staged_genome_summary
+{
+    my($raw_fasta_dir) = @_;
+
+    my($genome_count, $total_bases) = (0, 0);
+    if (opendir(my $dh, $raw_fasta_dir))
+    {
+        for my $f (readdir($dh))
+        {
+            next unless -f "$raw_fasta_dir/$f";
+            $genome_count++;
+            $total_bases += -s "$raw_fasta_dir/$f";
+        }
+        closedir($dh);
+    }
+    return ($genome_count, $total_bases);
 }
 
 #
@@ -234,13 +357,25 @@ sub run
 #
 sub preflight
 {
-    my($app, $app_def, $raw_params, $params) = @_;
+    my($self, $app, $app_def, $raw_params, $params) = @_;
+
+    #
+    # A failed input lookup must not fail the job; size it with the minimum
+    # CPU request instead.
+    #
+    my($genome_count, $total_bases) = eval { input_genome_summary($app, $params) };
+    if ($@)
+    {
+        print STDERR "Preflight: could not size the input genomes, using defaults: $@\n";
+        ($genome_count, $total_bases) = (0, 0);
+    }
+    my $cpu = ksnp_cpu_policy($genome_count, $total_bases);
+    print STDERR "Preflight: $genome_count genomes, $total_bases bases -> $cpu cpu\n";
 
-    my $time = 60 * 60 * 12;
     my $pf = {
-            	cpu => 1,
-            	memory => "32G",
-            	runtime => $time,
+            	cpu => $cpu,
+            	memory => PREFLIGHT_MEMORY,
+            	runtime => PREFLIGHT_RUNTIME,
                 storage => 0,
               };
 
@@ -266,6 +401,30 @@ sub save_output_files
             html => 'html');
     my @suffix_map = map { ("--map-suffix", "$_=$suffix_map{$_}") } keys %suffix_map;
 
+    #
+    # Upload everything listed in the output manifest concurrently, with
+    # retries. If some files still fail, run it once more serially; the
+    # upload state means only the files not yet uploaded are sent again.
+    # Copy folder by folder only when there is no manifest (the run failed early).
+    #
+    my $config_file = getcwd . "/config.json";
+    if (-f $config_file)
+    {
+        my $config = decode_json(read_file($config_file));
+        if (-f "$config->{work_data_dir}/output_manifest.json")
+        {
+            for my $workers (UPLOAD_WORKERS, 1)
+            {
+                my @cmd = ("whole_genome_snp_utils", "upload-output-files", "--workers", $workers,
+                           $config_file, "ws:" . $app->result_folder);
+                print STDERR "saving files to workspace... @cmd\n";
+                return if IPC::Run::run(\@cmd);
+                warn "Error $? uploading output with @cmd\n";
+            }
+            return;
+        }
+    }
+
     if (opendir(D, $output))
     {
 	while (my $p = readdir(D))
@@ -1,5 +1,9 @@
-from Bio import Phylo
+import base64
 import click
+import errno
+import gzip
+import hashlib
+import html
 import json
 import os
 import pandas as pd
@@ -10,11 +14,123 @@ import re
 import shutil
 import subprocess
 import sys
+import time
 
-from Bio import SeqIO
-from scipy.cluster.hierarchy import linkage, leaves_list
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.cluster.hierarchy import leaves_list, optimal_leaf_ordering
 from scipy.spatial.distance import squareform
 
+# kSNP4 SNP alignments use A/C/G/T for alleles and '-' where a genome lacks the locus.
+# Bases encode as 1-4; anything else is missing data (0).
+SNP_BASE_CODES = np.zeros(256, dtype=np.uint8)
+for _code, _base in enumerate("ACGT", start=1):
+    SNP_BASE_CODES[ord(_base)] = _code
+    SNP_BASE_CODES[ord(_base.lower())] = _code
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# 2-bit k-mer codes for genome scans (A=0, C=1, G=2, T=3); anything else (4) breaks a k-mer
+KMER_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    KMER_BASE_CODES[ord(_base)] = _code
+    KMER_BASE_CODES[ord(_base.lower())] = _code
+# Largest k whose 2-bit k-mers fit in a uint64
+MAX_SCAN_K = 32
+# Binary copies of parsed distance tables live here, under the work directory
+DISTANCE_CACHE_DIRNAME = "distance_cache"
+# Optimal leaf ordering is roughly cubic in the number of genomes
+OPTIMAL_LEAF_ORDERING_MAX_GENOMES = 500
+FASTA_EXTENSIONS = (".fasta", ".fa", ".fna")
+# .fai-style contig indexes for the input genomes live here, under the work directory
+FASTA_INDEX_DIRNAME = "fasta_index"
+FASTA_CHUNK_SIZE = 8 * 1024 * 1024
+# Maps each staged kSNP4-safe FASTA name to its raw source file
+FASTA_STAGING_MANIFEST = "fasta_staging_manifest.json"
+# Hardlink failures that mean the filesystem cannot link the file, so staging symlinks it instead
+HARDLINK_FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK)
+# Per-genome length, contig count, N fraction and sequence hash written by normalize-fastas
+GENOME_STATS_FILENAME = "genome_stats.tsv"
+GENOME_STATS_COLUMNS = ["genome", "length", "contigs", "n_fraction", "sequence_sha256", "status", "reason"]
+# Kchooser4 results keyed by genome content; the directory and size bound come from the service config
+KCHOOSER_REPORT_FILENAME = "Kchooser4_ksnp4_input_file.report"
+KCHOOSER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Cached reports name genomes by sequence hash, so no job sees another job's genome names
+KCHOOSER_TEMPLATE_FILENAME = "report.template"
+KCHOOSER_GENOME_PLACEHOLDER = re.compile(r"<genome:([0-9a-f]{64})>")
+# Genomes Kchooser4 ran on when --kchooser-sample picks a subset, written under the work directory
+KCHOOSER_SAMPLE_FILENAME = "kchooser_sample.json"
+# Summary of an incremental run (k reused, genomes kept and added), written under the work directory
+INCREMENTAL_UPDATE_FILENAME = "incremental_update.json"
+# Routing of kSNP4 work files into the output folders, compiled once. Routes are not
+# exclusive: a file is placed by every route whose pattern it matches, into a folder
+# that may name its SNP subset. Each route is (pattern, folder, only, exclude, renames,
+# nonempty): only/exclude limit which matching files are placed (the folder is still
+# created), renames add a website suffix to the first matching name, and nonempty
+# skips empty files.
+OUTPUT_ROUTES = [(re.compile(pattern), folder, only and re.compile(only), exclude and re.compile(exclude),
+                  [(re.compile(rename), suffix) for rename, suffix in renames], nonempty)
+                 for pattern, folder, only, exclude, renames, nonempty in [
+    (r"^All(_|$)|^SNPs_all|^all_snp_distance_heatmap\.html$", "All_SNPs", None, None,
+     [(r"^SNPs_all$", ".tsv"), (r"^SNPs_all_matrix$", ".txt")], False),
+    (r"^annotate(_|$)", "Intermediate_Files", None, None, [], True),
+    (r"^ClusterInfo\.(SNPs|core)(_|$)", "{subtype}/Cluster_Information", None, None, [], False),
+    (r"^(core|nonCore)(_|$)|^core_snp_distance_heatmap\.html$", "Core_SNPs", None, r"^core_kSNPdist",
+     [(r"^core_SNPs$", ".tsv"), (r"^core_SNPs_matrix$", ".txt")], False),
+    (r"^(COUNT|tip|Node|NJ\.dist\.matrix)(_|$)|^optimum_k\.txt$|^genome_stats\.tsv$", "Intermediate_Files", None, None, [], False),
+    (r"^Homoplasy(_|$)", "{subtype}/Homoplasy", None, None, [], False),
+    (r"^(?=.*SNPs_in_majority)(?=.*matrix)", "{subtype}", None, None, [(r"^SNPs_in_majority.{3}_matrix$", ".txt")], False),
+    # Only the SNPs_in_majority0.N locus table itself is placed here
+    (r"^SNPs_in_majority0\.|^majority_snp_distance_heatmap\.html$", "{subtype}", r"^SNPs_in_majority.{3}$", None,
+     [(r"^SNPs_in_majority.{3}$", ".tsv")], False),
+    (r"^VCF", "VCFs", None, None, [], False),
+]]
+# Tree files from clean_trees go to their subset's Trees folder, Newick files one level down
+TREE_ROUTES = [(re.compile(pattern), folder) for pattern, folder in [
+    (r"(?i)\.tre$", "{subtype}/Trees/Newick_Files"),
+    (r"", "{subtype}/Trees"),
+]]
+# Every artifact in the output folder, with its SNP subset and workspace type, written under the work directory
+OUTPUT_MANIFEST_FILENAME = "output_manifest.json"
+# Workspace types by file suffix, as mapped by save_output_files in wgSNPanalysis.pm
+OUTPUT_WORKSPACE_TYPES = {
+    "txt": "txt",
+    "tsv": "tsv",
+    "report": "tsv",
+    "matrix": "tsv",
+    "phyloxml": "phyloxml",
+    "tre": "nwk",
+    "NJ": "txt",
+    "ML": "txt",
+    "5": "tsv",
+    "vcf": "vcf",
+    "fasta": "aligned_dna_fasta",
+    "html": "html",
+}
+OUTPUT_SUBSETS = {"All_SNPs": "all", "Core_SNPs": "core", "Majority_SNPs": "majority"}
+# Checksums of the files already uploaded to each destination; kept in the work directory, so
+# only for the current job, unless the config names an upload_state_dir shared across jobs
+OUTPUT_UPLOAD_STATE_FILENAME = "output_upload_state.json"
+UPLOAD_WORKERS = 8
+UPLOAD_ATTEMPTS = 4
+UPLOAD_BACKOFF_SECONDS = 2.0
+# IUPAC nucleotide codes accepted in input genomes
+NUCLEOTIDE_CODES = b"ACGTURYKMSWBDHVNacgturykmswbdhvn"
+NORMALIZED_LINE_WIDTH = 80
+# Close-pair index for the report: default cutoff (the app's max_mid_linkage default) and size cap
+CLOSE_PAIRS_DEFAULT_CUTOFF = 40
+CLOSE_PAIRS_MAX = 200000
+# Rendered tree images keyed by the SHA-256 of the cleaned Newick: under the work directory unless the
+# service config names a tree_svg_cache_dir shared across jobs, whose size is then bounded
+TREE_SVG_CACHE_DIRNAME = "tree_svg_cache"
+TREE_SVG_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Trees with more leaves than this also get a label-free light image and a gzip copy of the full one
+TREE_SVG_LIGHT_MIN_LEAVES = 500
+# Per-tree image variants written by run-tree-to-svg for the report, under the work directory
+TREE_IMAGES_FILENAME = "tree_images.json"
+SVG_TEXT_ELEMENTS = re.compile(r"<text\b[^>]*?(?:/>|>.*?</text>)\s*", re.S)
+SVG_DECIMALS = re.compile(r"-?\d+\.\d{2,}")
+# Single-byte Newick tokens that change what the text after them means
+NEWICK_TOKENS = re.compile(rb"([(),:;'\[\]])")
+
 def add_to_report_dict(report_data, source_name, item):
     if source_name not in report_data:
         report_data[source_name] = []  # Initialize the list if the source doesn't exist
@@ -22,36 +138,140 @@ def add_to_report_dict(report_data, source_name, item):
     return report_data
 
 
-def copy_new_file(clean_fasta_dir, new_name, filename, original_path):
-    # Deal with moving the files 
-    clean_path = os.path.join(clean_fasta_dir, new_name)
-    # If the filename was changed, copy the renamed file to the output directory
-    if filename != new_name:
-        print("Renaming and copying: {} -> {}".format(filename, new_name))
-        shutil.copy2(original_path, clean_path)
-    else:
-        print("Copying: {}".format(filename))
-        shutil.copy2(original_path, clean_path) 
-
-def cluster_heatmap_data(genome_ids, snp_matrix):
-    # Convert matrix to distance format
-    dist_array = squareform(snp_matrix)
-    # linkage_result = linkage(dist_array, method="average")
-    linkage_result = linkage(dist_array, method="single")
+def build_distance_payload(path, kind, cache_dir, optimal_ordering=False, close_pair_cutoff=None):
+    """Cluster one heatmap view and encode it for the report; returns (payload, seconds)."""
+    start = time.time()
+    genome_ids, matrix = load_distance_view(path, kind, cache_dir)
+    clustered_labels, clustered_matrix = cluster_heatmap_data(genome_ids, matrix, optimal_ordering=optimal_ordering)
+    return encode_distance_payload(clustered_labels, clustered_matrix, close_pair_cutoff), time.time() - start
+
+
+def cache_distance_table(source_path, genome_ids, matrix, cache_dir, array_path=None):
+    """Record a parsed distance table in the binary cache, keyed on the source file's size and mtime; array_path reuses an already cached array."""
+    os.makedirs(cache_dir, exist_ok=True)
+    npy_path, ids_path = distance_cache_paths(source_path, cache_dir)
+    if array_path is None:
+        array_path = npy_path
+        tmp_path = array_path + ".tmp.npy"
+        np.save(tmp_path, np.asarray(matrix, dtype=np.float32))
+        os.replace(tmp_path, array_path)
+    stat = os.stat(source_path)
+    sidecar = {
+        "source": os.path.abspath(source_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "array": os.path.abspath(array_path),
+        "genome_ids": list(genome_ids),
+    }
+    tmp_path = ids_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sidecar, f)
+    os.replace(tmp_path, ids_path)
+    return array_path
+
+
+def cluster_heatmap_data(genome_ids, snp_matrix, optimal_ordering=False):
+    """Order genomes by single-linkage clustering, optionally with SciPy's optimal leaf ordering, and reorder the matrix to match."""
+    snp_matrix = np.asarray(snp_matrix, dtype=np.float64)
+    if len(genome_ids) < 2:
+        return list(genome_ids), snp_matrix
+    linkage_result = single_linkage(snp_matrix)
+    if optimal_ordering:
+        if len(genome_ids) <= OPTIMAL_LEAF_ORDERING_MAX_GENOMES:
+            linkage_result = optimal_leaf_ordering(linkage_result, squareform(snp_matrix, checks=False))
+        else:
+            sys.stderr.write("Skipping optimal leaf ordering for {} genomes (limit {})\n".format(len(genome_ids), OPTIMAL_LEAF_ORDERING_MAX_GENOMES))
     idx = leaves_list(linkage_result)
-    clustered_matrix = [[snp_matrix[i][j] for j in idx] for i in idx]
+    clustered_matrix = snp_matrix[np.ix_(idx, idx)]
     clustered_labels = [genome_ids[i] for i in idx]
     return clustered_labels, clustered_matrix
 
 
-def create_genome_length_bar_plot(clean_data_dir):
+def compute_new_row_distances(codes, first_new, threads=1, block_bytes=64 * 1024 * 1024):
+    """SNP differences and shared loci between each genome from row first_new on and every genome."""
+    valid, hi, lo = pack_snp_alignment(codes)
+    n_genomes, n_words = valid.shape
+    n_new = n_genomes - first_new
+    diffs = np.zeros((n_new, n_genomes), dtype=np.int32)
+    shared = np.zeros((n_new, n_genomes), dtype=np.int32)
+    if n_new <= 0:
+        return diffs, shared
+    block_rows = max(1, block_bytes // (4 * 8 * n_genomes * max(n_words, 1)))
+
+    def compare_block(start):
+        stop = min(start + block_rows, n_genomes)
+        rows = slice(start - first_new, stop - first_new)
+        both = valid[start:stop, None, :] & valid[None, :, :]
+        shared[rows] = popcount(both).sum(axis=2, dtype=np.int32)
+        mismatch = (hi[start:stop, None, :] ^ hi[None, :, :]) | (lo[start:stop, None, :] ^ lo[None, :, :])
+        mismatch &= both
+        diffs[rows] = popcount(mismatch).sum(axis=2, dtype=np.int32)
+
+    starts = range(first_new, n_genomes, block_rows)
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(compare_block, starts))
+    else:
+        for start in starts:
+            compare_block(start)
+    return diffs, shared
+
+
+def compute_snp_distances(codes, threads=1, block_bytes=64 * 1024 * 1024):
+    """Pairwise SNP differences and shared loci counts for an encoded SNP alignment, ignoring missing loci like kSNPdist."""
+    valid, hi, lo = pack_snp_alignment(codes)
+    n_genomes, n_words = valid.shape
+    diffs = np.zeros((n_genomes, n_genomes), dtype=np.int32)
+    shared = np.zeros((n_genomes, n_genomes), dtype=np.int32)
+    if n_genomes == 0:
+        return diffs, shared
+    # Each block holds a few (rows x n_genomes x n_words) uint64 temporaries
+    block_rows = max(1, block_bytes // (4 * 8 * n_genomes * max(n_words, 1)))
+
+    def compare_block(start):
+        stop = min(start + block_rows, n_genomes)
+        both = valid[start:stop, None, :] & valid[None, start:, :]
+        shared[start:stop, start:] = popcount(both).sum(axis=2, dtype=np.int32)
+        mismatch = (hi[start:stop, None, :] ^ hi[None, start:, :]) | (lo[start:stop, None, :] ^ lo[None, start:, :])
+        mismatch &= both
+        diffs[start:stop, start:] = popcount(mismatch).sum(axis=2, dtype=np.int32)
+
+    starts = range(0, n_genomes, block_rows)
+    if threads > 1:
+        # NumPy releases the GIL for the bitwise work so threads scale here
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(compare_block, starts))
+    else:
+        for start in starts:
+            compare_block(start)
+    # Only the upper triangle was computed; mirror it
+    diffs = np.triu(diffs) + np.triu(diffs, 1).T
+    shared = np.triu(shared) + np.triu(shared, 1).T
+    return diffs, shared
+
+
+def convert_tree_to_phyloxml(raw_nwk, clean_nwk):
+    """Rewrite one kSNP4 tree's genome IDs and convert it to phyloxml; returns the seconds it took."""
+    start = time.time()
+    edit_newick_genome_id(raw_nwk, clean_nwk)
+    run_newick_to_phyloxml(clean_nwk)
+    return time.time() - start
+
+
+def count_newick_leaves(nwk_path):
+    """Number of leaves in a single-tree Newick file."""
+    return 1 + sum(1 for piece, role in iter_newick_pieces(nwk_path) if role == "token" and piece == b",")
+
+
+def create_genome_length_bar_plot(clean_data_dir, index_dir, workers=1):
     genome_lengths = []
-    for filename in os.listdir(clean_data_dir):
-        if filename.endswith(".fasta") or filename.endswith(".fa") or filename.endswith(".fna"):
-            file_path = os.path.join(clean_data_dir, filename)
-            total_length = sum(len(record.seq) for record in SeqIO.parse(file_path, "fasta"))
-            display_name = os.path.splitext(filename)[0].replace("_", ".")
-            genome_lengths.append({"Genome": display_name, "Length": total_length})
+    fasta_paths = [os.path.join(clean_data_dir, filename) for filename in os.listdir(clean_data_dir)
+                   if filename.endswith(FASTA_EXTENSIONS)]
+    contig_lengths = fasta_contig_lengths(fasta_paths, index_dir, workers)
+    for file_path in fasta_paths:
+        total_length = sum(length for _, length in contig_lengths[file_path])
+        display_name = os.path.splitext(os.path.basename(file_path))[0].replace("_", ".")
+        genome_lengths.append({"Genome": display_name, "Length": total_length})
     # Bar Plot
     fig = px.bar(genome_lengths, 
                  x="Genome", 
@@ -380,7 +600,191 @@ def define_html_template(input_genome_table, barplot_html, snp_distribution_html
     return html_template
 
 
-def interactive_threshold_heatmap(service_config, metadata_json, majority_threshold):
+def digest_distance_view(path, kind, cache_dir):
+    """Load one heatmap view and hash its content; returns (digest, seconds)."""
+    start = time.time()
+    genome_ids, matrix = load_distance_view(path, kind, cache_dir)
+    return distance_view_digest(genome_ids, matrix), time.time() - start
+
+
+def distance_cache_paths(source_path, cache_dir):
+    """Cache array and genome-ID sidecar paths for a distance table; the work and output copies get separate entries."""
+    key = hashlib.sha1(os.path.abspath(source_path).encode()).hexdigest()[:12]
+    base = os.path.join(cache_dir, "{}.{}".format(os.path.basename(source_path), key))
+    return base + ".npy", base + ".ids.json"
+
+
+def distance_proportions(diffs, shared, label):
+    """SNP differences as a fraction of the loci each pair shares, as in kSNPdist.matrix; 0 where a pair shares none."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        proportions = np.where(shared > 0, diffs / np.maximum(shared, 1), 0.0)
+    no_shared = int(np.count_nonzero(np.triu(shared == 0, 1)))
+    if no_shared:
+        sys.stderr.write("{} genome pairs share no SNP loci; writing distance 0 for them in {}\n".format(no_shared, label))
+    return proportions
+
+
+def distance_view_digest(genome_ids, matrix):
+    """Content hash of a (labels, matrix) view, independent of genome order, after rounding distances to 4 decimals."""
+    order = sorted(range(len(genome_ids)), key=lambda i: genome_ids[i])
+    digest = hashlib.sha1(json.dumps([genome_ids[i] for i in order]).encode())
+    matrix = np.asarray(matrix, dtype=np.float64)[np.ix_(order, order)]
+    quantized = np.round(matrix * 10000).astype("<i8")
+    digest.update(quantized.tobytes())
+    return digest.hexdigest()
+
+
+def encode_close_pairs(data, n, scale, cutoff, max_pairs=CLOSE_PAIRS_MAX):
+    """Index the pairs of an encoded upper triangle at or below cutoff, sorted by distance, with the smallest distance left out as limit."""
+    selected = np.flatnonzero(data <= cutoff * scale)
+    order = np.argsort(data[selected], kind="stable")
+    positions = selected[order]
+    if len(positions) > max_pairs:
+        first_dropped = data[positions[max_pairs]]
+        positions = positions[:np.searchsorted(data[positions], first_dropped, side="left")]
+    excluded = np.ones(len(data), dtype=bool)
+    excluded[positions] = False
+    limit = float(data[excluded].min()) / scale if excluded.any() else None
+    # Condensed position k of pair (i, j) is row_start[i] + j - i - 1
+    rows = np.arange(n, dtype=np.int64)
+    row_start = rows * n - rows * (rows + 1) // 2
+    i = np.searchsorted(row_start, positions, side="right") - 1
+    j = positions - row_start[i] + i + 1
+    return {
+        "count": len(positions),
+        "limit": limit,
+        "i": base64.b64encode(i.astype("<u4").tobytes()).decode("ascii"),
+        "j": base64.b64encode(j.astype("<u4").tobytes()).decode("ascii"),
+        "d": base64.b64encode(data[positions].tobytes()).decode("ascii"),
+    }
+
+
+def encode_distance_payload(labels, matrix, close_pair_cutoff=None):
+    """Pack the upper triangle of a symmetric distance matrix as the narrowest exact typed array, base64 encoded, for the report."""
+    values = np.asarray(matrix, dtype=np.float64)
+    upper = values[np.triu_indices(len(labels), 1)]
+    scale = 1
+    if not np.all(upper == np.round(upper)):
+        scale = 10000
+        upper = np.round(upper * scale)
+    if upper.size == 0 or (upper.min() >= 0 and upper.max() < 2 ** 8):
+        dtype, data = "uint8", upper.astype("u1")
+    elif upper.min() >= 0 and upper.max() < 2 ** 16:
+        dtype, data = "uint16", upper.astype("<u2")
+    elif upper.min() >= -2 ** 31 and upper.max() < 2 ** 31:
+        dtype, data = "int32", upper.astype("<i4")
+    else:
+        dtype, data = "float32", (upper / scale).astype("<f4")
+        scale = 1
+    payload = {
+        "n": len(labels),
+        "labels": list(labels),
+        "dtype": dtype,
+        "scale": scale,
+        "data": base64.b64encode(data.tobytes()).decode("ascii"),
+    }
+    if close_pair_cutoff is not None:
+        payload["close_pairs"] = encode_close_pairs(data, len(labels), scale, close_pair_cutoff)
+    return payload
+
+
+def encode_kmers(codes, k):
+    """2-bit integers of every k-mer in a KMER_BASE_CODES array, plus a mask of k-mers without ambiguous bases."""
+    n_kmers = len(codes) - k + 1
+    kmers = np.zeros(n_kmers, dtype=np.uint64)
+    bases = (codes & 3).astype(np.uint64)
+    for offset in range(k):
+        kmers <<= np.uint64(2)
+        kmers |= bases[offset:offset + n_kmers]
+    ambiguous = np.concatenate(([0], np.cumsum(codes > 3)))
+    return kmers, (ambiguous[k:] - ambiguous[:-k]) == 0
+
+
+def fasta_contig_lengths(fasta_paths, index_dir, workers=1):
+    """Map each FASTA path to its [(contig, length), ...], reusing up-to-date .fai indexes in index_dir."""
+    os.makedirs(index_dir, exist_ok=True)
+    contig_lengths = {}
+    to_index = []
+    for fasta_path in fasta_paths:
+        index_path = fasta_index_path(fasta_path, index_dir)
+        if os.path.exists(index_path) and os.stat(index_path).st_mtime_ns >= os.stat(fasta_path).st_mtime_ns:
+            contig_lengths[fasta_path] = read_fasta_index(index_path)
+        else:
+            to_index.append((fasta_path, index_path))
+    for (fasta_path, _), contigs in zip(to_index, run_in_process_pool(index_fasta, to_index, workers)):
+        contig_lengths[fasta_path] = [(name, length) for name, length, _, _, _ in contigs]
+    return contig_lengths
+
+
+def fasta_index_path(fasta_path, index_dir):
+    return os.path.join(index_dir, os.path.basename(fasta_path) + ".fai")
+
+
+def fill_kchooser_report_template(template, genome_names):
+    """Put this job's genome names (keyed by sequence hash) back into a cached Kchooser4 report; None if one is unknown."""
+    if any(match.group(1) not in genome_names for match in KCHOOSER_GENOME_PLACEHOLDER.finditer(template)):
+        return None
+    return KCHOOSER_GENOME_PLACEHOLDER.sub(lambda match: genome_names[match.group(1)], template)
+
+
+def index_fasta(fasta_path, index_path, chunk_size=FASTA_CHUNK_SIZE):
+    """Scan a FASTA file in large binary chunks and write a samtools faidx style index; returns the index rows."""
+    contigs = []
+    current = None
+    header = None
+    # Bytes seen so far on the first sequence line of the current contig, and the last of them
+    measuring, measured, last_byte = False, 0, None
+    chunk_offset = 0
+    with open(fasta_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            pos, end = 0, len(chunk)
+            while pos < end:
+                if header is not None:
+                    newline = chunk.find(b"\n", pos)
+                    if newline == -1:
+                        header += chunk[pos:]
+                        break
+                    header += chunk[pos:newline]
+                    fields = header.decode(errors="replace").split()
+                    current = [fields[0] if fields else "", 0, chunk_offset + newline + 1, 0, 0]
+                    contigs.append(current)
+                    header = None
+                    measuring, measured, last_byte = True, 0, None
+                    pos = newline + 1
+                    continue
+                next_header = chunk.find(b">", pos)
+                stop = end if next_header == -1 else next_header
+                segment = chunk[pos:stop]
+                if current is not None:
+                    current[1] += len(segment) - segment.count(b"\n") - segment.count(b"\r")
+                    if measuring:
+                        newline = segment.find(b"\n")
+                        if newline == -1:
+                            measured += len(segment)
+                            last_byte = segment[-1] if segment else last_byte
+                        else:
+                            previous = segment[newline - 1] if newline > 0 else last_byte
+                            current[4] = measured + newline + 1
+                            current[3] = current[4] - (2 if previous == ord("\r") else 1)
+                            measuring = False
+                if next_header != -1:
+                    header = bytearray()
+                    pos = next_header + 1
+                else:
+                    pos = end
+            chunk_offset += len(chunk)
+    if current is not None and measuring:
+        # Single unterminated sequence line at the end of the file
+        current[3] = current[4] = measured
+    with open(index_path, "w") as f:
+        f.writelines("\t".join(str(field) for field in contig) + "\n" for contig in contigs)
+    return contigs
+
+
+def interactive_threshold_heatmap(service_config, metadata_json, majority_threshold, optimal_ordering=False):
     with open(service_config) as file:
         data = json.load(file)
     work_dir = data["work_data_dir"]
@@ -414,25 +818,49 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         )
         return heatmap_html, ""
 
-    def load_subset(report_path, matrix_path):
-        ids_rep, mat_rep, ids_mat, mat_mat = "null", "null", "null", "null"
-        if os.path.exists(report_path):
-            gids, mat = read_ksnp_distance_report(report_path)
-            cl, cm = cluster_heatmap_data(gids, mat)
-            ids_rep = json.dumps(cl)
-            mat_rep = json.dumps(cm)
-        if os.path.exists(matrix_path):
-            gids, mat = read_ksnp_distance_matrix(matrix_path)
-            cl, cm = cluster_heatmap_data(gids, mat)
-            ids_mat = json.dumps(cl)
-            mat_mat = json.dumps(cm)
-        return ids_rep, mat_rep, ids_mat, mat_mat
-
-    all_ids_rep,      all_mat_rep,      all_ids_mat,      all_mat_mat      = load_subset(**file_paths["all"])
-    core_ids_rep,     core_mat_rep,     core_ids_mat,     core_mat_mat     = load_subset(**file_paths["core"])
-    majority_ids_rep, majority_mat_rep, majority_ids_mat, majority_mat_mat = load_subset(**file_paths["majority"])
+    cache_dir = os.path.join(work_dir, DISTANCE_CACHE_DIRNAME)
+
+    # The six (subset, source) views are independent, so they are loaded and clustered on a
+    # process pool sized from the job's cores. Identical views (e.g. the all, core and majority
+    # reports when every SNP is core) are clustered and embedded once; every selector entry points
+    # at a payload digest. Keyed by the matrixSelector option values.
+    cores = int(data.get("cores", 1))
+    distance_views = {}
+    view_jobs = []
+    for key, subset in (("1", "all"), ("2", "core"), ("3", "majority")):
+        distance_views[key] = {"report": None, "matrix": None}
+        for kind in ("report", "matrix"):
+            path = file_paths[subset]["{}_path".format(kind)]
+            if os.path.exists(path):
+                view_jobs.append((key, subset, kind, path))
+
+    digests = run_in_process_pool(digest_distance_view, [(path, kind, cache_dir) for _, _, kind, path in view_jobs], cores)
+    unique_views = {}
+    for (key, subset, kind, path), (digest, elapsed) in zip(view_jobs, digests):
+        sys.stderr.write("{} SNPs {} view: loaded and hashed in {:.2f}s\n".format(subset, kind, elapsed))
+        distance_views[key][kind] = digest
+        if digest in unique_views:
+            sys.stderr.write("{} has the same distances as an earlier view; embedding it once\n".format(path))
+        else:
+            unique_views[digest] = (subset, kind, path)
+
+    # Close pairs are indexed up to the top of the mid-linkage band, the largest threshold the report suggests.
+    # That band is in SNPs, so only the SNP count (report) views are indexed; proportion views are scanned.
+    close_pair_cutoff = float(data["params"].get("max_mid_linkage", CLOSE_PAIRS_DEFAULT_CUTOFF))
+    built = run_in_process_pool(build_distance_payload, [(path, kind, cache_dir, optimal_ordering, close_pair_cutoff if kind == "report" else None)
+                                                         for _, kind, path in unique_views.values()], cores)
+    distance_payloads = {}
+    for (digest, (subset, kind, _)), (payload, elapsed) in zip(unique_views.items(), built):
+        sys.stderr.write("{} SNPs {} view: clustered and encoded in {:.2f}s\n".format(subset, kind, elapsed))
+        distance_payloads[digest] = payload
     # format the metadata into a string for the report
     metadata_json_string, metadata_df = create_metadata_table(metadata_json, "metadata.tsv")
+    # Tree image variants from run-tree-to-svg; big trees have a light image to show first
+    tree_images = {}
+    tree_images_path = os.path.join(work_dir, TREE_IMAGES_FILENAME)
+    if os.path.exists(tree_images_path):
+        with open(tree_images_path) as f:
+            tree_images = json.load(f)
     heatmap_template = """
     <!-- Plotly.js v3.0.1  — last updated June 2025 -->
     <script src="https://cdn.plot.ly/plotly-3.0.1.min.js"></script>
@@ -535,7 +963,15 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         </label>
         <button style="padding:8px 8px; font-size:14px;" onclick="applyThresholdColoring()">Recolor</button>
       </div>
+      <!-- Large-matrix mode: shown while a zoomed window of the overview is displayed -->
+      <div id="heatmapZoomBar" style="display:none; margin:8px 0; font-size:13px; color:#555;">
+        <button id="heatmapOverviewButton" style="padding:4px 10px; font-size:13px; cursor:pointer;" onclick="showHeatmapOverview()">&#8592; Back to overview</button>
+        <span id="heatmapZoomText" style="margin-left:8px;"></span>
+      </div>
       <div id="heatmap" style="width:100%;"></div>
+      <div id="heatmapHover" style="display:none; position:fixed; pointer-events:none; z-index:10;
+           background:rgba(255,255,255,0.95); border:1px solid #999; border-radius:3px;
+           padding:4px 8px; font-size:12px;"></div>
       <!-- Genome comparison panel (appears on cell click) -->
       <div id="comparisonPanel" style="display:none; margin-top:18px; border:1px solid #ccc;
            border-radius:6px; padding:16px; background:#fafafa;">
@@ -595,7 +1031,7 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
           Search genome ID:
           <input type="text" id="dmSearch" placeholder="Filter rows by ID..."
                  style="padding:4px 8px; width:200px; font-size:13px;"
-                 oninput="buildDistTable()">
+                 oninput="scheduleDistTableSearch()">
         </label>
         <span id="dmRowCount" style="color:#555; font-size:13px;"></span>
         <button onclick="exportDistTableToExcel()"
@@ -611,9 +1047,12 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         <span id="dmKeyMatching" style="background:#a8d5a2; color:#333; padding:2px 8px; border-radius:3px;">Matching threshold</span>
         <span id="dmKeyAbove"    style="background:#f4a460; color:#333; padding:2px 8px; border-radius:3px;">Above threshold</span>
       </div>
+      <!-- Only the visible cells are drawn on the canvas; the sizer gives the scrollbars the full table extent -->
       <div id="dmTableWrapper"
            style="overflow:auto; max-height:600px; border:1px solid #ccc; border-radius:4px;">
-        <table id="dmTable" style="border-collapse:collapse; white-space:nowrap;"></table>
+        <div id="dmTableSizer">
+          <canvas id="dmCanvas" style="position:sticky; top:0; left:0; display:block;"></canvas>
+        </div>
       </div>
     </div><!-- end distanceTableViewSection -->
 
@@ -643,22 +1082,16 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
 
     <script>
         // ===== Embedded data =====
-        // Pairwise SNP report (kSNPdist.report) — raw integer SNP counts
-        const labelsAll_rep      = {all_ids_rep};
-        const matrixAll_rep      = {all_mat_rep};
-        const labelsCore_rep     = {core_ids_rep};
-        const matrixCore_rep     = {core_mat_rep};
-        const labelsMaj_rep      = {majority_ids_rep};
-        const matrixMaj_rep      = {majority_mat_rep};
-        // Distance matrix (kSNPdist.matrix) — proportional float distances
-        const labelsAll_mat      = {all_ids_mat};
-        const matrixAll_mat      = {all_mat_mat};
-        const labelsCore_mat     = {core_ids_mat};
-        const matrixCore_mat     = {core_mat_mat};
-        const labelsMaj_mat      = {majority_ids_mat};
-        const matrixMaj_mat      = {majority_mat_mat};
+        // Per SNP subset: pairwise SNP report (kSNPdist.report, raw integer SNP counts) and
+        // distance matrix (kSNPdist.matrix, proportional float distances). Views point at a
+        // payload digest so identical views share one payload. Each payload is the base64
+        // upper triangle of a typed array, decoded on first use.
+        const distanceViews    = {distance_views};
+        const distancePayloads = {distance_payloads};
 
         const metadata      = {metadata_json_string};
+        // Per tree file: leaf count and whether a label-free light image exists
+        const treeImages    = {tree_images};
 
         const idToMeta = {{}};
         metadata.forEach(obj => {{ idToMeta[obj.genome_id] = obj; }});
@@ -668,27 +1101,51 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         // 'viridis' on initial load; 'threshold' after Recolor is clicked
         let heatmapColorMode = 'viridis';
 
+        // ===== Decode an embedded payload into labels + full symmetric matrix =====
+        const payloadArrayTypes = {{ uint8: Uint8Array, uint16: Uint16Array, int32: Int32Array, float32: Float32Array }};
+
+        function decodeBase64Array(data, ArrayType) {{
+            const raw   = atob(data);
+            const bytes = new Uint8Array(raw.length);
+            for (let k = 0; k < raw.length; k++) bytes[k] = raw.charCodeAt(k);
+            return new ArrayType(bytes.buffer);
+        }}
+
+        function decodeDistancePayload(payload) {{
+            const upper = decodeBase64Array(payload.data, payloadArrayTypes[payload.dtype]);
+            const n = payload.n;
+            const matrix = [];
+            for (let i = 0; i < n; i++) matrix.push(new Array(n).fill(0));
+            let k = 0;
+            for (let i = 0; i < n; i++) {{
+                for (let j = i + 1; j < n; j++) {{
+                    const v = upper[k++] / payload.scale;
+                    matrix[i][j] = v;
+                    matrix[j][i] = v;
+                }}
+            }}
+            return {{ labels: payload.labels, matrix: matrix }};
+        }}
+
+        const decodedPayloads = {{}};
+
         // ===== Return the active matrix based on SNP subset + data source selectors =====
         function getActiveMatrix() {{
             const subset = document.getElementById('matrixSelector').value;
             const src    = document.getElementById('dataSourceSelector').value;
-            const sets = {{
-                "1": {{ report: {{ labels: labelsAll_rep,  matrix: matrixAll_rep  }},
-                        matrix: {{ labels: labelsAll_mat,  matrix: matrixAll_mat  }} }},
-                "2": {{ report: {{ labels: labelsCore_rep, matrix: matrixCore_rep }},
-                        matrix: {{ labels: labelsCore_mat, matrix: matrixCore_mat }} }},
-                "3": {{ report: {{ labels: labelsMaj_rep,  matrix: matrixMaj_rep  }},
-                        matrix: {{ labels: labelsMaj_mat,  matrix: matrixMaj_mat  }} }},
-            }};
-            const chosen = sets[subset][src];
-            if (!chosen || !chosen.labels) {{
+            const key    = distanceViews[subset] ? distanceViews[subset][src] : null;
+            const payload = key ? distancePayloads[key] : null;
+            if (!payload) {{
                 return {{ labels: [], matrix: [] }};
             }}
-            return {{ labels: chosen.labels.slice(), matrix: chosen.matrix.map(r => r.slice()) }};
+            // Decode lazily, only once a subset/source is actually viewed; views never mutate it
+            if (!decodedPayloads[key]) decodedPayloads[key] = decodeDistancePayload(payload);
+            return decodedPayloads[key];
         }}
 
         // ===== SNP subset change — refresh all visible views =====
         function onMatrixChange() {{
+            heatmapWindow = null;
             recolorHeatmap();
             updateSVG();
             const cpSec = document.getElementById('closePairsViewSection');
@@ -818,17 +1275,96 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
             }}
         }}
 
-        // ===== Heatmap cell click → comparison panel =====
+        // ===== Large-matrix heatmap mode =====
+        // Above HEATMAP_DETAIL_MAX genomes the heatmap shows a block-downsampled overview; clicking a
+        // block zooms to a full-resolution window of HEATMAP_WINDOW genomes around it
+        const HEATMAP_DETAIL_MAX     = 800;
+        const HEATMAP_OVERVIEW_CELLS = 300;
+        const HEATMAP_WINDOW         = 200;
+        let heatmapWindow = null;
+        // What the plot currently shows, so hover and click can map a cell back to genomes
+        let heatmapGrid = null;
+
+        function matrixMax(matrix) {{
+            let maxVal = -Infinity;
+            for (let i = 0; i < matrix.length; i++) {{
+                const row = matrix[i];
+                for (let j = 0; j < row.length; j++) if (row[j] > maxVal) maxVal = row[j];
+            }}
+            return maxVal;
+        }}
+
+        // Smallest distance in each block x block tile, so close pairs stay visible when downsampled
+        function blockMinMatrix(matrix, block) {{
+            const n = matrix.length;
+            const m = Math.ceil(n / block);
+            const out = [];
+            for (let bi = 0; bi < m; bi++) {{
+                const row = new Array(m).fill(Infinity);
+                for (let i = bi * block; i < Math.min(n, (bi + 1) * block); i++) {{
+                    const src = matrix[i];
+                    for (let j = 0; j < n; j++) {{
+                        const bj = (j / block) | 0;
+                        if (src[j] < row[bj]) row[bj] = src[j];
+                    }}
+                }}
+                out.push(row);
+            }}
+            return out;
+        }}
+
+        function blockRange(b, block, n) {{
+            return (b * block + 1) + '–' + Math.min(n, (b + 1) * block);
+        }}
+
+        function showHeatmapOverview() {{
+            heatmapWindow = null;
+            recolorHeatmap();
+        }}
+
+        // ===== Heatmap hover → tooltip built from the cell's indices =====
+        function onHeatmapHover(eventData) {{
+            const tip = document.getElementById('heatmapHover');
+            if (!eventData || !eventData.points || eventData.points.length === 0 || !heatmapGrid) return;
+            const [yi, xi] = eventData.points[0].pointIndex;
+            const g = heatmapGrid;
+            if (g.block) {{
+                tip.innerHTML = `Genomes ${{blockRange(yi, g.block, g.n)}} vs ${{blockRange(xi, g.block, g.n)}}` +
+                    `<br>Closest SNP Distance: ${{g.values[yi][xi]}}<br><i>Click to zoom in</i>`;
+            }} else {{
+                const i = g.r0 + yi, j = g.c0 + xi;
+                tip.innerHTML = `${{currentLabels[i]}} vs ${{currentLabels[j]}}` +
+                    `<br>SNP Distance: ${{currentMatrix[i][j]}}<br><i>Click to show metadata</i>`;
+            }}
+            tip.style.left = (eventData.event.clientX + 12) + 'px';
+            tip.style.top  = (eventData.event.clientY + 12) + 'px';
+            tip.style.display = 'block';
+        }}
+
+        function onHeatmapUnhover() {{
+            document.getElementById('heatmapHover').style.display = 'none';
+        }}
+
+        // ===== Heatmap cell click → comparison panel, or zoom in from the overview =====
         function onHeatmapClick(eventData) {{
-            if (!eventData || !eventData.points || eventData.points.length === 0) return;
-            const pt   = eventData.points[0];
-            // Use customdata genome IDs so the comparison panel works even when axes
+            if (!eventData || !eventData.points || eventData.points.length === 0 || !heatmapGrid) return;
+            const [yi, xi] = eventData.points[0].pointIndex;
+            const g = heatmapGrid;
+            if (g.block) {{
+                const span = Math.min(HEATMAP_WINDOW, g.n);
+                const centre = b => Math.max(0, Math.min(g.n - span, Math.round((b + 0.5) * g.block - span / 2)));
+                heatmapWindow = {{ r0: centre(yi), c0: centre(xi) }};
+                onHeatmapUnhover();
+                recolorHeatmap();
+                return;
+            }}
+            // Look genomes up by index so the comparison panel works even when axes
             // are labeled by a metadata field rather than genome ID
-            const id1  = pt.customdata ? pt.customdata[0] : pt.y;
-            const id2  = pt.customdata ? pt.customdata[1] : pt.x;
-            const i1   = currentLabels.indexOf(id1);
-            const i2   = currentLabels.indexOf(id2);
-            const dist = (i1 >= 0 && i2 >= 0) ? currentMatrix[i1][i2] : '';
+            const i1   = g.r0 + yi;
+            const i2   = g.c0 + xi;
+            const id1  = currentLabels[i1];
+            const id2  = currentLabels[i2];
+            const dist = currentMatrix[i1][i2];
             const meta1 = idToMeta[id1] || {{ genome_id: id1 }};
             const meta2 = idToMeta[id2] || {{ genome_id: id2 }};
             document.getElementById('comparisonTitle').textContent = `SNP Distance: ${{dist}}`;
@@ -853,6 +1389,7 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
             if (genomeLabels.length === 0) {{
                 document.getElementById('heatmap').innerHTML =
                     '<p style="color:#666; font-style:italic; padding:16px;">No distance data available for this SNP subset and data source combination.</p>';
+                document.getElementById('heatmapZoomBar').style.display = 'none';
                 return;
             }}
 
@@ -864,6 +1401,7 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
 
             currentLabels = genomeLabels;
             currentMatrix = snpMatrix;
+            const n = genomeLabels.length;
 
             // Build display labels: use metadata field value if selected, fall back to genome ID
             const displayLabels = genomeLabels.map(id => {{
@@ -875,18 +1413,39 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                 return `${{id}} | ${{val}}`;
             }});
 
-            // customdata stores [rowGenomeId, colGenomeId] per cell so the click handler
-            // can look up metadata even when display labels are not genome IDs
-            const customData = genomeLabels.map(id1 => genomeLabels.map(id2 => [id1, id2]));
-
-            const hoverText = snpMatrix.map((row, i) =>
-                row.map((val, j) => `${{genomeLabels[i]}} vs ${{genomeLabels[j]}}<br>SNP Distance: ${{val}}<br><i>Click to show metadata</i>`)
-            );
+            // Full matrix, a zoomed window of it, or a block-downsampled overview
+            let grid, viewNote = '';
+            if (n <= HEATMAP_DETAIL_MAX) {{
+                heatmapWindow = null;
+                grid = {{ values: snpMatrix, x: displayLabels, y: displayLabels, r0: 0, c0: 0, n: n }};
+            }} else if (heatmapWindow) {{
+                const span = Math.min(HEATMAP_WINDOW, n);
+                const r0 = Math.min(heatmapWindow.r0, n - span);
+                const c0 = Math.min(heatmapWindow.c0, n - span);
+                const values = [];
+                for (let i = r0; i < r0 + span; i++) values.push(snpMatrix[i].slice(c0, c0 + span));
+                grid = {{ values: values, x: displayLabels.slice(c0, c0 + span), y: displayLabels.slice(r0, r0 + span),
+                          r0: r0, c0: c0, n: n }};
+                viewNote = ` – genomes ${{r0 + 1}}–${{r0 + span}} vs ${{c0 + 1}}–${{c0 + span}}`;
+            }} else {{
+                const block = Math.ceil(n / HEATMAP_OVERVIEW_CELLS);
+                const values = blockMinMatrix(snpMatrix, block);
+                const ticks = values.map((_, b) => blockRange(b, block, n));
+                grid = {{ values: values, x: ticks, y: ticks, block: block, n: n }};
+                viewNote = ` – overview of ${{n}} genomes`;
+            }}
+            heatmapGrid = grid;
+            const zoomBar = document.getElementById('heatmapZoomBar');
+            zoomBar.style.display = (n > HEATMAP_DETAIL_MAX) ? 'block' : 'none';
+            document.getElementById('heatmapOverviewButton').style.display = grid.block ? 'none' : '';
+            document.getElementById('heatmapZoomText').textContent = grid.block
+                ? `Each cell shows the closest pair among ${{grid.block}} × ${{grid.block}} genomes. Click a cell to zoom in.`
+                : (n > HEATMAP_DETAIL_MAX ? `Showing genomes ${{grid.r0 + 1}}–${{grid.r0 + grid.values.length}} (rows) and ${{grid.c0 + 1}}–${{grid.c0 + grid.values.length}} (columns) of ${{n}}.` : '');
 
             let zData, colorscale, colorbarConfig, extraRange;
             if (heatmapColorMode === 'threshold') {{
-                const maxVal = Math.max(...snpMatrix.flat());
-                zData        = snpMatrix.map(row => row.map(val => assignBin(val, t1, t2, maxVal)));
+                const maxVal = matrixMax(snpMatrix);
+                zData        = grid.values.map(row => row.map(val => assignBin(val, t1, t2, maxVal)));
                 colorscale   = getColorScale();
                 extraRange   = {{ zmin: 0, zmax: 4 }};
                 colorbarConfig = {{
@@ -895,21 +1454,21 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                     title: 'Linkage Strength'
                 }};
             }} else {{
-                zData        = snpMatrix;
+                zData        = grid.values;
                 colorscale   = 'Viridis';
                 extraRange   = {{}};
                 colorbarConfig = {{ title: 'SNP Distance' }};
             }}
 
-            const titleStr = heatmapColorMode === 'threshold'
+            const titleStr = (heatmapColorMode === 'threshold'
                 ? `SNP Heatmap (Thresholds: ${{t1}}, ${{t2}})` + (metaField ? ` – Reordered by "${{metaField}}"` : '')
-                : 'SNP Distance Heatmap'                        + (metaField ? ` – Reordered by "${{metaField}}"` : '');
+                : 'SNP Distance Heatmap'                        + (metaField ? ` – Reordered by "${{metaField}}"` : '')) + viewNote;
 
+            // Hover text is built on demand from the cell indices instead of an N x N array of strings
             const traceData = [Object.assign({{
-                z: zData, x: displayLabels, y: displayLabels,
+                z: zData, x: grid.x, y: grid.y,
                 type: 'heatmap', colorscale: colorscale,
-                text: hoverText, hoverinfo: 'text', colorbar: colorbarConfig,
-                customdata: customData
+                hoverinfo: 'none', colorbar: colorbarConfig
             }}, extraRange)];
 
             const heatmapDiv = document.getElementById('heatmap');
@@ -919,12 +1478,14 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                 title: titleStr,
                 width: plotDim,
                 height: plotDim,
-                xaxis: {{ type: 'category', tickangle: 45 }},
-                yaxis: {{ type: 'category', tickangle: 45 }}
+                xaxis: {{ type: 'category', tickangle: 45, showticklabels: !grid.block }},
+                yaxis: {{ type: 'category', tickangle: 45, showticklabels: !grid.block }}
             }};
 
             Plotly.newPlot('heatmap', traceData, layout);
-            document.getElementById('heatmap').on('plotly_click', onHeatmapClick);
+            heatmapDiv.on('plotly_click', onHeatmapClick);
+            heatmapDiv.on('plotly_hover', onHeatmapHover);
+            heatmapDiv.on('plotly_unhover', onHeatmapUnhover);
         }}
 
         // ===== Switch to threshold coloring (Recolor button) =====
@@ -983,15 +1544,58 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         let _cpSortField = 'dist';
         let _cpSortAsc   = true;
 
+        // Pairs of the active view sorted by distance, precomputed up to a cutoff; decoded once per payload
+        const decodedClosePairs = {{}};
+
+        function getClosePairIndex() {{
+            const subset = document.getElementById('matrixSelector').value;
+            const src    = document.getElementById('dataSourceSelector').value;
+            const key    = distanceViews[subset] ? distanceViews[subset][src] : null;
+            const payload = key ? distancePayloads[key] : null;
+            if (!payload || !payload.close_pairs) return null;
+            if (!decodedClosePairs[key]) {{
+                const cp = payload.close_pairs;
+                const d  = decodeBase64Array(cp.d, payloadArrayTypes[payload.dtype]);
+                const dist = new Float64Array(d.length);
+                for (let k = 0; k < d.length; k++) dist[k] = d[k] / payload.scale;
+                decodedClosePairs[key] = {{
+                    labels: payload.labels,
+                    i: decodeBase64Array(cp.i, Uint32Array),
+                    j: decodeBase64Array(cp.j, Uint32Array),
+                    dist: dist,
+                    limit: cp.limit,
+                }};
+            }}
+            return decodedClosePairs[key];
+        }}
+
         function buildClosePairs() {{
             const t = getDmThreshold();
-            const {{ labels, matrix }} = getActiveMatrix();
-            const n = labels.length;
+            const index = getClosePairIndex();
             _cpPairs = [];
-            for (let i = 0; i < n; i++) {{
-                for (let j = i + 1; j < n; j++) {{
-                    const d = matrix[i][j];
-                    if (t === null || d <= t) _cpPairs.push({{ g1: labels[i], g2: labels[j], dist: d }});
+            // The index holds every pair below its limit; larger thresholds fall back to a full scan
+            if (index && (index.limit === null || (t !== null && t < index.limit))) {{
+                let lo = 0, hi = index.dist.length;
+                if (t !== null) {{
+                    while (lo < hi) {{
+                        const mid = (lo + hi) >>> 1;
+                        if (index.dist[mid] <= t) lo = mid + 1; else hi = mid;
+                    }}
+                }} else {{
+                    lo = hi;
+                }}
+                const labels = index.labels;
+                for (let k = 0; k < lo; k++) {{
+                    _cpPairs.push({{ g1: labels[index.i[k]], g2: labels[index.j[k]], dist: index.dist[k] }});
+                }}
+            }} else {{
+                const {{ labels, matrix }} = getActiveMatrix();
+                const n = labels.length;
+                for (let i = 0; i < n; i++) {{
+                    for (let j = i + 1; j < n; j++) {{
+                        const d = matrix[i][j];
+                        if (t === null || d <= t) _cpPairs.push({{ g1: labels[i], g2: labels[j], dist: d }});
+                    }}
                 }}
             }}
             _renderClosePairs(t);
@@ -1048,6 +1652,43 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         }}
 
         // ===== Full Distance Matrix Table =====
+        // Drawn on a canvas that only paints the cells in view, so thousands of genomes stay responsive
+        const DM_CELL_H   = 20;
+        const DM_HEADER_H = 110;
+        const DM_FONT     = '11px sans-serif';
+        const _dmExtents  = new WeakMap();
+        let _dm = null;
+        let _dmSearchTimer = null;
+        let _dmDrawPending = false;
+
+        function scheduleDistTableSearch() {{
+            clearTimeout(_dmSearchTimer);
+            _dmSearchTimer = setTimeout(buildDistTable, 200);
+        }}
+
+        function scheduleDistTableDraw() {{
+            if (_dmDrawPending) return;
+            _dmDrawPending = true;
+            requestAnimationFrame(() => {{ _dmDrawPending = false; drawDistTable(); }});
+        }}
+
+        // Widest value text per matrix, measured once
+        function distTableExtent(matrix) {{
+            if (!_dmExtents.has(matrix)) {{
+                let maxVal = 0, fractional = false;
+                for (let i = 0; i < matrix.length; i++) {{
+                    const row = matrix[i];
+                    for (let j = 0; j < row.length; j++) {{
+                        const v = row[j];
+                        if (v > maxVal) maxVal = v;
+                        if (!fractional && v % 1 !== 0) fractional = true;
+                    }}
+                }}
+                _dmExtents.set(matrix, {{ maxVal: maxVal, fractional: fractional }});
+            }}
+            return _dmExtents.get(matrix);
+        }}
+
         function buildDistTable() {{
             const searchVal = document.getElementById('dmSearch') ? document.getElementById('dmSearch').value.trim().toLowerCase() : '';
             const t = getDmThreshold();
@@ -1064,54 +1705,36 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                 if (!searchVal || lbl.toLowerCase().includes(searchVal)) visibleRows.push(i);
             }});
 
-            const table    = document.getElementById('dmTable');
-            const fragment = document.createDocumentFragment();
-
-            const thead  = document.createElement('thead');
-            const hRow   = document.createElement('tr');
-            const corner = document.createElement('th');
-            corner.style.cssText = 'position:sticky; top:0; left:0; z-index:4; background:#fff; padding:4px 8px; border:1px solid #ddd; min-width:120px;';
-            corner.textContent = '';
-            hRow.appendChild(corner);
-            labels.forEach(lbl => {{
-                const th = document.createElement('th');
-                th.style.cssText = 'position:sticky; top:0; z-index:2; background:#f8f8f8; border:1px solid #ddd; padding:2px; font-size:10px; font-weight:normal; writing-mode:vertical-rl; transform:rotate(180deg); height:110px; vertical-align:bottom; text-align:left;';
-                th.textContent = lbl;
-                hRow.appendChild(th);
-            }});
-            thead.appendChild(hRow);
-            fragment.appendChild(thead);
+            const canvas = document.getElementById('dmCanvas');
+            const ctx = canvas.getContext('2d');
+            ctx.font = DM_FONT;
+            const extent = distTableExtent(matrix);
+            const valueText = Math.max(ctx.measureText(String(extent.maxVal)).width,
+                                       extent.fractional ? ctx.measureText('0.0000').width : 0);
+            let labelW = 120;
+            labels.forEach(lbl => {{ labelW = Math.max(labelW, ctx.measureText(lbl).width + 16); }});
+            _dm = {{
+                labels: labels,
+                matrix: matrix,
+                t: t,
+                rows: visibleRows,
+                cellW: Math.max(28, Math.ceil(valueText) + 10),
+                labelW: Math.min(240, Math.ceil(labelW)),
+            }};
 
-            const tbody = document.createElement('tbody');
-            visibleRows.forEach(i => {{
-                const tr    = document.createElement('tr');
-                const rowTh = document.createElement('th');
-                rowTh.style.cssText = 'position:sticky; left:0; z-index:1; background:#f8f8f8; border:1px solid #ddd; padding:3px 8px; font-size:11px; font-weight:normal; white-space:nowrap; text-align:left;';
-                rowTh.textContent = labels[i];
-                tr.appendChild(rowTh);
-                labels.forEach((lbl, j) => {{
-                    const val        = matrix[i][j];
-                    const {{ bg, fg }} = getDmColor(val, t);
-                    const td         = document.createElement('td');
-                    td.style.cssText = 'background:' + bg + '; color:' + fg + '; padding:3px 5px; border:1px solid #ddd; text-align:center; font-size:11px; min-width:28px;';
-                    td.textContent   = val;
-                    td.title         = labels[i] + ' vs ' + lbl + ': ' + val + ' SNP differences';
-                    tr.appendChild(td);
-                }});
-                tbody.appendChild(tr);
-            }});
-            if (visibleRows.length === 0) {{
-                const emptyTr = document.createElement('tr');
-                const emptyTd = document.createElement('td');
-                emptyTd.colSpan = n + 1;
-                emptyTd.style.cssText = 'padding:16px; text-align:center; color:#666; font-style:italic;';
-                emptyTd.textContent   = 'No genomes match the current filters.';
-                emptyTr.appendChild(emptyTd);
-                tbody.appendChild(emptyTr);
+            const fullH = DM_HEADER_H + Math.max(visibleRows.length, 1) * DM_CELL_H;
+            const sizer = document.getElementById('dmTableSizer');
+            sizer.style.width  = (_dm.labelW + n * _dm.cellW) + 'px';
+            sizer.style.height = fullH + 'px';
+            const wrapper = document.getElementById('dmTableWrapper');
+            wrapper.style.height = Math.min(600, fullH + 18) + 'px';
+            if (!wrapper.dataset.bound) {{
+                wrapper.dataset.bound = '1';
+                wrapper.addEventListener('scroll', scheduleDistTableDraw);
+                window.addEventListener('resize', scheduleDistTableDraw);
+                canvas.addEventListener('mousemove', onDistTableHover);
             }}
-            fragment.appendChild(tbody);
-            table.innerHTML = '';
-            table.appendChild(fragment);
+            drawDistTable();
 
             document.getElementById('dmRowCount').textContent =
                 visibleRows.length === n
@@ -1119,6 +1742,111 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                     : 'Showing ' + visibleRows.length + ' of ' + n + ' genomes';
         }}
 
+        function drawDistTable() {{
+            if (!_dm) return;
+            const {{ labels, matrix, t, rows, cellW, labelW }} = _dm;
+            const n = labels.length;
+            const wrapper = document.getElementById('dmTableWrapper');
+            const canvas  = document.getElementById('dmCanvas');
+            const w = Math.min(wrapper.clientWidth, labelW + n * cellW);
+            const h = Math.min(wrapper.clientHeight, DM_HEADER_H + Math.max(rows.length, 1) * DM_CELL_H);
+            const dpr = window.devicePixelRatio || 1;
+            if (canvas.width !== Math.round(w * dpr) || canvas.height !== Math.round(h * dpr)) {{
+                canvas.width  = Math.round(w * dpr);
+                canvas.height = Math.round(h * dpr);
+                canvas.style.width  = w + 'px';
+                canvas.style.height = h + 'px';
+            }}
+            const ctx = canvas.getContext('2d');
+            ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+            ctx.clearRect(0, 0, w, h);
+            ctx.font = DM_FONT;
+            ctx.textBaseline = 'middle';
+            ctx.lineWidth = 1;
+            ctx.strokeStyle = '#ddd';
+
+            const sx = wrapper.scrollLeft, sy = wrapper.scrollTop;
+            const c0 = Math.floor(sx / cellW);
+            const c1 = Math.min(n, Math.ceil((sx + w - labelW) / cellW) + 1);
+            const r0 = Math.floor(sy / DM_CELL_H);
+            const r1 = Math.min(rows.length, Math.ceil((sy + h - DM_HEADER_H) / DM_CELL_H) + 1);
+
+            // Cells
+            ctx.textAlign = 'center';
+            for (let r = r0; r < r1; r++) {{
+                const y = DM_HEADER_H + r * DM_CELL_H - sy;
+                const row = matrix[rows[r]];
+                for (let c = c0; c < c1; c++) {{
+                    const x = labelW + c * cellW - sx;
+                    const val = row[c];
+                    const {{ bg, fg }} = getDmColor(val, t);
+                    ctx.fillStyle = bg;
+                    ctx.fillRect(x, y, cellW, DM_CELL_H);
+                    ctx.strokeRect(x + 0.5, y + 0.5, cellW, DM_CELL_H);
+                    ctx.fillStyle = fg;
+                    ctx.fillText(String(val), x + cellW / 2, y + DM_CELL_H / 2);
+                }}
+            }}
+            if (rows.length === 0) {{
+                ctx.fillStyle = '#666';
+                ctx.font = 'italic 13px sans-serif';
+                ctx.fillText('No genomes match the current filters.', w / 2, DM_HEADER_H + DM_CELL_H / 2);
+                ctx.font = DM_FONT;
+            }}
+
+            // Row labels, pinned to the left edge
+            ctx.textAlign = 'left';
+            ctx.fillStyle = '#f8f8f8';
+            ctx.fillRect(0, DM_HEADER_H, labelW, h - DM_HEADER_H);
+            for (let r = r0; r < r1; r++) {{
+                const y = DM_HEADER_H + r * DM_CELL_H - sy;
+                ctx.strokeRect(0.5, y + 0.5, labelW, DM_CELL_H);
+                ctx.fillStyle = '#333';
+                ctx.save();
+                ctx.beginPath();
+                ctx.rect(0, y, labelW - 4, DM_CELL_H);
+                ctx.clip();
+                ctx.fillText(labels[rows[r]], 8, y + DM_CELL_H / 2);
+                ctx.restore();
+            }}
+
+            // Column labels, pinned to the top edge
+            ctx.fillStyle = '#f8f8f8';
+            ctx.fillRect(labelW, 0, w - labelW, DM_HEADER_H);
+            for (let c = c0; c < c1; c++) {{
+                const x = labelW + c * cellW - sx;
+                ctx.strokeRect(x + 0.5, 0.5, cellW, DM_HEADER_H);
+                ctx.save();
+                ctx.beginPath();
+                ctx.rect(Math.max(x, labelW), 0, cellW, DM_HEADER_H - 2);
+                ctx.clip();
+                ctx.translate(x + cellW / 2, DM_HEADER_H - 6);
+                ctx.rotate(-Math.PI / 2);
+                ctx.fillStyle = '#333';
+                ctx.fillText(labels[c], 0, 0);
+                ctx.restore();
+            }}
+            ctx.fillStyle = '#fff';
+            ctx.fillRect(0, 0, labelW, DM_HEADER_H);
+            ctx.strokeRect(0.5, 0.5, labelW, DM_HEADER_H);
+        }}
+
+        function onDistTableHover(event) {{
+            if (!_dm) return;
+            const canvas  = document.getElementById('dmCanvas');
+            const wrapper = document.getElementById('dmTableWrapper');
+            const rect = canvas.getBoundingClientRect();
+            const x = event.clientX - rect.left, y = event.clientY - rect.top;
+            const c = Math.floor((x - _dm.labelW + wrapper.scrollLeft) / _dm.cellW);
+            const r = Math.floor((y - DM_HEADER_H + wrapper.scrollTop) / DM_CELL_H);
+            if (x < _dm.labelW || y < DM_HEADER_H || c >= _dm.labels.length || r >= _dm.rows.length) {{
+                canvas.title = '';
+                return;
+            }}
+            const i = _dm.rows[r];
+            canvas.title = _dm.labels[i] + ' vs ' + _dm.labels[c] + ': ' + _dm.matrix[i][c] + ' SNP differences';
+        }}
+
         // ===== Tree viewer =====
         function updateSVG() {{
             const data_input = document.getElementById('treeSNPSelector').value;
@@ -1129,23 +1857,87 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
                 "3": "SNPs_in_majority{majority_threshold}"
             }};
             const tree_type = fp_map[data_input] || "SNPs_all";
-            const svgPath = `report_supporting_documents/tree.${{tree_type}}.${{method}}.tre.svg`;
-            fetch(svgPath)
-                .then(response => {{
-                    if (!response.ok) throw new Error('SVG not found');
-                    return response.text();
-                }})
-                .then(svgContent => {{
-                    document.getElementById('svgContainer').innerHTML = svgContent;
-                }})
+            const treeFile = `tree.${{tree_type}}.${{method}}.tre`;
+            const container = document.getElementById('svgContainer');
+            container.dataset.tree = treeFile;
+            const info = treeImages[treeFile] || {{}};
+            // Big trees show the label-free light image first; the full one loads on request
+            const first = info.light ? fetchTreeSVG(treeFile, 'light') : fetchTreeSVG(treeFile, 'full');
+            first
+                .then(svgContent => showTreeSVG(treeFile, svgContent, !!info.light))
                 .catch(() => {{
-                    document.getElementById('svgContainer').innerHTML =
+                    if (container.dataset.tree !== treeFile) return;
+                    container.innerHTML =
                         '<p style="color:#555;">Tree not available for this combination. ' +
                         'Ensure the <code>report_supporting_documents</code> directory is in ' +
                         'the same folder as this report file.</p>';
                 }});
         }}
 
+        // Fetched tree images, keyed by file and variant; holds promises so concurrent requests share one fetch
+        const treeSVGCache = {{}};
+
+        function fetchText(path) {{
+            return fetch(path).then(response => {{
+                if (!response.ok) throw new Error('SVG not found');
+                return response.text();
+            }});
+        }}
+
+        function fetchTreeSVG(treeFile, variant) {{
+            const cacheKey = treeFile + ':' + variant;
+            if (!treeSVGCache[cacheKey]) {{
+                const svgPath = `report_supporting_documents/${{treeFile}}.svg`;
+                let request;
+                if (variant === 'light') {{
+                    request = fetchText(`report_supporting_documents/${{treeFile}}.light.svg`);
+                }} else if ((treeImages[treeFile] || {{}}).light && typeof DecompressionStream !== 'undefined') {{
+                    // The gzip copy is a fraction of the size; fall back to the plain image if it cannot be read
+                    request = fetch(svgPath + '.gz')
+                        .then(response => {{
+                            if (!response.ok) throw new Error('SVG not found');
+                            return new Response(response.body.pipeThrough(new DecompressionStream('gzip'))).text();
+                        }})
+                        .catch(() => fetchText(svgPath));
+                }} else {{
+                    request = fetchText(svgPath);
+                }}
+                treeSVGCache[cacheKey] = request;
+                request.catch(() => {{ delete treeSVGCache[cacheKey]; }});
+            }}
+            return treeSVGCache[cacheKey];
+        }}
+
+        function showTreeSVG(treeFile, svgContent, light) {{
+            const container = document.getElementById('svgContainer');
+            // Ignore a slow response for a tree that is no longer selected
+            if (container.dataset.tree !== treeFile) return;
+            container.innerHTML = '';
+            if (light) {{
+                const note = document.createElement('p');
+                note.style.color = '#555';
+                note.textContent = 'Showing a simplified view of this ' + treeImages[treeFile].leaves +
+                    '-genome tree without labels. ';
+                const button = document.createElement('button');
+                button.textContent = 'Load full detail';
+                button.onclick = () => {{
+                    button.disabled = true;
+                    button.textContent = 'Loading...';
+                    fetchTreeSVG(treeFile, 'full')
+                        .then(fullContent => showTreeSVG(treeFile, fullContent, false))
+                        .catch(() => {{
+                            button.disabled = false;
+                            button.textContent = 'Full image not available; retry';
+                        }});
+                }};
+                note.appendChild(button);
+                container.appendChild(note);
+            }}
+            const image = document.createElement('div');
+            image.innerHTML = svgContent;
+            container.appendChild(image);
+        }}
+
         // ===== Excel export for Distance Matrix Table =====
         function colorToRgb(color) {{
             if (color === 'white') return 'FFFFFF';
@@ -1224,19 +2016,10 @@ def interactive_threshold_heatmap(service_config, metadata_json, majority_thresh
         updateSVG();
     </script>
     """.format(
-    all_ids_rep=all_ids_rep,
-    all_mat_rep=all_mat_rep,
-    core_ids_rep=core_ids_rep,
-    core_mat_rep=core_mat_rep,
-    majority_ids_rep=majority_ids_rep,
-    majority_mat_rep=majority_mat_rep,
-    all_ids_mat=all_ids_mat,
-    all_mat_mat=all_mat_mat,
-    core_ids_mat=core_ids_mat,
-    core_mat_mat=core_mat_mat,
-    majority_ids_mat=majority_ids_mat,
-    majority_mat_mat=majority_mat_mat,
+    distance_views=json.dumps(distance_views),
+    distance_payloads=json.dumps(distance_payloads),
     metadata_json_string=metadata_json_string,
+    tree_images=json.dumps(tree_images),
     majority_threshold=majority_threshold,
     )
     return heatmap_template, metadata_json_string
@@ -1246,22 +2029,13 @@ def edit_newick_genome_id(raw_nwk, clean_nwk):
     """Reverts genome ids in kSNP4 formatted Newick files to match genome ids for phyloxml"""
     click.echo("Reverting genome IDs {}".format(raw_nwk))
     if os.path.isfile(raw_nwk) == True and os.path.getsize(raw_nwk) > 0:
-        # Using bio phylo package to ensure accuracy as some files have extra details
-        fix_labels_with_phylo(raw_nwk, clean_nwk)
+        rewrite_newick_labels(raw_nwk, clean_nwk)
         return clean_nwk
     else:
         msg = "{} is either empty or not found... cannot edit genome ids for phyloxml".format(raw_nwk)
         sys.stderr.write(msg)
 
 
-def fix_labels_with_phylo(raw_nwk, clean_nwk):
-    tree = Phylo.read(raw_nwk, "newick")
-    for clade in tree.find_clades():
-        if clade.name:
-            clade.name = clade.name.replace("_", ".")
-    Phylo.write(tree, clean_nwk, "newick")
-
-
 def generate_table_html_2(kchooser_df, table_width='75%'):
     # Generate table headers
     headers = ''.join(f'<th>{header}</th>' for header in kchooser_df.columns)
@@ -1311,6 +2085,67 @@ def infer_output_subtype(filename):
         return "All_SNPs"
 
 
+def iter_newick_pieces(nwk_path, chunk_size=FASTA_CHUNK_SIZE):
+    """Stream a Newick file as (bytes, role) pieces, role being "label", "token" or "other", that concatenate back to the file."""
+    in_quote = in_comment = in_length = False
+    with open(nwk_path, "rb") as src:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            for piece in NEWICK_TOKENS.split(chunk):
+                if not piece:
+                    continue
+                role = "other"
+                if in_comment:
+                    in_comment = piece != b"]"
+                elif in_quote:
+                    # A doubled '' inside a quoted label closes and reopens the quote
+                    if piece == b"'":
+                        in_quote = False
+                    else:
+                        role = "label"
+                elif piece == b"[":
+                    in_comment = True
+                elif piece == b"'":
+                    in_quote = True
+                elif piece in (b"(", b")", b",", b":", b";"):
+                    in_length = piece == b":"
+                    role = "token"
+                elif not in_length:
+                    role = "label"
+                yield piece, role
+
+
+def kchooser_cache_key(sequence_hashes):
+    """Content address of a Kchooser4 run: the sorted per-genome sequence hashes, so names and order do not matter."""
+    digest = hashlib.sha256()
+    for sequence_hash in sorted(sequence_hashes):
+        digest.update(sequence_hash.encode() + b"\n")
+    return digest.hexdigest()
+
+
+def kchooser_cache_settings(data):
+    """Kchooser cache directory and size bound from the service config; the directory is None when caching is off."""
+    return data.get("kchooser_cache_dir"), int(data.get("kchooser_cache_max_bytes", KCHOOSER_CACHE_MAX_BYTES))
+
+
+def kchooser_genome_hashes(stats_df, kchooser_input):
+    """Sequence hash of each genome name in a Kchooser4 input file, from the normalize-fastas stats."""
+    hashes = dict(zip(stats_df["genome"], stats_df["sequence_sha256"]))
+    with open(kchooser_input) as f:
+        rows = [line.rstrip("\r\n").split("\t") for line in f if line.strip()]
+    return {row[1]: hashes[os.path.basename(row[0])] for row in rows
+            if len(row) > 1 and os.path.basename(row[0]) in hashes}
+
+
+def kchooser_report_template(report_text, genome_hashes):
+    """A Kchooser4 report with every genome name replaced by a placeholder holding its sequence hash."""
+    if not genome_hashes:
+        return report_text
+    # Longest names first, and whole names only, so g_1 never matches inside g_10
+    names = sorted(genome_hashes, key=len, reverse=True)
+    pattern = re.compile(r"(?<![A-Za-z0-9_-])(?:{})(?![A-Za-z0-9_-])".format("|".join(map(re.escape, names))))
+    return pattern.sub(lambda match: "<genome:{}>".format(genome_hashes[match.group()]), report_text)
+
+
 def ksnp4_filename_format(filename):
     # Update the filename according to kSNP4.1 rules.
     # Files coming from the api do not end in fasta. If it does not end in .fasta add extension
@@ -1329,6 +2164,32 @@ def ksnp4_filename_format(filename):
     return "{}{}".format(name, ext)
 
 
+def load_distance_table(source_path, kind, cache_dir):
+    """Genome IDs and float32 distance matrix for a kSNPdist report or matrix file, parsed only on a cache miss."""
+    npy_path, ids_path = distance_cache_paths(source_path, cache_dir)
+    stat = os.stat(source_path)
+    try:
+        with open(ids_path) as f:
+            sidecar = json.load(f)
+        if sidecar["size"] == stat.st_size and sidecar["mtime_ns"] == stat.st_mtime_ns:
+            return sidecar["genome_ids"], np.load(sidecar["array"], mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        pass
+    if kind == "report":
+        genome_ids, matrix = read_ksnp_distance_report(source_path)
+    else:
+        genome_ids, matrix = read_ksnp_distance_matrix(source_path)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    cache_distance_table(source_path, genome_ids, matrix, cache_dir)
+    return genome_ids, matrix
+
+
+def load_distance_view(path, kind, cache_dir):
+    """Genome IDs and float64 distances for a heatmap view, rounded to 4 decimal places for readability."""
+    genome_ids, matrix = load_distance_table(path, kind, cache_dir)
+    return genome_ids, np.round(np.asarray(matrix, dtype=np.float64), 4)
+
+
 def make_genome_bar_chart(data, report_data, majority_threshold):
     if "COUNT_coreSNPs" not in report_data or "COUNT_SNPs" not in report_data:
         msg = "SNP count files not found; skipping SNP distribution chart.\n"
@@ -1369,109 +2230,172 @@ def make_genome_bar_chart(data, report_data, majority_threshold):
     return snp_distribution
 
 
-def organize_files_by_type(work_dir, destination_dir):
+def normalize_fasta(fasta_path, index_path, line_width=NORMALIZED_LINE_WIDTH):
+    """Validate one staged genome and normalize its layout if needed; returns its stats."""
+    stats = {
+        "genome": os.path.basename(fasta_path),
+        "length": 0,
+        "contigs": 0,
+        "n_fraction": 0.0,
+        "sequence_sha256": "",
+        "status": "ok",
+        "reason": "",
+    }
+    contigs = []
+    current = None
+    invalid = set()
+    headerless = False
+    n_count = 0
+    needs_rewrite = False
+    offset = 0
+    sequence_hash = hashlib.sha256()
+    hashed_contigs = 0
+    with open(fasta_path, "rb") as f:
+        for line in f:
+            line_offset = offset
+            offset += len(line)
+            stripped = line.rstrip(b"\r\n")
+            if line.endswith(b"\r\n") or b"\r" in stripped:
+                needs_rewrite = True
+            if stripped.startswith(b">"):
+                fields = stripped[1:].decode(errors="replace").split()
+                current = {"row": [fields[0] if fields else "", 0, offset, 0, 0], "short_line": False}
+                contigs.append(current)
+                continue
+            if b" " in stripped or b"\t" in stripped:
+                needs_rewrite = True
+                stripped = stripped.replace(b" ", b"").replace(b"\t", b"")
+            if not stripped:
+                needs_rewrite = True
+                continue
+            if current is None:
+                headerless = True
+                continue
+            bad = stripped.translate(None, NUCLEOTIDE_CODES)
+            if bad:
+                invalid.update(chr(c) for c in set(bad))
+            n_count += stripped.count(b"N") + stripped.count(b"n")
+            row = current["row"]
+            if row[1] == 0:
+                if hashed_contigs:
+                    sequence_hash.update(b">")
+                hashed_contigs += 1
+                row[3], row[4] = len(stripped), offset - line_offset
+            elif current["short_line"] or len(stripped) > row[3]:
+                # Only the last line of a record may be shorter than the first
+                needs_rewrite = True
+            if len(stripped) < row[3]:
+                current["short_line"] = True
+            row[1] += len(stripped)
+            sequence_hash.update(stripped.upper())
+
+    rows = [contig["row"] for contig in contigs if contig["row"][1] > 0]
+    if len(rows) != len(contigs):
+        needs_rewrite = True
+    stats["length"] = sum(row[1] for row in rows)
+    stats["contigs"] = len(rows)
+    stats["n_fraction"] = round(n_count / stats["length"], 6) if stats["length"] else 0.0
+    reasons = []
+    if headerless:
+        reasons.append("sequence before the first header")
+    if invalid:
+        reasons.append("non-nucleotide characters: {}".format(" ".join(sorted(repr(c) for c in invalid))))
+    if reasons:
+        stats["status"] = "rejected"
+        stats["reason"] = "; ".join(reasons)
+        return stats
+    if stats["length"] == 0:
+        stats["status"] = "rejected"
+        stats["reason"] = "no sequence"
+        return stats
+    stats["sequence_sha256"] = sequence_hash.hexdigest()
+    if needs_rewrite:
+        rows = rewrite_fasta(fasta_path, line_width)
+        stats["status"] = "normalized"
+    with open(index_path, "w") as f:
+        f.writelines("\t".join(str(field) for field in row) + "\n" for row in rows)
+    return stats
+
+
+def organize_files_by_type(work_dir, destination_dir, workers=8):
+    """Place kSNP4 outputs from the work directory into the output folder layout."""
     if not os.path.exists(work_dir):
         sys.stderr.write("Work directory, {}, does not exist".format(work_dir))
         return
-    for filename in os.listdir(work_dir):
-        file_path = os.path.join(work_dir, filename)
-        intermediate_dir = os.path.join(destination_dir, "Intermediate_Files")
-        os.makedirs(intermediate_dir, exist_ok=True)
-        firstword = filename.split("_")[0]
+    start = time.time()
+    folders = {os.path.join(destination_dir, "Intermediate_Files")}
+    placements = []
+    with os.scandir(work_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            for pattern, folder, only, exclude, renames, nonempty in OUTPUT_ROUTES:
+                if not pattern.search(entry.name):
+                    continue
+                subtype = infer_output_subtype(entry.name)
+                if "{subtype}" in folder and subtype is None:
+                    sys.stderr.write("Cannot tell the SNP subset of {}; not organizing it\n".format(entry.name))
+                    continue
+                folder = os.path.join(destination_dir, folder.format(subtype=subtype))
+                folders.add(folder)
+                if (only and not only.search(entry.name)) or (exclude and exclude.search(entry.name)):
+                    continue
+                if nonempty and entry.stat().st_size == 0:
+                    continue
+                name = entry.name
+                for rename, suffix in renames:
+                    if rename.search(name):
+                        name += suffix
+                        break
+                placements.append((entry.path, os.path.join(folder, name)))
+    # Trees get their own table — only tree.* files, skip tree_* (AlleleCounts, tipAlleleCounts, etc.)
+    clean_tree_dir = os.path.join(work_dir, "clean_trees")
+    # Incremental runs reuse kSNP4's loci and build no trees
+    if os.path.isdir(clean_tree_dir):
+        with os.scandir(clean_tree_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith("tree."):
+                    continue
+                subtype = infer_output_subtype(entry.name) or "All_SNPs"
+                for pattern, folder in TREE_ROUTES:
+                    if pattern.search(entry.name):
+                        folder = os.path.join(destination_dir, folder.format(subtype=subtype))
+                        folders.add(folder)
+                        placements.append((entry.path, os.path.join(folder, entry.name)))
+                        break
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lambda placement: place_output_file(*placement), placements))
+    sys.stderr.write("Organized {} files into {} folders in {:.2f}s\n".format(len(placements), len(folders), time.time() - start))
+
+
+def output_manifest_entry(output_dir, path):
+    """Manifest record for one output file: relative path, SNP subset, workspace type, size and sha256."""
+    relative_path = os.path.relpath(path, output_dir)
+    suffix = os.path.basename(path).rpartition(".")[2] if "." in os.path.basename(path) else ""
+    return {
+        "path": relative_path,
+        "subset": OUTPUT_SUBSETS.get(relative_path.split(os.sep)[0]),
+        "type": OUTPUT_WORKSPACE_TYPES.get(suffix, "unspecified"),
+        "size": os.path.getsize(path),
+        "sha256": sha256_file(path),
+    }
 
-        # Skip directories
-        if not os.path.isfile(file_path):
-            continue
-        
-        # Sort files into directories according to the first word
-        if firstword == "All" or filename.startswith("SNPs_all") or filename == "all_snp_distance_heatmap.html":
-            All_SNPs_dir = os.path.join(destination_dir, "All_SNPs")
-            os.makedirs(All_SNPs_dir, exist_ok=True)
-            # Add extensions to SNPs_all and SNPs_all_matrix for the website
-            if filename == "SNPs_all":
-                new_path = os.path.join(All_SNPs_dir, (filename + ".tsv"))
-                shutil.copy(file_path, new_path)
-            elif filename == "SNPs_all_matrix":
-                new_path = os.path.join(All_SNPs_dir, (filename + ".txt"))
-                shutil.copy(file_path, new_path)
-            # else copy all files to the all SNPs dir
-            else:
-                shutil.copy(file_path, All_SNPs_dir)
-        if firstword == "annotate" and os.path.getsize(file_path) > 0:
-            shutil.copy(file_path, intermediate_dir)
-        if firstword == "ClusterInfo.SNPs" or firstword == "ClusterInfo.core":
-            group = infer_output_subtype(filename)
-            cluster_dir = os.path.join(destination_dir, group, "Cluster_Information")
-            os.makedirs(cluster_dir, exist_ok=True)
-            shutil.copy(file_path, cluster_dir)
-        if firstword == "core" or firstword == "nonCore" or filename == "core_snp_distance_heatmap.html":
-            core_snp_dir = os.path.join(destination_dir, "Core_SNPs")
-            os.makedirs(core_snp_dir, exist_ok=True)
-            # Add extensions to core_SNPs and core_SNPs_matrix for the website
-            if filename == "core_SNPs":
-                new_path = os.path.join(core_snp_dir, (filename + ".tsv"))
-                shutil.copy(file_path, new_path)
-            elif filename == "core_SNPs_matrix":
-                new_path = os.path.join(core_snp_dir, (filename + ".txt"))
-                shutil.copy(file_path, new_path)
-            elif filename.startswith("core_kSNPdist"):
-                # shutil.copy(file_path, work_dir)
-                pass
-            # else copy all files to the core SNPs dir
-            else:
-                shutil.copy(file_path, core_snp_dir)
-        if firstword == "COUNT" or firstword == "tip" or firstword == "Node" or firstword == "NJ.dist.matrix":
-            intermediate_dir = os.path.join(destination_dir, "Intermediate_Files")
-            os.makedirs(intermediate_dir, exist_ok=True)
-            shutil.copy(file_path, intermediate_dir)
-        if firstword == "Homoplasy":
-            group = infer_output_subtype(filename)
-            homoplasy_dir = os.path.join(destination_dir, group, "Homoplasy")
-            os.makedirs(homoplasy_dir, exist_ok=True)
-            shutil.copy(file_path, homoplasy_dir)
-        if "SNPs_in_majority" in filename and "matrix" in filename:
-            group = infer_output_subtype(filename)
-            majority_dir = os.path.join(destination_dir, group)
-            os.makedirs(majority_dir, exist_ok=True)
-            if len(filename) == 26:
-                new_path = os.path.join(majority_dir, (filename + ".txt"))
-                shutil.copy(file_path, new_path)
-            else:
-                shutil.copy(file_path, majority_dir)
-        # Capture specifically SNPs_in_majority0.5 where 5 could be any integer 0-9
-        if filename.startswith("SNPs_in_majority0.") or filename == "majority_snp_distance_heatmap.html":
-            group = infer_output_subtype(filename)
-            majority_dir = os.path.join(destination_dir, group)
-            os.makedirs(majority_dir, exist_ok=True)
-            # shutil.copy(file_path, majority_dir)
-            if filename.startswith("SNPs_in_majority") and len(filename) == 19:
-                new_path = os.path.join(majority_dir, (filename + ".tsv"))
-                shutil.copy(file_path, new_path)
-            # elif "SNPs_in_majority" in filename and len(filename) == 26:
-            #     new_path = os.path.join(majority_dir, (filename + ".txt"))
-            #     shutil.copy(file_path, new_path)
-        if firstword.startswith("VCF"):
-            VCFs_dir = os.path.join(destination_dir, "VCFs")
-            os.makedirs(VCFs_dir, exist_ok=True)
-            shutil.copy(file_path, VCFs_dir)
-    # Trees get their own loop — only process tree.* files, skip tree_* (AlleleCounts, tipAlleleCounts, etc.)
-    clean_tree_dir = os.path.join(work_dir,"clean_trees")
-    for filename in os.listdir(clean_tree_dir):
-        if not filename.startswith("tree."):
-            continue
-        file_path = os.path.join(clean_tree_dir, filename)
-        group = infer_output_subtype(filename)
-        if group == "All_SNPs" or group == "Core_SNPs" or group == "Majority_SNPs":
-            tree_dir = os.path.join(destination_dir, group, "Trees")
-        else:
-            tree_dir = os.path.join(destination_dir, "All_SNPs", "Trees")
-        os.makedirs(tree_dir, exist_ok=True)
-        if os.path.splitext(file_path)[-1].lower() == ".tre":
-            newick_dir = os.path.join(tree_dir, "Newick_Files")
-            os.makedirs(newick_dir, exist_ok=True)
-            shutil.copy(file_path, newick_dir)
-        else:
-            shutil.copy(file_path, tree_dir)
+
+def pack_snp_alignment(codes):
+    """Bit-pack an encoded SNP alignment into validity and two base bit-planes of uint64 words."""
+    valid = codes > 0
+    base = np.where(valid, codes - 1, 0).astype(np.uint8)
+    planes = []
+    for plane in (valid, base & 2, base & 1):
+        packed = np.packbits(plane.astype(bool), axis=1)
+        # Pad each row to whole 64-bit words so popcounts run on uint64
+        pad = (-packed.shape[1]) % 8
+        if pad:
+            packed = np.pad(packed, ((0, 0), (0, pad)))
+        planes.append(np.ascontiguousarray(packed).view(np.uint64))
+    return tuple(planes)
 
 
 def parse_core_snps(file_path, filename):
@@ -1491,6 +2415,7 @@ def parse_core_snps(file_path, filename):
             }
             add_to_report_dict(filename, count_data)
 
+
 def parse_intermediate_files(report_data, work_dir):
     for filename in os.listdir(work_dir):
         file_path = os.path.join(work_dir, filename)
@@ -1506,10 +2431,13 @@ def parse_intermediate_files(report_data, work_dir):
     return report_data
 
 
-def parse_kchooser_report(report_data, kchooser_report):
+def parse_kchooser_report(report_data, kchooser_report, kchooser_sample=None, incremental_update=None):
     kchooser_data = {}
-    with open(kchooser_report, "r") as file:
-        text = file.read()
+    text = ""
+    # Incremental runs reuse k and have no Kchooser4 report of their own
+    if os.path.exists(kchooser_report):
+        with open(kchooser_report, "r") as file:
+            text = file.read()
     # Extract number of genomes
     match = re.search(r'There were (\d+) genomes', text)
     if match:
@@ -1528,6 +2456,14 @@ def parse_kchooser_report(report_data, kchooser_report):
     if match:
         kchooser_data["Shortest Genome"] = match.group(1).replace("_", ".")
         kchooser_data["Shortest Genome Length"] = int(match.group(2))
+    # A sampled run only saw part of the input; report the full count and the sample
+    if kchooser_sample is not None:
+        kchooser_data["Total Genomes"] = kchooser_sample["total_genomes"]
+        kchooser_data["Kchooser Sample"] = "{} genomes, stratified by length".format(kchooser_sample["sample_size"])
+    if incremental_update is not None:
+        kchooser_data["Total Genomes"] = incremental_update["previous_genomes"] + len(incremental_update["added_genomes"])
+        kchooser_data["Incremental Update"] = "{} genomes added to a previous run (k = {} reused)".format(
+            len(incremental_update["added_genomes"]), incremental_update["k"])
     # return kchooser_data
     report_data = add_to_report_dict(report_data, "kchooser_report", kchooser_data)
     return report_data
@@ -1557,38 +2493,262 @@ def parse_optimum_k(kchooser_report):
                 print(match.group(1))
                 return
     print("Optimum value of k not found")
-  
+
+
+def place_output_file(source_path, destination_path):
+    """Hardlink a work file into the output folder, copying when they are on different filesystems."""
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copy(source_path, destination_path)
+
+
+def popcount(words):
+    """Number of set bits in each element of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # NumPy < 2.0 has no popcount ufunc; count the bytes through a lookup table
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+
+def prune_kchooser_cache(cache_dir, max_bytes):
+    """Evict least recently used Kchooser cache entries until the cache fits in max_bytes."""
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if key.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        # Another job may evict or replace an entry while it is being measured
+        try:
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        except FileNotFoundError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        sys.stderr.write("Evicted Kchooser cache entry {}\n".format(os.path.basename(entry_dir)))
+
+
+def prune_tree_svg_cache(cache_dir, max_bytes):
+    """Evict least recently used tree images (all variants of a tree together) until the cache fits in max_bytes."""
+    entries = {}
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith(".") or entry.name.endswith(".tmp") or not entry.is_file():
+            continue
+        # Another job may evict or replace an image while it is being measured
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        digest = entry.name.split(".", 1)[0]
+        mtime, size, paths = entries.get(digest, (0, 0, []))
+        entries[digest] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry.path])
+    total = sum(size for _, size, _ in entries.values())
+    for digest, (_, size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total <= max_bytes:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        sys.stderr.write("Evicted cached tree image {}\n".format(digest))
+
+
+def read_fasta_index(index_path):
+    """[(contig, length), ...] from a .fai-style index."""
+    contigs = []
+    with open(index_path) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                contigs.append((fields[0], int(fields[1])))
+    return contigs
+
+
+def read_genome_stats(work_dir):
+    """Per-genome stats from normalize-fastas for the genomes that passed validation."""
+    stats_df = pd.read_csv(os.path.join(work_dir, GENOME_STATS_FILENAME), sep="\t", keep_default_na=False)
+    return stats_df[stats_df["status"] != "rejected"].reset_index(drop=True)
+
+
+def read_ksnp4_input_genomes(ksnp4_input_file):
+    """FASTA file names listed in a kSNP4 input file (path<TAB>genome name per line)."""
+    with open(ksnp4_input_file) as f:
+        return [os.path.basename(line.split("\t")[0]) for line in f if line.strip()]
+
 
 def read_ksnp_distance_matrix(ksnp_dist_matrix):
     df = pd.read_csv(ksnp_dist_matrix, sep='\t', header=0, index_col=None)
-    genome_ids_raw = list(df.columns)
-    df.index = genome_ids_raw
-    # Round to 4 decimal places for readability
-    matrix = [[round(v, 4) for v in row] for row in df.values.tolist()]
+    # Matrices already processed by fix_ksnp_matrix_genome_ids carry a genome_id row label column
+    if df.columns[0] == "genome_id":
+        df = df.set_index("genome_id")
+    genome_ids_raw = [str(gid) for gid in df.columns]
     genome_ids = [gid.replace("_", ".") for gid in genome_ids_raw]
+    matrix = df.to_numpy(dtype=np.float32)
     return genome_ids, matrix
 
 
 def read_ksnp_distance_report(ksnp_dist_report):
-    df = pd.read_csv(ksnp_dist_report, sep='\t', header=None)
-    df.columns = ["value", "genome1", "genome2"]
-    pivot_df = df.pivot(index="genome1", columns="genome2", values="value")
-    # Ensure it's symmetric by filling missing cells
-    pivot_df = pivot_df.combine_first(pivot_df.T)
+    """Read a long-format kSNPdist pair report into sorted genome IDs and a symmetric matrix."""
+    genome_index = {}
+    rows = array("i")
+    cols = array("i")
+    values = array("f")
+    with open(ksnp_dist_report) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            # Skip blank lines and the header added by process_ksnp_report
+            if len(fields) < 3 or fields[0] == "distance":
+                continue
+            rows.append(genome_index.setdefault(fields[1], len(genome_index)))
+            cols.append(genome_index.setdefault(fields[2], len(genome_index)))
+            values.append(float(fields[0]))
 
     # Ensure genomes are in same order for rows/columns
-    genomes = sorted(set(pivot_df.index) | set(pivot_df.columns))
-    pivot_df = pivot_df.reindex(index=genomes, columns=genomes)
+    genomes = sorted(genome_index)
+    position = np.empty(len(genomes), dtype=np.intp)
+    position[[genome_index[g] for g in genomes]] = np.arange(len(genomes))
+    rows = position[np.frombuffer(rows, dtype=np.int32)]
+    cols = position[np.frombuffer(cols, dtype=np.int32)]
+    values = np.frombuffer(values, dtype=np.float32)
+
+    # Missing cells (including the diagonal) stay 0; mirror first so a pair's own entry wins
+    snpMatrix = np.zeros((len(genomes), len(genomes)), dtype=np.float32)
+    snpMatrix[cols, rows] = values
+    snpMatrix[rows, cols] = values
+
+    # replace _ with . to match metadata IDs
+    genome_ids = [gid.replace("_", ".") for gid in genomes]
+    return genome_ids, snpMatrix
 
-    # Fill diagonals or missing cells as needed
-    pivot_df = pivot_df.fillna(0)    
-    pivot_df.index = pivot_df.index.astype(str)
-    pivot_df.columns = pivot_df.columns.astype(str)
 
-    # give the data as lists of lists, replacing _ with . to match metadata IDs
-    genome_ids = [gid.replace("_", ".") for gid in pivot_df.columns.tolist()]
-    snpMatrix = pivot_df.values.tolist()
-    return genome_ids, snpMatrix
+def read_snp_alignment(fasta_path):
+    """Read a kSNP4 SNP matrix FASTA into genome IDs and an (N genomes x L loci) uint8 code array."""
+    with open(fasta_path, "rb") as f:
+        content = f.read()
+    genome_ids = []
+    rows = []
+    for record in content.split(b">")[1:]:
+        header, _, seq = record.partition(b"\n")
+        genome_ids.append(header.strip().decode())
+        seq = seq.replace(b"\n", b"").replace(b"\r", b"")
+        rows.append(SNP_BASE_CODES[np.frombuffer(seq, dtype=np.uint8)])
+    lengths = {len(row) for row in rows}
+    if len(lengths) > 1:
+        raise ValueError("{} is not aligned; found sequence lengths {}".format(fasta_path, sorted(lengths)))
+    codes = np.vstack(rows) if rows else np.zeros((0, 0), dtype=np.uint8)
+    return genome_ids, codes
+
+
+def read_snps_all(snps_all_path):
+    """Read a kSNP4 SNPs_all table into (locus number, lines) in locus order, and whether loci were separated by blank lines."""
+    loci = {}
+    blank_separated = False
+    with open(snps_all_path) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 5 or not fields[0].strip().isdigit():
+                blank_separated = blank_separated or not line.strip()
+                continue
+            loci.setdefault(int(fields[0]), []).append(fields)
+    return sorted(loci.items()), blank_separated
+
+
+def refresh_distance_cache(source_path, cache_dir, previous_stat):
+    """Re-key the cache entry of a file rewritten without changing its distances, if the entry matched the old file."""
+    _, ids_path = distance_cache_paths(source_path, cache_dir)
+    try:
+        with open(ids_path) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return
+    if sidecar.get("size") == previous_stat.st_size and sidecar.get("mtime_ns") == previous_stat.st_mtime_ns:
+        cache_distance_table(source_path, sidecar["genome_ids"], None, cache_dir, array_path=sidecar["array"])
+
+
+def rejected_genomes_html(work_dir):
+    """Report table of the input genomes normalize-fastas excluded and why; empty when none were."""
+    stats_path = os.path.join(work_dir, GENOME_STATS_FILENAME)
+    if not os.path.exists(stats_path):
+        return ""
+    stats_df = pd.read_csv(stats_path, sep="\t", keep_default_na=False)
+    rejected = stats_df[stats_df["status"] == "rejected"]
+    if rejected.empty:
+        return ""
+    # Name each genome by the file the user supplied, not its kSNP4-safe staged name
+    manifest = {}
+    manifest_path = os.path.join(work_dir, FASTA_STAGING_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    table_df = pd.DataFrame({
+        "Input File": [html.escape(os.path.basename(manifest.get(genome, {}).get("source", genome))) for genome in rejected["genome"]],
+        "Reason": [html.escape(reason) for reason in rejected["reason"]],
+    })
+    return '<p class="warning"><strong>{} input genome{} failed validation and {} excluded from the analysis:</strong></p>{}'.format(
+        len(table_df), "" if len(table_df) == 1 else "s", "was" if len(table_df) == 1 else "were",
+        generate_table_html_2(table_df, table_width='75%'))
+
+
+def rewrite_fasta(fasta_path, line_width):
+    """Replace a FASTA with a copy with LF line endings, fixed wrapping and no empty records or whitespace; returns its index rows."""
+    tmp_path = fasta_path + ".normalizing"
+    rows = []
+    offset = 0
+    with open(fasta_path, "rb") as src, open(tmp_path, "wb") as out:
+
+        def write_record(header, sequence):
+            nonlocal offset
+            if header is None or not sequence:
+                return
+            out.write(header + b"\n")
+            offset += len(header) + 1
+            fields = header[1:].decode(errors="replace").split()
+            rows.append([fields[0] if fields else "", len(sequence), offset, min(line_width, len(sequence)),
+                         min(line_width, len(sequence)) + 1])
+            for start in range(0, len(sequence), line_width):
+                out.write(sequence[start:start + line_width] + b"\n")
+            offset += len(sequence) + -(-len(sequence) // line_width)
+
+        header, sequence = None, bytearray()
+        for line in src:
+            stripped = line.rstrip(b"\r\n").replace(b"\r", b"")
+            if stripped.startswith(b">"):
+                write_record(header, sequence)
+                header, sequence = stripped, bytearray()
+            else:
+                sequence += stripped.replace(b" ", b"").replace(b"\t", b"")
+        write_record(header, sequence)
+    # Replace rather than overwrite, so a hardlinked or symlinked raw input is never modified
+    os.replace(tmp_path, fasta_path)
+    return rows
+
+
+def rewrite_newick_labels(raw_nwk, clean_nwk, chunk_size=FASTA_CHUNK_SIZE):
+    """Replace "_" with "." in the node labels of a Newick file, copying everything else byte for byte."""
+    with open(clean_nwk, "wb") as out:
+        for piece, role in iter_newick_pieces(raw_nwk, chunk_size):
+            out.write(piece.replace(b"_", b".") if role == "label" else piece)
+    return clean_nwk
+
+
+def run_in_process_pool(func, jobs, workers):
+    """Call func(*job) for each job on up to workers processes, returning results in job order."""
+    jobs = list(jobs)
+    if workers <= 1 or len(jobs) <= 1:
+        return [func(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = [pool.submit(func, *job) for job in jobs]
+        return [future.result() for future in futures]
 
 
 def run_newick_to_phyloxml(clean_nwk):
@@ -1610,10 +2770,10 @@ def read_plotly_html(plot_path):
     return plotly_graph_content
 
 
-def process_ksnp_report(report_path):
+def process_ksnp_report(report_path, cache_dir):
     """Add column header and replace underscores with dots in genome IDs.
 
-    Produces the format: distance\\tgenome_id_1\\tgenome_id_2 (matching the
+    Produces the format: distance\tgenome_id_1\tgenome_id_2 (matching the
     cgMLST distance report), with genome IDs using dots rather than the
     underscores kSNP4 uses internally.
     """
@@ -1621,35 +2781,345 @@ def process_ksnp_report(report_path):
         return
     with open(report_path, "r") as f:
         first_line = f.readline()
-    has_header = first_line.startswith("distance\t")
-    df = pd.read_csv(report_path, sep="\t", header=0 if has_header else None, dtype=str)
-    if not has_header:
-        df.columns = ["distance", "genome_id_1", "genome_id_2"]
-    df["genome_id_1"] = df["genome_id_1"].str.replace("_", ".", regex=False)
-    df["genome_id_2"] = df["genome_id_2"].str.replace("_", ".", regex=False)
-    df.to_csv(report_path, sep="\t", index=False)
-
-
-def fix_ksnp_matrix_genome_ids(matrix_path):
+    # Already processed — idempotent
+    if first_line.startswith("distance\t"):
+        return
+    previous_stat = os.stat(report_path)
+    tmp_path = report_path + ".tmp"
+    with open(report_path) as src, open(tmp_path, "w") as out:
+        out.write("distance\tgenome_id_1\tgenome_id_2\n")
+        for line in src:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 3:
+                continue
+            fields[1] = fields[1].replace("_", ".")
+            fields[2] = fields[2].replace("_", ".")
+            out.write("\t".join(fields) + "\n")
+    os.replace(tmp_path, report_path)
+    # Same distances, new file: point the rewritten file at the existing cache entry
+    refresh_distance_cache(report_path, cache_dir, previous_stat)
+
+
+def fix_ksnp_matrix_genome_ids(matrix_path, cache_dir):
     """Fix genome IDs in kSNPdist.matrix: replace underscores with dots and add labeled row index."""
     if not os.path.exists(matrix_path) or os.path.getsize(matrix_path) == 0:
         return
-    df = pd.read_csv(matrix_path, sep="\t", header=0, index_col=None)
+    with open(matrix_path, "r") as f:
+        first_line = f.readline()
     # Already labeled — idempotent
-    if df.columns[0] == "genome_id":
+    if first_line.startswith("genome_id\t"):
         return
-    df.columns = [c.replace("_", ".") for c in df.columns]
-    df.index = df.columns.tolist()
-    df.index.name = "genome_id"
-    df.to_csv(matrix_path, sep="\t", index=True)
+    previous_stat = os.stat(matrix_path)
+    genome_ids = [gid.replace("_", ".") for gid in first_line.rstrip("\r\n").split("\t")]
+    tmp_path = matrix_path + ".tmp"
+    # Distance values are copied as kSNPdist wrote them; row i belongs to column i
+    with open(matrix_path) as src, open(tmp_path, "w") as out:
+        src.readline()
+        out.write("genome_id\t" + "\t".join(genome_ids) + "\n")
+        rows = (line.rstrip("\r\n") for line in src if line.strip())
+        for gid, row in zip(genome_ids, rows):
+            out.write(gid + "\t" + row + "\n")
+    os.replace(tmp_path, matrix_path)
+    # Same distances, new file: point the rewritten file at the existing cache entry
+    refresh_distance_cache(matrix_path, cache_dir, previous_stat)
+
+
+def run_p3x_tree_to_svg(file_path, svg_path):
+    """Render a Newick tree with p3x-tree-to-svg and move the image to svg_path; returns an error message or None."""
+    result = subprocess.run(["p3x-tree-to-svg", file_path], capture_output=True, text=True)
+    rendered_path = file_path + ".svg"
+    if result.returncode != 0 or not os.path.isfile(rendered_path):
+        return "p3x-tree-to-svg exited {}: {}".format(result.returncode, result.stderr.strip() or "no svg written")
+    # svg_path may be in a shared cache on another filesystem; other jobs must never see a partial image
+    tmp_path = "{}.{}.tmp".format(svg_path, os.getpid())
+    try:
+        shutil.move(rendered_path, tmp_path)
+        os.replace(tmp_path, svg_path)
+    except OSError as e:
+        for path in (rendered_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return "could not store the image: {}".format(e)
+    return None
+
+
+def scan_genome_snps(fasta_path, context_keys, context_loci, n_loci, k):
+    """Call a genome's alleles at known SNP loci by matching their contexts on both strands."""
+    genome = os.path.splitext(os.path.basename(fasta_path))[0]
+    centre = np.uint64(2 * (k // 2))
+    centre_mask = ~(np.uint64(3) << centre)
+    hit_loci, hit_alleles, hit_kmers, hit_positions, hit_strands = [], [], [], [], []
+
+    def match(kmers, usable, positions, strand):
+        masked = kmers & centre_mask
+        idx = np.minimum(np.searchsorted(context_keys, masked), len(context_keys) - 1)
+        hit = usable & (context_keys[idx] == masked)
+        hit_loci.append(context_loci[idx[hit]])
+        hit_alleles.append(((kmers[hit] >> centre) & np.uint64(3)).astype(np.uint8) + 1)
+        hit_kmers.append(kmers[hit])
+        hit_positions.append(positions[hit])
+        hit_strands.append(np.full(int(hit.sum()), strand == "R"))
+
+    if len(context_keys):
+        with open(fasta_path, "rb") as f:
+            for record in f.read().split(b">")[1:]:
+                _, _, sequence = record.partition(b"\n")
+                codes = KMER_BASE_CODES[np.frombuffer(sequence.replace(b"\n", b"").replace(b"\r", b""), dtype=np.uint8)]
+                if len(codes) < k:
+                    continue
+                # 1-based position of each k-mer's centre base on the forward strand
+                positions = np.arange(len(codes) - k + 1) + k // 2 + 1
+                kmers, usable = encode_kmers(codes, k)
+                match(kmers, usable, positions, "F")
+                reverse, _ = encode_kmers(np.where(codes > 3, codes, 3 - codes)[::-1], k)
+                match(reverse[::-1], usable, positions, "R")
+
+    row = np.zeros(n_loci, dtype=np.uint8)
+    lines = []
+    if hit_loci and sum(len(h) for h in hit_loci):
+        loci = np.concatenate(hit_loci)
+        alleles = np.concatenate(hit_alleles)
+        calls = np.unique(loci.astype(np.int64) * 8 + alleles)
+        called_loci = calls // 8
+        single = np.bincount(called_loci, minlength=n_loci) == 1
+        row[called_loci[single[called_loci]]] = (calls % 8)[single[called_loci]]
+        # One SNPs_all line per called locus, from its first hit
+        keep = single[loci]
+        _, first = np.unique(loci[keep], return_index=True)
+        kmers = np.concatenate(hit_kmers)[keep][first]
+        shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+        contexts = np.frombuffer(b"ACGT", dtype=np.uint8)[((kmers[:, None] >> shifts) & np.uint64(3)).astype(np.intp)]
+        for locus, context, position, reverse in zip(loci[keep][first].tolist(), contexts,
+                                                     np.concatenate(hit_positions)[keep][first].tolist(),
+                                                     np.concatenate(hit_strands)[keep][first].tolist()):
+            lines.append((locus, context.tobytes().decode(), position, "R" if reverse else "F", genome))
+    return row, lines
+
+
+def sha256_file(path):
+    """Hex SHA-256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(FASTA_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def single_linkage(distance_matrix):
+    """SciPy-style linkage matrix for single-linkage clustering of a square distance matrix, via Prim's algorithm."""
+    n = distance_matrix.shape[0]
+    in_tree = np.zeros(n, dtype=bool)
+    in_tree[0] = True
+    best = distance_matrix[0].copy()
+    nearest = np.zeros(n, dtype=np.intp)
+    mst_edges = []
+    for _ in range(n - 1):
+        candidates = np.where(in_tree, np.inf, best)
+        j = int(np.argmin(candidates))
+        mst_edges.append((best[j], nearest[j], j))
+        in_tree[j] = True
+        closer = (distance_matrix[j] < best) & ~in_tree
+        best[closer] = distance_matrix[j][closer]
+        nearest[closer] = j
+
+    # Merge clusters along MST edges in order of increasing distance
+    parent = list(range(2 * n - 1))
+    size = [1] * n + [0] * (n - 1)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    linkage_result = np.empty((n - 1, 4), dtype=np.float64)
+    for k, (dist, a, b) in enumerate(sorted(mst_edges, key=lambda edge: edge[0])):
+        root_a, root_b = sorted((find(a), find(b)))
+        new_cluster = n + k
+        parent[root_a] = parent[root_b] = new_cluster
+        size[new_cluster] = size[root_a] + size[root_b]
+        linkage_result[k] = (root_a, root_b, dist, size[new_cluster])
+    return linkage_result
+
+
+def snp_context_keys(loci, genome_ids, codes, k):
+    """Sorted centre-masked 2-bit context keys for SNP loci, and the matrix column of each key."""
+    row_of = {genome: i for i, genome in enumerate(genome_ids)}
+    complement = str.maketrans("ACGT", "TGCA")
+    contexts = []
+    columns = []
+    for column, (_, lines) in enumerate(loci):
+        context = lines[0][1].upper()
+        row = row_of.get(lines[0][-1])
+        if row is not None and codes[row, column]:
+            allele = "ACGT"[codes[row, column] - 1]
+            if context[k // 2] != allele and context[k // 2].translate(complement) == allele:
+                context = context.translate(complement)[::-1]
+        context = context[:k // 2] + "A" + context[k // 2 + 1:]
+        if len(context) == k and not context.strip("ACGT"):
+            contexts.append(context)
+            columns.append(column)
+    if not contexts:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    context_codes = KMER_BASE_CODES[np.frombuffer("".join(contexts).encode(), dtype=np.uint8)].reshape(len(contexts), k)
+    keys = np.zeros(len(contexts), dtype=np.uint64)
+    for offset in range(k):
+        keys <<= np.uint64(2)
+        keys |= context_codes[:, offset].astype(np.uint64)
+    keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    unique = counts == 1
+    return keys[unique], np.asarray(columns, dtype=np.int64)[first[unique]]
+
+
+def stage_fasta_file(clean_fasta_dir, new_name, filename, original_path, mode="link"):
+    """Place a raw genome in the clean directory under its kSNP4-safe name; returns the staging method used."""
+    clean_path = os.path.join(clean_fasta_dir, new_name)
+    if os.path.lexists(clean_path):
+        sys.stderr.write("{} is already staged; replacing it with {}\n".format(new_name, filename))
+        os.remove(clean_path)
+    method = "copy"
+    if mode == "link":
+        try:
+            os.link(original_path, clean_path)
+            method = "hardlink"
+        except OSError as e:
+            # Only a filesystem that cannot hardlink the file falls back; a missing or unreadable input is an error
+            if e.errno not in HARDLINK_FALLBACK_ERRNOS:
+                raise
+            os.symlink(os.path.abspath(original_path), clean_path)
+            method = "symlink"
+    else:
+        shutil.copy2(original_path, clean_path)
+    if filename != new_name:
+        print("Renaming and staging ({}): {} -> {}".format(method, filename, new_name))
+    else:
+        print("Staging ({}): {}".format(method, filename))
+    return method
+
 
+def store_kchooser_cache_entry(cache_dir, key, report_template, genome_count):
+    """Add a name-free Kchooser4 report template to the cache under key, or refresh the entry if it already exists."""
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        os.utime(entry_dir)
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    optimum_k = None
+    match = re.search(r'The optimum value of k is (\d+)', report_template)
+    if match:
+        optimum_k = int(match.group(1))
+    # Build the entry beside the cache and rename it in, so concurrent jobs never see a partial entry
+    tmp_dir = os.path.join(cache_dir, ".{}.{}".format(key, os.getpid()))
+    os.makedirs(tmp_dir)
+    try:
+        with open(os.path.join(tmp_dir, KCHOOSER_TEMPLATE_FILENAME), "w") as f:
+            f.write(report_template)
+        with open(os.path.join(tmp_dir, "entry.json"), "w") as f:
+            json.dump({"optimum_k": optimum_k, "genomes": genome_count, "created": time.time()}, f, indent=2)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Losing the rename to a concurrent job storing the same key is fine
+        if not os.path.isdir(entry_dir):
+            raise
+    sys.stderr.write("Stored Kchooser result for {} (k = {})\n".format(key, optimum_k))
+
+
+def stratified_kchooser_sample(stats_df, sample_size):
+    """Pick sample_size genomes spread evenly over the length distribution, always including the shortest and median."""
+    ordered = stats_df.sort_values(["length", "genome"])["genome"].tolist()
+    if sample_size >= len(ordered):
+        return ordered
+    median = len(ordered) // 2
+    picks = {0, median}
+    quantiles = [round(i * (len(ordered) - 1) / (sample_size - 1)) for i in range(sample_size)] if sample_size > 1 else []
+    # Fill from the longest quantile down, then from the middle outwards if rounding collided
+    for position in quantiles[::-1] + sorted(range(len(ordered)), key=lambda p: abs(p - median)):
+        if len(picks) >= sample_size:
+            break
+        picks.add(position)
+    return [ordered[position] for position in sorted(picks)]
+
+
+def tree_svg_cache_settings(data):
+    """Tree image cache directory and size bound (None for the per-job cache) from the service config."""
+    shared_dir = data.get("tree_svg_cache_dir")
+    if shared_dir:
+        try:
+            os.makedirs(shared_dir, exist_ok=True)
+            if os.access(shared_dir, os.W_OK | os.X_OK):
+                return shared_dir, int(data.get("tree_svg_cache_max_bytes", TREE_SVG_CACHE_MAX_BYTES))
+            sys.stderr.write("Warning: tree image cache {} is not writable; using the work directory\n".format(shared_dir))
+        except OSError as e:
+            sys.stderr.write("Warning: tree image cache {} is unavailable ({}); using the work directory\n".format(shared_dir, e))
+    cache_dir = os.path.join(data["work_data_dir"], TREE_SVG_CACHE_DIRNAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir, None
+
+
+def upload_output_file(source_path, destination, entry):
+    """Upload one output file to a workspace folder (ws:...) or copy it under a local stand-in directory."""
+    if destination.startswith("ws:"):
+        filename = os.path.basename(entry["path"])
+        command = ["p3-cp", "-f"]
+        if "." in filename:
+            command += ["--map-suffix", "{}={}".format(filename.rpartition(".")[2], entry["type"])]
+        subprocess.run(command + [source_path, "{}/{}".format(destination.rstrip("/"), entry["path"])],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    else:
+        shutil.copyfile(source_path, os.path.join(destination, entry["path"]))
+
+
+def upload_state_path(data, destination):
+    """Where the checksums already uploaded to a destination are recorded."""
+    if data.get("upload_state_dir"):
+        return os.path.join(data["upload_state_dir"], hashlib.sha256(destination.encode()).hexdigest() + ".json")
+    return os.path.join(data["work_data_dir"], OUTPUT_UPLOAD_STATE_FILENAME)
+
+
+def upload_with_retry(source_path, destination, entry, attempts=UPLOAD_ATTEMPTS, backoff=UPLOAD_BACKOFF_SECONDS):
+    """Upload a file, retrying with exponential backoff; returns None on success or the last error."""
+    for attempt in range(attempts):
+        try:
+            upload_output_file(source_path, destination, entry)
+            return None
+        except (OSError, subprocess.CalledProcessError) as e:
+            error = e.stderr.decode(errors="replace").strip() if getattr(e, "stderr", None) else str(e)
+            if attempt + 1 < attempts:
+                sys.stderr.write("Upload of {} failed ({}); retrying in {:.1f}s\n".format(entry["path"], error, backoff * 2 ** attempt))
+                time.sleep(backoff * 2 ** attempt)
+    return error
+
+
+def write_distance_outputs(subset, subdir, genome_ids, diffs, proportions, work_dir, output_dir, cache_dir):
+    """Write a subset's kSNPdist files to the work directory, link them into its output folder and prime the distance cache."""
+    matrix_path = os.path.join(work_dir, "{}_kSNPdist.matrix".format(subset))
+    report_path = os.path.join(work_dir, "{}_kSNPdist.report".format(subset))
+    write_ksnp_distance_files(genome_ids, diffs, proportions, matrix_path, report_path)
+    out_dir = os.path.join(output_dir, subdir)
+    os.makedirs(out_dir, exist_ok=True)
+    out_matrix_path = os.path.join(out_dir, os.path.basename(matrix_path))
+    out_report_path = os.path.join(out_dir, os.path.basename(report_path))
+    place_output_file(matrix_path, out_matrix_path)
+    place_output_file(report_path, out_report_path)
+    # Prime the binary cache so later commands never parse these text files;
+    # the report reader orders genomes by their kSNP4 name
+    dotted_ids = [gid.replace("_", ".") for gid in genome_ids]
+    order = sorted(range(len(genome_ids)), key=genome_ids.__getitem__)
+    report_array = cache_distance_table(report_path, [dotted_ids[i] for i in order], diffs[np.ix_(order, order)], cache_dir)
+    cache_distance_table(out_report_path, [dotted_ids[i] for i in order], None, cache_dir, array_path=report_array)
+    matrix_array = cache_distance_table(matrix_path, dotted_ids, np.round(proportions, 6), cache_dir)
+    cache_distance_table(out_matrix_path, dotted_ids, None, cache_dir, array_path=matrix_array)
+
+
+def write_gzip_copy(source_path, gzip_path):
+    """Write a reproducible gzip copy of a file, replacing gzip_path atomically."""
+    tmp_path = "{}.{}.tmp".format(gzip_path, os.getpid())
+    with open(source_path, "rb") as src, open(tmp_path, "wb") as raw, \
+            gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as out:
+        shutil.copyfileobj(src, out, FASTA_CHUNK_SIZE)
+    os.replace(tmp_path, gzip_path)
 
-def run_p3x_tree_to_svg(file_path, tree_svg_dir):
-        # Run tree to svg command 
-        subprocess.run(["p3x-tree-to-svg", file_path])
-        tree_file_path = file_path + ".svg"
-        shutil.copy(tree_file_path, tree_svg_dir)
-  
 
 def write_homoplastic_snp_table(report_data):
     # Initialize containers for the data
@@ -1712,6 +3182,39 @@ def write_homoplastic_snp_table(report_data):
     return homoplastic_snps_html
 
 
+def write_ksnp_distance_files(genome_ids, diffs, proportions, matrix_path, report_path):
+    """Write SNP differences as a kSNPdist.report and their proportion of shared loci as a kSNPdist.matrix."""
+    with open(matrix_path, "w") as f:
+        f.write("\t".join(genome_ids) + "\n")
+        np.savetxt(f, proportions, fmt="%.6f", delimiter="\t")
+    with open(report_path, "w") as f:
+        for i in range(len(genome_ids) - 1):
+            row = diffs[i].tolist()
+            f.writelines("{}\t{}\t{}\n".format(row[j], genome_ids[i], genome_ids[j])
+                         for j in range(i + 1, len(genome_ids)))
+
+
+def write_light_tree_svg(svg_path, light_path):
+    """Write a lighter tree image: text labels dropped and coordinates rounded to one decimal."""
+    with open(svg_path) as f:
+        svg = f.read()
+    svg = SVG_TEXT_ELEMENTS.sub("", svg)
+    svg = SVG_DECIMALS.sub(lambda match: "{:.1f}".format(float(match.group())), svg)
+    tmp_path = "{}.{}.tmp".format(light_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(svg)
+    os.replace(tmp_path, light_path)
+
+
+def write_snp_alignment(fasta_path, genome_ids, codes):
+    """Write an encoded SNP alignment as a kSNP4 SNP matrix FASTA, with '-' for missing loci."""
+    letters = np.frombuffer(b"-ACGT", dtype=np.uint8)
+    with open(fasta_path, "wb") as f:
+        for genome_id, row in zip(genome_ids, codes):
+            f.write(">{}\n".format(genome_id).encode())
+            f.write(letters[row].tobytes() + b"\n")
+
+
 @click.group()
 def cli():
     """ This script supports the Whole Genome SNP service with multiple commands."""
@@ -1719,17 +3222,224 @@ def cli():
 
 
 @cli.command()
+@click.option("--staging-mode", type=click.Choice(["link", "copy"]), default="link", show_default=True,
+              help="Hardlink (or symlink across filesystems) raw genomes into place, or copy them")
 @click.argument("service_config")
-def clean_fasta_filenames(service_config):
+def clean_fasta_filenames(service_config, staging_mode):
     """Ensure files adhere to the rules defined by kSNP4"""
     with open(service_config) as file:
         data = json.load(file)
         raw_fasta_dir = data["raw_fasta_dir"]
         clean_fasta_dir = data["clean_data_dir"]
+        manifest = {}
         for index, filename in enumerate(sorted(os.listdir(raw_fasta_dir)), start=1):
             original_path = os.path.join(raw_fasta_dir, filename)
             new_name = ksnp4_filename_format(filename)
-            copy_new_file(clean_fasta_dir, new_name, filename, original_path)
+            method = stage_fasta_file(clean_fasta_dir, new_name, filename, original_path, mode=staging_mode)
+            manifest[new_name] = {"source": os.path.abspath(original_path), "method": method}
+    # Kept out of the clean directory, which MakeKSNP4infile reads in full
+    manifest_path = os.path.join(data["work_data_dir"], FASTA_STAGING_MANIFEST)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+@cli.command()
+@click.argument("service_config")
+def normalize_fastas(service_config):
+    """Validate and normalize the staged genomes in parallel before kSNP4, recording per-genome stats."""
+    with open(service_config) as file:
+        data = json.load(file)
+    clean_fasta_dir = data["clean_data_dir"]
+    work_dir = data["work_data_dir"]
+    index_dir = os.path.join(work_dir, FASTA_INDEX_DIRNAME)
+    os.makedirs(index_dir, exist_ok=True)
+    fasta_paths = [os.path.join(clean_fasta_dir, filename) for filename in sorted(os.listdir(clean_fasta_dir))
+                   if filename.endswith(FASTA_EXTENSIONS)]
+    start = time.time()
+    jobs = [(fasta_path, fasta_index_path(fasta_path, index_dir)) for fasta_path in fasta_paths]
+    all_stats = run_in_process_pool(normalize_fasta, jobs, int(data.get("cores", 1)))
+
+    manifest_path = os.path.join(work_dir, FASTA_STAGING_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    for fasta_path, stats in zip(fasta_paths, all_stats):
+        if stats["status"] == "rejected":
+            sys.stderr.write("Rejecting {}: {}\n".format(stats["genome"], stats["reason"]))
+            os.remove(fasta_path)
+        elif stats["status"] == "normalized":
+            sys.stderr.write("Normalized {}\n".format(stats["genome"]))
+            if stats["genome"] in manifest:
+                manifest[stats["genome"]]["method"] = "rewritten"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    stats_df = pd.DataFrame(all_stats, columns=GENOME_STATS_COLUMNS)
+    stats_df.to_csv(os.path.join(work_dir, GENOME_STATS_FILENAME), sep="\t", index=False)
+
+    accepted = sum(1 for stats in all_stats if stats["status"] != "rejected")
+    sys.stderr.write("Checked {} genomes in {:.2f}s: {} accepted, {} rejected\n".format(
+        len(all_stats), time.time() - start, accepted, len(all_stats) - accepted))
+    if accepted < 2:
+        sys.stderr.write("kSNP4 needs at least 2 valid genomes but only {} passed validation; see {}\n".format(
+            accepted, os.path.join(work_dir, GENOME_STATS_FILENAME)))
+        sys.exit(1)
+
+@cli.command()
+@click.option("--threads", type=int, default=None, help="Worker threads; defaults to the cores in the service config")
+@click.argument("service_config")
+def compute_distances(service_config, threads):
+    """Compute kSNPdist-style distance matrices and reports for the All, Core and Majority SNP alignments in one pass."""
+    with open(service_config) as file:
+        data = json.load(file)
+    work_dir = data["work_data_dir"]
+    output_dir = data["output_data_dir"]
+    majority_threshold = data["params"]["majority-threshold"]
+    if threads is None:
+        threads = int(data.get("cores", 1))
+    cache_dir = os.path.join(work_dir, DISTANCE_CACHE_DIRNAME)
+    alignments = [
+        ("all", "All_SNPs", "SNPs_all_matrix.fasta"),
+        ("core", "Core_SNPs", "core_SNPs_matrix.fasta"),
+        ("majority", "Majority_SNPs", "SNPs_in_majority{}_matrix.fasta".format(majority_threshold)),
+    ]
+    missing = []
+    for subset, subdir, alignment in alignments:
+        alignment_path = os.path.join(work_dir, alignment)
+        if not os.path.exists(alignment_path) or os.path.getsize(alignment_path) == 0:
+            sys.stderr.write("{} is either empty or not found... cannot compute {} SNP distances\n".format(alignment_path, subset))
+            missing.append(subset)
+            continue
+        start = time.time()
+        genome_ids, codes = read_snp_alignment(alignment_path)
+        diffs, shared = compute_snp_distances(codes, threads=threads)
+        proportions = distance_proportions(diffs, shared, "{} SNP distances".format(subset))
+        write_distance_outputs(subset, subdir, genome_ids, diffs, proportions, work_dir, output_dir, cache_dir)
+        sys.stderr.write("{} SNP distances: {} genomes x {} loci in {:.2f}s\n".format(subset, codes.shape[0], codes.shape[1], time.time() - start))
+    if missing:
+        sys.exit(1)
+
+@cli.command()
+@click.option("--threads", type=int, default=None, help="Worker threads; defaults to the cores in the service config")
+@click.argument("service_config")
+def extend_snp_analysis(service_config, threads):
+    """Add genomes to a previous job's SNP matrices and distances, reusing its k and SNP loci instead of rerunning kSNP4."""
+    with open(service_config) as file:
+        data = json.load(file)
+    work_dir = data["work_data_dir"]
+    output_dir = data["output_data_dir"]
+    clean_fasta_dir = data["clean_data_dir"]
+    previous_dir = data["previous_output_dir"]
+    majority_threshold = data["params"]["majority-threshold"]
+    if threads is None:
+        threads = int(data.get("cores", 1))
+    cache_dir = os.path.join(work_dir, DISTANCE_CACHE_DIRNAME)
+    start = time.time()
+
+    snps_all_path = os.path.join(previous_dir, "All_SNPs", "SNPs_all.tsv")
+    matrix_path = os.path.join(previous_dir, "All_SNPs", "SNPs_all_matrix.fasta")
+    for path in (snps_all_path, matrix_path):
+        if not os.path.exists(path):
+            sys.stderr.write("{} not found; the previous output folder cannot be extended, run a full analysis\n".format(path))
+            sys.exit(1)
+    previous_ids, previous_codes = read_snp_alignment(matrix_path)
+    loci, blank_separated = read_snps_all(snps_all_path)
+    if len(loci) != previous_codes.shape[1]:
+        sys.stderr.write("{} lists {} SNP loci but {} has {} columns; run a full analysis\n".format(
+            snps_all_path, len(loci), matrix_path, previous_codes.shape[1]))
+        sys.exit(1)
+    # kSNP4 SNP contexts are k-mers, so the previous k is the context length
+    k = len(loci[0][1][0][1]) if loci else 0
+    optimum_k_path = os.path.join(previous_dir, "Intermediate_Files", "optimum_k.txt")
+    if os.path.exists(optimum_k_path):
+        with open(optimum_k_path) as f:
+            recorded_k = f.read().strip()
+        if recorded_k.isdigit() and int(recorded_k) != k:
+            sys.stderr.write("Previous optimum_k.txt says k = {} but its SNP contexts are {} long; using {}\n".format(recorded_k, k, k))
+    if not 0 < k <= MAX_SCAN_K or k % 2 == 0:
+        sys.stderr.write("Cannot scan for SNP contexts of length {}; run a full analysis\n".format(k))
+        sys.exit(1)
+    with open(os.path.join(work_dir, "optimum_k.txt"), "w") as f:
+        f.write("{}\n".format(k))
+
+    # Genomes dropped from the group are removed; only genomes new to the group are scanned
+    current = {os.path.splitext(genome)[0]: genome for genome in read_genome_stats(work_dir)["genome"]}
+    kept = [i for i, genome_id in enumerate(previous_ids) if genome_id in current]
+    added = sorted(set(current) - set(previous_ids))
+    context_keys, context_loci = snp_context_keys(loci, previous_ids, previous_codes, k)
+    jobs = [(os.path.join(clean_fasta_dir, current[genome_id]), context_keys, context_loci, len(loci), k) for genome_id in added]
+    scans = run_in_process_pool(scan_genome_snps, jobs, threads)
+    genome_ids = [previous_ids[i] for i in kept] + added
+    codes = np.vstack([previous_codes[kept]] + [row[None, :] for row, _ in scans])
+    sys.stderr.write("Scanned {} new genomes for {} SNP contexts (k = {}) in {:.2f}s\n".format(
+        len(added), len(context_keys), k, time.time() - start))
+
+    # SNPs_all keeps the previous lines of the remaining genomes and gains lines for the new ones
+    new_lines = {}
+    for _, lines in scans:
+        for locus, context, position, strand, genome in lines:
+            new_lines.setdefault(locus, []).append([str(loci[locus][0]), context, str(position), strand, genome])
+    keep_genomes = set(genome_ids)
+    with open(os.path.join(work_dir, "SNPs_all"), "w") as f:
+        for column, (_, lines) in enumerate(loci):
+            f.writelines("\t".join(fields) + "\n" for fields in lines if fields[-1] in keep_genomes)
+            f.writelines("\t".join(fields) + "\n" for fields in new_lines.get(column, []))
+            if blank_separated:
+                f.write("\n")
+
+    present = codes > 0
+    previous_present = previous_codes > 0
+    subsets = [
+        ("all", "All_SNPs", "SNPs_all_matrix.fasta", np.ones(codes.shape[1], dtype=bool),
+         np.ones(codes.shape[1], dtype=bool)),
+        ("core", "Core_SNPs", "core_SNPs_matrix.fasta", present.all(axis=0), previous_present.all(axis=0)),
+        ("majority", "Majority_SNPs", "SNPs_in_majority{}_matrix.fasta".format(majority_threshold),
+         present.mean(axis=0) >= float(majority_threshold), previous_present.mean(axis=0) >= float(majority_threshold)),
+    ]
+    for subset, subdir, alignment, columns, previous_columns in subsets:
+        subset_start = time.time()
+        subset_codes = np.ascontiguousarray(codes[:, columns])
+        write_snp_alignment(os.path.join(work_dir, alignment), genome_ids, subset_codes)
+        previous_report = os.path.join(previous_dir, subdir, "{}_kSNPdist.report".format(subset))
+        previous_matrix = os.path.join(previous_dir, subdir, "{}_kSNPdist.matrix".format(subset))
+        # Previous distances stay valid only while the subset keeps the same loci
+        if np.array_equal(columns, previous_columns) and os.path.exists(previous_report) and os.path.exists(previous_matrix):
+            dotted_ids = [previous_ids[i].replace("_", ".") for i in kept]
+            report_ids, report_values = load_distance_table(previous_report, "report", cache_dir)
+            matrix_ids, matrix_values = load_distance_table(previous_matrix, "matrix", cache_dir)
+            report_positions = {genome_id: i for i, genome_id in enumerate(report_ids)}
+            matrix_positions = {genome_id: i for i, genome_id in enumerate(matrix_ids)}
+            report_order = [report_positions[genome_id] for genome_id in dotted_ids]
+            matrix_order = [matrix_positions[genome_id] for genome_id in dotted_ids]
+            new_diffs, new_shared = compute_new_row_distances(subset_codes, len(kept), threads=threads)
+            new_proportions = distance_proportions(new_diffs, new_shared, "{} SNP distances".format(subset))
+            diffs = np.zeros((len(genome_ids), len(genome_ids)), dtype=np.int32)
+            diffs[:len(kept), :len(kept)] = np.rint(np.asarray(report_values)[np.ix_(report_order, report_order)])
+            diffs[len(kept):, :] = new_diffs
+            diffs[:, len(kept):] = new_diffs.T
+            proportions = np.zeros(diffs.shape, dtype=np.float64)
+            proportions[:len(kept), :len(kept)] = np.asarray(matrix_values)[np.ix_(matrix_order, matrix_order)]
+            proportions[len(kept):, :] = new_proportions
+            proportions[:, len(kept):] = new_proportions.T
+            method = "extended"
+        else:
+            diffs, shared = compute_snp_distances(subset_codes, threads=threads)
+            proportions = distance_proportions(diffs, shared, "{} SNP distances".format(subset))
+            method = "recomputed"
+        write_distance_outputs(subset, subdir, genome_ids, diffs, proportions, work_dir, output_dir, cache_dir)
+        sys.stderr.write("{} SNP distances {}: {} genomes x {} loci in {:.2f}s\n".format(
+            subset, method, len(genome_ids), subset_codes.shape[1], time.time() - subset_start))
+
+    # SNP counts in the layout of kSNP4's COUNT files, for the report
+    with open(os.path.join(work_dir, "COUNT_SNPs"), "w") as f:
+        f.write("Number_SNPs: {}\n".format(codes.shape[1]))
+    with open(os.path.join(work_dir, "COUNT_coreSNPs"), "w") as f:
+        f.write("Number core SNPs: {}\n".format(int(subsets[1][3].sum())))
+        f.write("Number non-core SNPs: {}\n".format(int(codes.shape[1] - subsets[1][3].sum())))
+        f.write("Number SNPs in at least a fraction {} of genomes: {}\n".format(majority_threshold, int(subsets[2][3].sum())))
+    with open(os.path.join(work_dir, INCREMENTAL_UPDATE_FILENAME), "w") as f:
+        json.dump({"k": k, "previous_genomes": len(kept), "removed_genomes": len(previous_ids) - len(kept),
+                   "added_genomes": added}, f, indent=2)
+    sys.stderr.write("Extended {} genomes with {} new in {:.2f}s\n".format(len(kept), len(added), time.time() - start))
 
 @cli.command()
 @click.argument("service_config")
@@ -1742,18 +3452,17 @@ def convert_to_phyloxml_trees(service_config):
     if not os.path.exists(work_dir):
         sys.stderr.write("Work directory, {}, does not exist".format(work_dir))
         return
-    for filename in os.listdir(work_dir):
-        file_path = os.path.join(work_dir, filename)
-        # Skip directories
-        if not os.path.isfile(file_path):
-            continue
-        # newick to phyloxml driver cocd
-        clean_tree_dir = os.path.join(work_dir, "clean_trees")
-        os.makedirs(clean_tree_dir, exist_ok=True)
-        if "tree" in filename:
-            clean_nwk_path = os.path.join(clean_tree_dir, filename)
-            edit_newick_genome_id(file_path, clean_nwk_path)
-            run_newick_to_phyloxml(clean_nwk_path)
+    clean_tree_dir = os.path.join(work_dir, "clean_trees")
+    os.makedirs(clean_tree_dir, exist_ok=True)
+    with os.scandir(work_dir) as entries:
+        tree_files = sorted(entry.name for entry in entries if entry.is_file() and "tree" in entry.name)
+    # Each tree is independent: a Newick rewrite plus a p3x-newick-to-phyloxml run
+    start = time.time()
+    jobs = [(os.path.join(work_dir, filename), os.path.join(clean_tree_dir, filename)) for filename in tree_files]
+    timings = run_in_process_pool(convert_tree_to_phyloxml, jobs, int(data.get("cores", 1)))
+    for filename, seconds in zip(tree_files, timings):
+        sys.stderr.write("{}: converted in {:.2f}s\n".format(filename, seconds))
+    sys.stderr.write("Converted {} trees in {:.2f}s\n".format(len(tree_files), time.time() - start))
 
 @cli.command()
 @click.argument("service_config")
@@ -1782,14 +3491,147 @@ def run_tree_to_svg(service_config):
                 "tree.SNPs_in_majority{}.NJ.tre".format(majority_threshold),
                 "tree.SNPs_in_majority{}.parsimony.tre".format(majority_threshold)
                 ]
+    # Renders are cached by the cleaned Newick content, so identical trees are drawn once per job or,
+    # with a shared cache, once across jobs
+    cache_dir, max_bytes = tree_svg_cache_settings(data)
+    start = time.time()
+    tree_digests = {}
+    to_render = {}
     for tree_filename in tree_filenames:
         file_path = os.path.join(work_dir, "clean_trees", tree_filename)
         if os.path.exists(file_path) == True and os.path.getsize(file_path) > 0:
-            run_p3x_tree_to_svg(file_path, tree_svg_dir)
+            digest = sha256_file(file_path)
+            tree_digests[tree_filename] = digest
+            cache_path = os.path.join(cache_dir, digest + ".svg")
+            if not os.path.isfile(cache_path):
+                to_render.setdefault(digest, (file_path, cache_path))
+            elif max_bytes is not None:
+                # Mark the image recently used so pruning keeps it; a failed touch only costs a warning
+                try:
+                    os.utime(cache_path)
+                except OSError as e:
+                    sys.stderr.write("Warning: could not touch cached tree image {}: {}\n".format(digest, e))
         else:
             sys.stderr.write("service did not generate {}".format(tree_filename))
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(int(data.get("cores", 1)), len(to_render)))) as pool:
+        for digest, error in zip(to_render, pool.map(lambda job: run_p3x_tree_to_svg(*job), to_render.values())):
+            if error is not None:
+                failed[digest] = error
+    # Big trees also get a label-free light image for the report to show first and a gzip copy of the full one
+    tree_images = {}
+    for tree_filename, digest in tree_digests.items():
+        if digest in failed:
+            sys.stderr.write("Could not render {}: {}\n".format(tree_filename, failed[digest]))
+            continue
+        cache_path = os.path.join(cache_dir, digest + ".svg")
+        leaves = count_newick_leaves(os.path.join(work_dir, "clean_trees", tree_filename))
+        variants = [(cache_path, ".svg")]
+        light = leaves > TREE_SVG_LIGHT_MIN_LEAVES
+        if light:
+            light_path = os.path.join(cache_dir, digest + ".light.svg")
+            gzip_path = cache_path + ".gz"
+            # The report falls back to the full image when the extra variants cannot be written
+            try:
+                if not os.path.isfile(light_path):
+                    write_light_tree_svg(cache_path, light_path)
+                if not os.path.isfile(gzip_path):
+                    write_gzip_copy(cache_path, gzip_path)
+                variants += [(light_path, ".light.svg"), (gzip_path, ".svg.gz")]
+            except OSError as e:
+                sys.stderr.write("Warning: could not write light images of {}: {}\n".format(tree_filename, e))
+                light = False
+        try:
+            for source_path, suffix in variants:
+                place_output_file(source_path, os.path.join(tree_svg_dir, tree_filename + suffix))
+        except OSError as e:
+            # A shared cache may have evicted the image since it was checked
+            sys.stderr.write("Could not place {}: {}\n".format(tree_filename, e))
+            continue
+        tree_images[tree_filename] = {"leaves": leaves, "light": light}
+    with open(os.path.join(work_dir, TREE_IMAGES_FILENAME), "w") as f:
+        json.dump(tree_images, f, indent=2)
+    if max_bytes is not None:
+        try:
+            prune_tree_svg_cache(cache_dir, max_bytes)
+        except OSError as e:
+            sys.stderr.write("Warning: could not prune the tree image cache: {}\n".format(e))
+    sys.stderr.write("{} trees: {} images rendered, {} from cache, {} failed in {:.2f}s\n".format(
+        len(tree_digests), len(to_render) - len(failed), len(set(tree_digests.values())) - len(to_render),
+        len(failed), time.time() - start))
 
 
+@cli.command()
+@click.argument("service_config")
+def write_output_manifest(service_config):
+    """List every file in the output folder with its SNP subset, workspace type, size and checksum."""
+    with open(service_config) as file:
+        data = json.load(file)
+    output_dir = data["output_data_dir"]
+    start = time.time()
+    paths = sorted(os.path.join(root, filename) for root, _, filenames in os.walk(output_dir) for filename in filenames)
+    with ThreadPoolExecutor(max_workers=max(1, int(data.get("cores", 1)))) as pool:
+        files = list(pool.map(lambda path: output_manifest_entry(output_dir, path), paths))
+    manifest_path = os.path.join(data["work_data_dir"], OUTPUT_MANIFEST_FILENAME)
+    with open(manifest_path, "w") as f:
+        json.dump({"output_dir": os.path.abspath(output_dir), "files": files}, f, indent=2)
+    sys.stderr.write("Wrote {} with {} files ({} bytes) in {:.2f}s\n".format(
+        manifest_path, len(files), sum(entry["size"] for entry in files), time.time() - start))
+
+@cli.command()
+@click.option("--workers", type=int, default=UPLOAD_WORKERS, show_default=True, help="Concurrent uploads")
+@click.argument("service_config")
+@click.argument("destination")
+def upload_output_files(service_config, destination, workers):
+    """Upload the files in the output manifest to DESTINATION, a ws: folder or a local directory, skipping unchanged files."""
+    with open(service_config) as file:
+        data = json.load(file)
+    with open(os.path.join(data["work_data_dir"], OUTPUT_MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    state_path = upload_state_path(data, destination)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    uploaded = state.setdefault(destination, {})
+    pending = [entry for entry in manifest["files"] if uploaded.get(entry["path"]) != entry["sha256"]]
+    start = time.time()
+
+    if destination.startswith("ws:"):
+        # Create each workspace folder once, parents first
+        folders = sorted({os.path.dirname(entry["path"]) for entry in pending} - {""}, key=lambda folder: folder.count("/"))
+        for folder in folders:
+            subprocess.run(["p3-mkdir", "{}/{}".format(destination.rstrip("/"), folder)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        for folder in {os.path.dirname(entry["path"]) for entry in pending}:
+            os.makedirs(os.path.join(destination, folder), exist_ok=True)
+
+    def upload(entry):
+        return entry, upload_with_retry(os.path.join(manifest["output_dir"], entry["path"]), destination, entry)
+
+    failed = []
+    uploaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for entry, error in pool.map(upload, pending):
+            if error is None:
+                uploaded[entry["path"]] = entry["sha256"]
+                uploaded_bytes += entry["size"]
+            else:
+                failed.append(entry["path"])
+                sys.stderr.write("Failed to upload {}: {}\n".format(entry["path"], error))
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    # Jobs sharing the state directory may finish together; never leave a partial file behind
+    with open(state_path + ".tmp.{}".format(os.getpid()), "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f.name, state_path)
+    elapsed = time.time() - start
+    sys.stderr.write("Uploaded {} files ({} bytes) to {} in {:.2f}s ({:.1f} MB/s); {} unchanged, {} failed\n".format(
+        len(pending) - len(failed), uploaded_bytes, destination, elapsed, uploaded_bytes / 1e6 / max(elapsed, 1e-6),
+        len(manifest["files"]) - len(pending), len(failed)))
+    if failed:
+        sys.exit(1)
+
 @cli.command()
 @click.argument("service_config")
 def organize_output_files(service_config):
@@ -1798,7 +3640,99 @@ def organize_output_files(service_config):
         data = json.load(file)
     work_dir = data["work_data_dir"]
     destination_dir = data["output_data_dir"]
-    organize_files_by_type(work_dir, destination_dir)
+    organize_files_by_type(work_dir, destination_dir, int(data.get("cores", 1)))
+
+@cli.command()
+@click.argument("service_config")
+@click.argument("kchooser_input")
+@click.argument("kchooser_report")
+def kchooser_cache_lookup(service_config, kchooser_input, kchooser_report):
+    """Write the cached Kchooser4 report for the genomes in KCHOOSER_INPUT to KCHOOSER_REPORT; exits 1 on a cache miss."""
+    with open(service_config) as file:
+        data = json.load(file)
+    cache_dir, _ = kchooser_cache_settings(data)
+    if not cache_dir:
+        sys.exit(1)
+    stats_df = read_genome_stats(data["work_data_dir"])
+    stats_df = stats_df[stats_df["genome"].isin(read_ksnp4_input_genomes(kchooser_input))]
+    # An empty genome set would hash to the same key for every job
+    if stats_df.empty:
+        sys.stderr.write("No genome hashes for {}; skipping the Kchooser cache\n".format(kchooser_input))
+        sys.exit(1)
+    key = kchooser_cache_key(stats_df["sequence_sha256"])
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, KCHOOSER_TEMPLATE_FILENAME)) as f:
+            template = f.read()
+    except OSError as e:
+        sys.stderr.write("Kchooser cache miss for {}: {}\n".format(key, e))
+        sys.exit(1)
+    # The cached report names genomes by content; name them as this job does
+    genome_names = {sequence_hash: name for name, sequence_hash in kchooser_genome_hashes(stats_df, kchooser_input).items()}
+    report = fill_kchooser_report_template(template, genome_names)
+    if report is None:
+        sys.stderr.write("Kchooser cache entry {} names a genome this job does not have; treating it as a miss\n".format(key))
+        sys.exit(1)
+    try:
+        with open(kchooser_report, "w") as f:
+            f.write(report)
+    except OSError as e:
+        sys.stderr.write("Kchooser cache miss for {}: {}\n".format(key, e))
+        sys.exit(1)
+    # Touch the entry so LRU eviction sees it as recently used
+    try:
+        os.utime(entry_dir)
+    except OSError as e:
+        sys.stderr.write("Warning: could not touch Kchooser cache entry {}: {}\n".format(key, e))
+    sys.stderr.write("Kchooser cache hit for {}\n".format(key))
+
+@cli.command()
+@click.argument("service_config")
+@click.argument("kchooser_input")
+@click.argument("kchooser_report")
+def kchooser_cache_store(service_config, kchooser_input, kchooser_report):
+    """Store the Kchooser4 report and optimum k for the genomes in KCHOOSER_INPUT, evicting old entries past the size bound."""
+    with open(service_config) as file:
+        data = json.load(file)
+    cache_dir, max_bytes = kchooser_cache_settings(data)
+    if not cache_dir:
+        return
+    stats_df = read_genome_stats(data["work_data_dir"])
+    stats_df = stats_df[stats_df["genome"].isin(read_ksnp4_input_genomes(kchooser_input))]
+    if stats_df.empty:
+        sys.stderr.write("No genome hashes for {}; not caching the Kchooser result\n".format(kchooser_input))
+        return
+    key = kchooser_cache_key(stats_df["sequence_sha256"])
+    # The Kchooser4 result is already good; a cache that cannot be written only costs a warning
+    try:
+        with open(kchooser_report) as f:
+            report_template = kchooser_report_template(f.read(), kchooser_genome_hashes(stats_df, kchooser_input))
+        store_kchooser_cache_entry(cache_dir, key, report_template, len(stats_df))
+        prune_kchooser_cache(cache_dir, max_bytes)
+    except OSError as e:
+        sys.stderr.write("Warning: could not update the Kchooser cache for {}: {}\n".format(key, e))
+
+
+@cli.command()
+@click.option("--kchooser-sample", type=int, required=True, help="Number of genomes to run Kchooser4 on")
+@click.argument("service_config")
+@click.argument("ksnp4_input_file")
+@click.argument("sample_input_file")
+def write_kchooser_sample(service_config, ksnp4_input_file, sample_input_file, kchooser_sample):
+    """Write a kSNP4 input file listing a length-stratified sample of the genomes for Kchooser4."""
+    with open(service_config) as file:
+        data = json.load(file)
+    work_dir = data["work_data_dir"]
+    with open(ksnp4_input_file) as f:
+        lines = {os.path.basename(line.split("\t")[0]): line for line in f if line.strip()}
+    stats_df = read_genome_stats(work_dir)
+    stats_df = stats_df[stats_df["genome"].isin(lines)]
+    sample = stratified_kchooser_sample(stats_df, kchooser_sample)
+    with open(sample_input_file, "w") as f:
+        f.writelines(lines[genome] for genome in sample)
+    with open(os.path.join(work_dir, KCHOOSER_SAMPLE_FILENAME), "w") as f:
+        json.dump({"sample_size": len(sample), "total_genomes": len(lines), "genomes": sample}, f, indent=2)
+    sys.stderr.write("Kchooser4 will run on {} of {} genomes\n".format(len(sample), len(lines)))
 
 @cli.command()
 @click.argument("kchooser_report")
@@ -1813,14 +3747,16 @@ def fix_ksnpdist_outputs(service_config):
     with open(service_config) as f:
         data = json.load(f)
     output_dir = data["output_data_dir"]
+    cache_dir = os.path.join(data["work_data_dir"], DISTANCE_CACHE_DIRNAME)
     for subset, subdir in [("all", "All_SNPs"), ("core", "Core_SNPs"), ("majority", "Majority_SNPs")]:
-        process_ksnp_report(os.path.join(output_dir, subdir, "{}_kSNPdist.report".format(subset)))
-        fix_ksnp_matrix_genome_ids(os.path.join(output_dir, subdir, "{}_kSNPdist.matrix".format(subset)))
+        process_ksnp_report(os.path.join(output_dir, subdir, "{}_kSNPdist.report".format(subset)), cache_dir)
+        fix_ksnp_matrix_genome_ids(os.path.join(output_dir, subdir, "{}_kSNPdist.matrix".format(subset)), cache_dir)
 
 @cli.command()
+@click.option("--optimal-leaf-ordering", "optimal_ordering", is_flag=True, help="Apply optimal leaf ordering to the heatmap clustering (skipped for large groups)")
 @click.argument("service_config")
 @click.argument("html_report_path")
-def write_html_report(service_config, html_report_path):
+def write_html_report(service_config, html_report_path, optimal_ordering):
     """Write an interactive report summarizing all outputs"""
     # run the functions here 
     report_data = {}
@@ -1831,27 +3767,38 @@ def write_html_report(service_config, html_report_path):
     majority_threshold = data["params"]["majority-threshold"]
     metadata_json = os.path.join(os.getcwd(), "genome_metadata.json")
     
-    kchooser_report = os.path.join(clean_data_dir, "Kchooser4_ksnp4_input_file.report")
-    report_data = parse_kchooser_report(report_data, kchooser_report)
+    kchooser_report = os.path.join(clean_data_dir, KCHOOSER_REPORT_FILENAME)
+    kchooser_sample = None
+    kchooser_sample_path = os.path.join(work_dir, KCHOOSER_SAMPLE_FILENAME)
+    if os.path.exists(kchooser_sample_path):
+        with open(kchooser_sample_path) as f:
+            kchooser_sample = json.load(f)
+    incremental_update = None
+    incremental_update_path = os.path.join(work_dir, INCREMENTAL_UPDATE_FILENAME)
+    if os.path.exists(incremental_update_path):
+        with open(incremental_update_path) as f:
+            incremental_update = json.load(f)
+    report_data = parse_kchooser_report(report_data, kchooser_report, kchooser_sample, incremental_update)
     kchooser_df = pd.DataFrame.from_dict(report_data["kchooser_report"])
     
     report_data = parse_intermediate_files(report_data, work_dir)
     homoplastic_snps_html = write_homoplastic_snp_table(report_data)
-    barplot_html = create_genome_length_bar_plot(clean_data_dir)
+    barplot_html = create_genome_length_bar_plot(clean_data_dir, os.path.join(work_dir, FASTA_INDEX_DIRNAME), int(data.get("cores", 1)))
     snp_distribution_html = make_genome_bar_chart(data, report_data, majority_threshold)
-    input_genome_table = generate_table_html_2(kchooser_df, table_width='75%')
+    input_genome_table = generate_table_html_2(kchooser_df, table_width='75%') + rejected_genomes_html(work_dir)
     # SNP Counts 
-    heatmap_html, metadata_json_string = interactive_threshold_heatmap(service_config, metadata_json, majority_threshold)
+    heatmap_html, metadata_json_string = interactive_threshold_heatmap(service_config, metadata_json, majority_threshold, optimal_ordering=optimal_ordering)
     output_dir = data["output_data_dir"]
     tsv_dst = os.path.join(output_dir, "metadata.tsv")
     if os.path.exists("metadata.tsv"):
-        shutil.copy("metadata.tsv", tsv_dst)
+        place_output_file("metadata.tsv", tsv_dst)
 
+    cache_dir = os.path.join(work_dir, DISTANCE_CACHE_DIRNAME)
     for subset, subdir in [("all", "All_SNPs"), ("core", "Core_SNPs"), ("majority", "Majority_SNPs")]:
         report_path = os.path.join(output_dir, subdir, "{}_kSNPdist.report".format(subset))
-        process_ksnp_report(report_path)
+        process_ksnp_report(report_path, cache_dir)
         matrix_path = os.path.join(output_dir, subdir, "{}_kSNPdist.matrix".format(subset))
-        fix_ksnp_matrix_genome_ids(matrix_path)
+        fix_ksnp_matrix_genome_ids(matrix_path, cache_dir)
 
     html_template = define_html_template(input_genome_table, barplot_html, snp_distribution_html, \
                     homoplastic_snps_html, heatmap_html, \
@@ -0,0 +1,5 @@
+import os
+import sys
+
+SERVICE_SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "service-scripts")
+sys.path.insert(0, SERVICE_SCRIPTS)
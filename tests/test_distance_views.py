@@ -0,0 +1,67 @@
+"""The report embeds each distinct distance view once, however its genomes are ordered."""
+import json
+import re
+
+import whole_genome_snp_utils as wgs
+
+REPORT_ROWS = [("4", "g_1", "g_2"), ("9", "g_1", "g_3"), ("6", "g_2", "g_3")]
+
+
+def write_report(path, rows):
+    path.write_text("".join("\t".join(row) + "\n" for row in rows))
+
+
+def write_matrix(path, genome_ids, matrix):
+    path.write_text("\t".join(genome_ids) + "\n" + "".join("\t".join(str(v) for v in row) + "\n" for row in matrix))
+
+
+def heatmap_views(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metadata = tmp_path / "metadata.json"
+    metadata.write_text(json.dumps([{"genome_id": "g_{}".format(i), "genome_name": "genome {}".format(i)} for i in (1, 2, 3)]))
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"cores": 1, "work_data_dir": str(tmp_path), "params": {}}))
+    html, _ = wgs.interactive_threshold_heatmap(str(config), str(metadata), 0.5)
+    views = json.loads(re.search(r"const distanceViews\s*=\s*(\{.*?\});", html).group(1))
+    payloads = json.loads(re.search(r"const distancePayloads\s*=\s*(\{.*?\});\n", html).group(1))
+    return views, payloads
+
+
+def test_equivalent_views_share_one_payload(tmp_path, monkeypatch):
+    # Every SNP is core, so the three reports hold the same distances, listed in different orders
+    write_report(tmp_path / "all_kSNPdist.report", REPORT_ROWS)
+    write_report(tmp_path / "core_kSNPdist.report", [(d, b, a) for d, a, b in reversed(REPORT_ROWS)])
+    write_report(tmp_path / "majority_kSNPdist.report", REPORT_ROWS[1:] + REPORT_ROWS[:1])
+    proportions = [[0, 0.04, 0.09], [0.04, 0, 0.06], [0.09, 0.06, 0]]
+    write_matrix(tmp_path / "all_kSNPdist.matrix", ["g_1", "g_2", "g_3"], proportions)
+    # The same proportions in alignment order g_3, g_1, g_2
+    write_matrix(tmp_path / "core_kSNPdist.matrix", ["g_3", "g_1", "g_2"],
+                 [[0, 0.09, 0.06], [0.09, 0, 0.04], [0.06, 0.04, 0]])
+
+    views, payloads = heatmap_views(tmp_path, monkeypatch)
+
+    assert views["1"]["report"] == views["2"]["report"] == views["3"]["report"]
+    assert views["1"]["matrix"] == views["2"]["matrix"]
+    assert views["3"]["matrix"] is None
+    assert len(payloads) == 2
+
+
+def test_different_distances_keep_separate_payloads(tmp_path, monkeypatch):
+    write_report(tmp_path / "all_kSNPdist.report", REPORT_ROWS)
+    write_report(tmp_path / "core_kSNPdist.report", [("5", "g_1", "g_2")] + REPORT_ROWS[1:])
+
+    views, payloads = heatmap_views(tmp_path, monkeypatch)
+
+    assert views["1"]["report"] != views["2"]["report"]
+    assert len(payloads) == 2
+
+
+def test_only_snp_count_views_get_a_close_pair_index(tmp_path, monkeypatch):
+    write_report(tmp_path / "all_kSNPdist.report", REPORT_ROWS[:2] + [("60", "g_2", "g_3")])
+    write_matrix(tmp_path / "all_kSNPdist.matrix", ["g_1", "g_2", "g_3"], [[0, 0.04, 0.9], [0.04, 0, 0.6], [0.9, 0.6, 0]])
+
+    views, payloads = heatmap_views(tmp_path, monkeypatch)
+
+    # The default cutoff of 40 SNPs leaves out one pair of the report, but would take in every proportion
+    assert payloads[views["1"]["report"]]["close_pairs"]["count"] == 2
+    assert "close_pairs" not in payloads[views["1"]["matrix"]]
@@ -0,0 +1,172 @@
+"""extend-snp-analysis on a small synthetic group must reproduce a full distance recomputation."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import SERVICE_SCRIPTS
+import whole_genome_snp_utils as wgs
+
+SCRIPT = os.path.join(SERVICE_SCRIPTS, "whole_genome_snp_utils.py")
+K = 21
+LOCI = 200
+GENOMES = 10
+PREVIOUS = 8
+MAJORITY = 0.5
+# Genomes whose FASTA holds the reverse complement of the reference strand
+REVERSED = {1, 5, 8}
+SUBSETS = [
+    ("all", "All_SNPs", "SNPs_all_matrix.fasta"),
+    ("core", "Core_SNPs", "core_SNPs_matrix.fasta"),
+    ("majority", "Majority_SNPs", "SNPs_in_majority{}_matrix.fasta".format(MAJORITY)),
+]
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def run(command, job_dir):
+    """Run a whole_genome_snp_utils command on a job's config; returns its stderr log."""
+    result = subprocess.run([sys.executable, SCRIPT, command, "config.json"], cwd=job_dir, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return result.stderr
+
+
+@pytest.fixture(scope="module")
+def synthetic_group():
+    """Genomes sharing one backbone with SNPs at fixed loci; some loci lose their k-mer context in some genomes."""
+    rng = np.random.default_rng(7)
+    backbone = list("".join(rng.choice(list("ACGT"), size=60 * LOCI + 100)))
+    positions = [30 + 60 * i for i in range(LOCI)]
+    alternates = [rng.choice([b for b in "ACGT" if b != backbone[p]]) for p in positions]
+    names = ["{}_{}".format(2000 + g, g % 3) for g in range(GENOMES)]
+    alleles = np.full((GENOMES, LOCI), "-")
+    genomes = []
+    for g in range(GENOMES):
+        sequence = backbone.copy()
+        for locus, p in enumerate(positions):
+            sequence[p] = alternates[locus] if rng.random() < 0.3 else backbone[p]
+            if rng.random() < 0.05:
+                sequence[p + 4] = rng.choice([b for b in "ACGT" if b != sequence[p + 4]])
+            else:
+                alleles[g, locus] = sequence[p]
+        genomes.append("".join(sequence))
+    # Every locus must exist in the previous analysis
+    alleles[0, ~(alleles[:PREVIOUS] != "-").any(axis=0)] = "A"
+    return {"names": names, "genomes": genomes, "positions": positions, "alleles": alleles}
+
+
+def make_job(job_dir, group, members, **config):
+    for sub in ("work", "output", "clean", "raw"):
+        os.makedirs(os.path.join(job_dir, sub))
+    for g in members:
+        sequence = group["genomes"][g]
+        if g in REVERSED:
+            sequence = reverse_complement(sequence)
+        with open(os.path.join(job_dir, "clean", group["names"][g] + ".fasta"), "w") as f:
+            f.write(">{}_contig1\n".format(group["names"][g]))
+            for start in range(0, len(sequence), 70):
+                f.write(sequence[start:start + 70] + "\n")
+    data = {
+        "cores": 2,
+        "work_data_dir": os.path.join(job_dir, "work"),
+        "output_data_dir": os.path.join(job_dir, "output"),
+        "clean_data_dir": os.path.join(job_dir, "clean"),
+        "raw_fasta_dir": os.path.join(job_dir, "raw"),
+        "params": {"majority-threshold": MAJORITY, "min_mid_linkage": 10, "max_mid_linkage": 40},
+    }
+    data.update(config)
+    with open(os.path.join(job_dir, "config.json"), "w") as f:
+        json.dump(data, f)
+
+
+def write_snp_matrices(job_dir, group, members):
+    """The SNP alignments kSNP4 would have written for these genomes."""
+    alleles = group["alleles"][members]
+    present = alleles != "-"
+    columns = {
+        "all": np.arange(LOCI),
+        "core": np.flatnonzero(present.all(axis=0)),
+        "majority": np.flatnonzero(present.mean(axis=0) >= MAJORITY),
+    }
+    for subset, _, filename in SUBSETS:
+        with open(os.path.join(job_dir, "work", filename), "w") as f:
+            for g, row in zip(members, alleles):
+                f.write(">{}\n{}\n".format(group["names"][g], "".join(row[columns[subset]])))
+
+
+def write_previous_outputs(job_dir, group, members):
+    """SNPs_all.tsv, SNP matrices and optimum k in the layout of a finished job's output folder."""
+    output_dir = os.path.join(job_dir, "output")
+    with open(os.path.join(output_dir, "All_SNPs", "SNPs_all.tsv"), "w") as f:
+        for locus, p in enumerate(group["positions"]):
+            for g in members:
+                if group["alleles"][g, locus] == "-":
+                    continue
+                genome = group["genomes"][g]
+                context = genome[p - K // 2:p + K // 2 + 1]
+                if g in REVERSED:
+                    f.write("{}\t{}\t{}\tR\t{}\n".format(locus + 1, reverse_complement(context), len(genome) - p,
+                                                          group["names"][g]))
+                else:
+                    f.write("{}\t{}\t{}\tF\t{}\n".format(locus + 1, context, p + 1, group["names"][g]))
+            f.write("\n")
+    for _, subdir, filename in SUBSETS:
+        shutil.copy(os.path.join(job_dir, "work", filename), os.path.join(output_dir, subdir))
+    os.makedirs(os.path.join(output_dir, "Intermediate_Files"))
+    with open(os.path.join(output_dir, "Intermediate_Files", "optimum_k.txt"), "w") as f:
+        f.write("{}\n".format(K))
+
+
+def read_distances(path, kind):
+    if kind == "report":
+        genome_ids, matrix = wgs.read_ksnp_distance_report(path)
+    else:
+        genome_ids, matrix = wgs.read_ksnp_distance_matrix(path)
+    order = np.argsort(genome_ids)
+    return [genome_ids[i] for i in order], np.asarray(matrix, dtype=np.float64)[np.ix_(order, order)]
+
+
+def test_extended_distances_match_full_recompute(tmp_path, synthetic_group):
+    previous = list(range(PREVIOUS))
+    # Drop one previous genome and add two new ones
+    members = [g for g in range(GENOMES) if g != 3]
+
+    previous_job = str(tmp_path / "previous")
+    make_job(previous_job, synthetic_group, previous)
+    write_snp_matrices(previous_job, synthetic_group, previous)
+    run("compute-distances", previous_job)
+    run("fix-ksnpdist-outputs", previous_job)
+    write_previous_outputs(previous_job, synthetic_group, previous)
+
+    extended_job = str(tmp_path / "extended")
+    make_job(extended_job, synthetic_group, members, previous_output_dir=os.path.join(previous_job, "output"))
+    run("normalize-fastas", extended_job)
+    log = run("extend-snp-analysis", extended_job)
+    # The full SNP set keeps its loci, so its previous distances are reused rather than recomputed
+    assert "all SNP distances extended" in log
+
+    full_job = str(tmp_path / "full")
+    make_job(full_job, synthetic_group, members)
+    write_snp_matrices(full_job, synthetic_group, members)
+    run("compute-distances", full_job)
+
+    with open(os.path.join(extended_job, "work", wgs.INCREMENTAL_UPDATE_FILENAME)) as f:
+        update = json.load(f)
+    assert update["previous_genomes"] == PREVIOUS - 1
+    assert update["removed_genomes"] == 1
+    assert len(update["added_genomes"]) == 2
+
+    for subset, _, _ in SUBSETS:
+        for kind in ("report", "matrix"):
+            filename = "{}_kSNPdist.{}".format(subset, kind)
+            extended_ids, extended = read_distances(os.path.join(extended_job, "work", filename), kind)
+            full_ids, full = read_distances(os.path.join(full_job, "work", filename), kind)
+            assert extended_ids == full_ids
+            np.testing.assert_allclose(extended, full, atol=1e-4, err_msg=filename)
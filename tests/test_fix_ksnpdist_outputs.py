@@ -0,0 +1,68 @@
+"""fix-ksnpdist-outputs relabels the published kSNPdist files without reformatting them."""
+import json
+import os
+
+import numpy as np
+from click.testing import CliRunner
+
+import whole_genome_snp_utils as wgs
+
+# kSNPdist output as written, including rows out of genome order and a pair listed both ways
+RAW_REPORT = "3\tg_2\tg_1\n0\tg_1\tg_3\n12\tg_3\tg_2\n12\tg_2\tg_3\n"
+RAW_MATRIX = "g_1\tg_2\tg_3\n0\t0.0125\t0\n0.0125\t0\t0.1\n0\t0.1\t0\n"
+
+
+def fix_outputs(tmp_path):
+    output_dir = tmp_path / "output"
+    (output_dir / "All_SNPs").mkdir(parents=True)
+    (tmp_path / "work").mkdir()
+    report = output_dir / "All_SNPs" / "all_kSNPdist.report"
+    matrix = output_dir / "All_SNPs" / "all_kSNPdist.matrix"
+    report.write_text(RAW_REPORT)
+    matrix.write_text(RAW_MATRIX)
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"work_data_dir": str(tmp_path / "work"), "output_data_dir": str(output_dir)}))
+    cache_dir = str(tmp_path / "work" / wgs.DISTANCE_CACHE_DIRNAME)
+    before = {path: wgs.load_distance_table(str(path), kind, cache_dir) for path, kind in ((report, "report"), (matrix, "matrix"))}
+
+    result = CliRunner().invoke(wgs.cli, ["fix-ksnpdist-outputs", str(config)])
+    assert result.exit_code == 0, result.output
+    return report, matrix, cache_dir, before
+
+
+def test_rows_and_values_are_kept(tmp_path):
+    report, matrix, _, _ = fix_outputs(tmp_path)
+
+    assert report.read_text() == ("distance\tgenome_id_1\tgenome_id_2\n"
+                                  "3\tg.2\tg.1\n0\tg.1\tg.3\n12\tg.3\tg.2\n12\tg.2\tg.3\n")
+    assert matrix.read_text() == ("genome_id\tg.1\tg.2\tg.3\n"
+                                  "g.1\t0\t0.0125\t0\ng.2\t0.0125\t0\t0.1\ng.3\t0\t0.1\t0\n")
+
+
+def test_cached_distances_follow_the_rewritten_files(tmp_path):
+    report, matrix, cache_dir, before = fix_outputs(tmp_path)
+
+    for path, kind in ((report, "report"), (matrix, "matrix")):
+        cached_ids, cached = wgs.load_distance_table(str(path), kind, cache_dir)
+        # A fresh parse of the rewritten file must agree with the re-keyed cache entry
+        parsed_ids, parsed = (wgs.read_ksnp_distance_report if kind == "report" else wgs.read_ksnp_distance_matrix)(str(path))
+        assert cached_ids == parsed_ids == before[path][0]
+        np.testing.assert_array_equal(cached, parsed)
+
+
+def test_stale_cache_entry_is_not_carried_over(tmp_path):
+    output_dir = tmp_path / "output" / "All_SNPs"
+    output_dir.mkdir(parents=True)
+    report = output_dir / "all_kSNPdist.report"
+    report.write_text(RAW_REPORT)
+    cache_dir = str(tmp_path / "cache")
+    wgs.load_distance_table(str(report), "report", cache_dir)
+    # The report changes after it was cached, then is relabeled
+    report.write_text("7\tg_1\tg_2\n")
+    os.utime(report, ns=(1, 1))
+
+    wgs.process_ksnp_report(str(report), cache_dir)
+
+    genome_ids, matrix = wgs.load_distance_table(str(report), "report", cache_dir)
+    assert genome_ids == ["g.1", "g.2"]
+    assert matrix[0, 1] == 7
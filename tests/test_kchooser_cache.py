@@ -0,0 +1,88 @@
+"""The Kchooser cache reuses results across jobs without carrying genome names between them."""
+import json
+import os
+
+import pandas as pd
+from click.testing import CliRunner
+
+import whole_genome_snp_utils as wgs
+
+SEQUENCES = ["ACGTACGTAA", "ACGTACGTACGTCC", "ACGTACGTACGTACGTGG"]
+REPORT = """There were 3 genomes
+The median length genome was {1}
+Its length is 14
+The shortest genomes is {0} its length is 10
+When k is 13 FCK = 0.5 for {2}
+The optimum value of k is 13
+"""
+
+
+def make_job(job_dir, names, cache_dir):
+    """A job whose genomes carry the given names, in the order of SEQUENCES."""
+    clean_dir = job_dir / "clean"
+    work_dir = job_dir / "work"
+    clean_dir.mkdir(parents=True)
+    work_dir.mkdir()
+    rows = []
+    for name, sequence in zip(names, SEQUENCES):
+        rows.append({"genome": name + ".fasta", "length": len(sequence), "contigs": 1, "n_fraction": 0.0,
+                     "sequence_sha256": wgs.hashlib.sha256(sequence.encode()).hexdigest(), "status": "ok", "reason": ""})
+    pd.DataFrame(rows, columns=wgs.GENOME_STATS_COLUMNS).to_csv(work_dir / wgs.GENOME_STATS_FILENAME, sep="\t", index=False)
+    (clean_dir / "ksnp4_input_file.txt").write_text("".join("{}/{}.fasta\t{}\n".format(clean_dir, name, name) for name in names))
+    (job_dir / "config.json").write_text(json.dumps({"work_data_dir": str(work_dir), "kchooser_cache_dir": str(cache_dir)}))
+    return job_dir
+
+
+def invoke(command, job_dir, report_path):
+    return CliRunner().invoke(wgs.cli, [command, str(job_dir / "config.json"),
+                                        str(job_dir / "clean" / "ksnp4_input_file.txt"), str(report_path)])
+
+
+def test_cached_report_is_named_for_the_job_that_reads_it(tmp_path):
+    cache_dir = tmp_path / "cache"
+    first_names = ["alice_1", "alice_10", "alice_100"]
+    first = make_job(tmp_path / "first", first_names, cache_dir)
+    (first / "report").write_text(REPORT.format(*first_names))
+    assert invoke("kchooser-cache-store", first, first / "report").exit_code == 0
+
+    # The cache itself holds no genome names
+    cached = "".join(open(os.path.join(root, name)).read() for root, _, names in os.walk(cache_dir) for name in names)
+    assert "alice" not in cached
+    assert "The optimum value of k is 13" in cached
+
+    # The same sequences under other names, listed in another order
+    second_names = ["bob_x", "bob_y", "bob_z"]
+    second = make_job(tmp_path / "second", second_names, cache_dir)
+    (second / "clean" / "ksnp4_input_file.txt").write_text("".join(
+        "{}/{}.fasta\t{}\n".format(second / "clean", name, name) for name in reversed(second_names)))
+    result = invoke("kchooser-cache-lookup", second, second / "report")
+
+    assert result.exit_code == 0, result.stderr
+    assert (second / "report").read_text() == REPORT.format(*second_names)
+    report_data = wgs.parse_kchooser_report({}, str(second / "report"))
+    assert report_data["kchooser_report"][0]["Median Genome"] == "bob.y"
+    assert report_data["kchooser_report"][0]["Shortest Genome"] == "bob.x"
+
+
+def test_lookup_misses_for_other_genomes(tmp_path):
+    cache_dir = tmp_path / "cache"
+    first = make_job(tmp_path / "first", ["a", "b", "c"], cache_dir)
+    (first / "report").write_text(REPORT.format("a", "b", "c"))
+    invoke("kchooser-cache-store", first, first / "report")
+    second = make_job(tmp_path / "second", ["a", "b"], cache_dir)
+    (second / "clean" / "ksnp4_input_file.txt").write_text("{0}/a.fasta\ta\n{0}/b.fasta\tb\n".format(second / "clean"))
+
+    result = invoke("kchooser-cache-lookup", second, second / "report")
+
+    assert result.exit_code == 1
+    assert not (second / "report").exists()
+
+
+def test_template_matches_whole_names_only():
+    hashes = {"g_1": "1" * 64, "g_10": "a" * 64}
+
+    template = wgs.kchooser_report_template("g_10 g_1 g_1.fasta xg_1 g_1x", hashes)
+
+    assert template == "<genome:{}> <genome:{}> <genome:{}>.fasta xg_1 g_1x".format("a" * 64, "1" * 64, "1" * 64)
+    assert wgs.fill_kchooser_report_template(template, {"a" * 64: "n10", "1" * 64: "n1"}) == "n10 n1 n1.fasta xg_1 g_1x"
+    assert wgs.fill_kchooser_report_template(template, {"a" * 64: "n10"}) is None
@@ -0,0 +1,54 @@
+"""rewrite_newick_labels must change only label underscores, whatever the chunk boundaries."""
+import io
+
+import pytest
+from Bio import Phylo
+
+import whole_genome_snp_utils as wgs
+
+SAMPLE_TREES = [
+    # kSNP4-style genome labels with supports and branch lengths
+    "((1280_1234.5:0.0012,1280_9999.1:0.25)0.97:0.5,(573_1.2:1e-05,573_22.7:0.1)1:0.003,470_4.4:0.75);\n",
+    # Quoted labels with spaces, doubled '' escapes and reserved characters
+    "('g_1 x_y':0.1,'it''s_2':0.2,('a_(b)_c:d':0.3,'''_lead_':0.4)'inner_node':0.05);\n",
+    # [comments] containing underscores and Newick punctuation
+    "(a_1[&support_x=1,y_z=(2)]:0.1,(b_2:0.2[&rate_a=0.5],c_3[note_'q']:0.3)0.88[&node_x]:0.4);\n",
+    # Named internal nodes, missing branch lengths and whitespace between tokens
+    "( ( x_1 , y_2 ) node_12 : 0.5 , z_3 )root_node;\n",
+    # One long line crossing many chunk boundaries
+    "({});\n".format(",".join("'g_{0} s_{0}':{1:.6f}".format(i, i / 997) if i % 3 == 0
+                              else "{}_{}.{}:{:.6f}".format(1000 + i, i, i % 9, i / 991) for i in range(300))),
+]
+
+
+def read_clades(text):
+    tree = Phylo.read(io.StringIO(text), "newick")
+    return [(clade.name, clade.branch_length, clade.confidence, clade.comment) for clade in tree.find_clades()]
+
+
+@pytest.mark.parametrize("tree_text", SAMPLE_TREES)
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, wgs.FASTA_CHUNK_SIZE])
+def test_rewrite_matches_phylo_label_rewrite(tmp_path, tree_text, chunk_size):
+    raw_nwk = tmp_path / "raw.tre"
+    clean_nwk = tmp_path / "clean.tre"
+    raw_nwk.write_bytes(tree_text.encode())
+
+    wgs.rewrite_newick_labels(str(raw_nwk), str(clean_nwk), chunk_size)
+
+    rewritten = clean_nwk.read_bytes().decode()
+    expected = [(name.replace("_", ".") if name else name, length, confidence, comment)
+                for name, length, confidence, comment in read_clades(tree_text)]
+    assert read_clades(rewritten) == expected
+    # Only label underscores change; everything else is copied byte for byte
+    assert len(rewritten) == len(tree_text)
+    assert all(new == old or (old, new) == ("_", ".") for old, new in zip(tree_text, rewritten))
+
+
+def test_comments_and_lengths_keep_their_underscores(tmp_path):
+    raw_nwk = tmp_path / "raw.tre"
+    clean_nwk = tmp_path / "clean.tre"
+    raw_nwk.write_text("(a_1[&x_y=1]:1e-05,'b_2''_c':0.5)n_1;\n")
+
+    wgs.rewrite_newick_labels(str(raw_nwk), str(clean_nwk), 2)
+
+    assert clean_nwk.read_text() == "(a.1[&x_y=1]:1e-05,'b.2''.c':0.5)n.1;\n"
@@ -0,0 +1,71 @@
+"""normalize-fastas rejects unusable genomes with a clear reason and the report lists them."""
+import json
+
+import pandas as pd
+from click.testing import CliRunner
+
+import whole_genome_snp_utils as wgs
+
+GENOMES = {
+    "good_1.fasta": ">c1\nACGTACGT\nACG\n",
+    "good_2.fasta": ">c1\r\nACGT ACGT\r\n\r\n>c2\r\nTTTT\r\n",
+    "headerless.fasta": "ACGT\n>c1\nACGT\n",
+    "protein.fasta": ">p1\nMKV<Q\n",
+    "both.fasta": "ACGT\n>c1\nAC*T\n",
+    "empty.fasta": ">c1\n\n",
+}
+
+
+def run_normalize(tmp_path):
+    clean_dir = tmp_path / "clean"
+    work_dir = tmp_path / "work"
+    clean_dir.mkdir()
+    work_dir.mkdir()
+    for name, content in GENOMES.items():
+        (clean_dir / name).write_bytes(content.encode())
+    (work_dir / wgs.FASTA_STAGING_MANIFEST).write_text(json.dumps(
+        {name: {"source": "/raw/{} input.fna".format(name.split(".")[0]), "method": "hardlink"} for name in GENOMES}))
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"cores": 2, "clean_data_dir": str(clean_dir), "work_data_dir": str(work_dir)}))
+    result = CliRunner().invoke(wgs.cli, ["normalize-fastas", str(config)])
+    assert result.exit_code == 0, result.stderr
+    stats = pd.read_csv(work_dir / wgs.GENOME_STATS_FILENAME, sep="\t", keep_default_na=False).set_index("genome")
+    return clean_dir, work_dir, stats
+
+
+def test_rejection_reasons_are_tracked_separately(tmp_path):
+    clean_dir, _, stats = run_normalize(tmp_path)
+
+    assert stats.loc["headerless.fasta", "reason"] == "sequence before the first header"
+    assert stats.loc["protein.fasta", "reason"] == "non-nucleotide characters: '<' 'Q'"
+    assert stats.loc["both.fasta", "reason"] == "sequence before the first header; non-nucleotide characters: '*'"
+    assert stats.loc["empty.fasta", "reason"] == "no sequence"
+    assert list(stats.index[stats["status"] != "rejected"]) == ["good_1.fasta", "good_2.fasta"]
+    assert stats.loc["good_2.fasta", "status"] == "normalized"
+    assert sorted(path.name for path in clean_dir.iterdir()) == ["good_1.fasta", "good_2.fasta"]
+
+
+def test_report_lists_excluded_genomes_by_input_file(tmp_path):
+    _, work_dir, _ = run_normalize(tmp_path)
+
+    table = wgs.rejected_genomes_html(str(work_dir))
+
+    assert "4 input genomes failed validation and were excluded from the analysis" in table
+    assert "<td>headerless input.fna</td>" in table
+    assert "<td>non-nucleotide characters: &#x27;&lt;&#x27; &#x27;Q&#x27;</td>" in table
+    assert "good_1" not in table
+
+
+def test_report_has_no_table_when_every_genome_passed(tmp_path):
+    (tmp_path / wgs.GENOME_STATS_FILENAME).write_text("\t".join(wgs.GENOME_STATS_COLUMNS) + "\ng1.fasta\t8\t1\t0.0\tab\tok\t\n")
+
+    assert wgs.rejected_genomes_html(str(tmp_path)) == ""
+
+
+def test_genome_stats_are_published_with_the_intermediate_files(tmp_path):
+    _, work_dir, _ = run_normalize(tmp_path)
+    output_dir = tmp_path / "output"
+
+    wgs.organize_files_by_type(str(work_dir), str(output_dir), workers=1)
+
+    assert (output_dir / "Intermediate_Files" / wgs.GENOME_STATS_FILENAME).exists()
@@ -0,0 +1,55 @@
+"""stage_fasta_file links inputs into the clean directory and only falls back when linking is impossible."""
+import errno
+import os
+
+import pytest
+
+import whole_genome_snp_utils as wgs
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    raw_dir = tmp_path / "raw"
+    clean_dir = tmp_path / "clean"
+    raw_dir.mkdir()
+    clean_dir.mkdir()
+    (raw_dir / "g 1.fna").write_text(">c1\nACGT\n")
+    return raw_dir, clean_dir
+
+
+def fail_link(monkeypatch, code):
+    def link(source, destination):
+        raise OSError(code, os.strerror(code))
+    monkeypatch.setattr(wgs.os, "link", link)
+
+
+def test_hardlinks_when_possible(dirs):
+    raw_dir, clean_dir = dirs
+
+    method = wgs.stage_fasta_file(str(clean_dir), "g_1.fasta", "g 1.fna", str(raw_dir / "g 1.fna"))
+
+    assert method == "hardlink"
+    assert os.path.samefile(clean_dir / "g_1.fasta", raw_dir / "g 1.fna")
+
+
+@pytest.mark.parametrize("code", [errno.EXDEV, errno.EPERM, errno.EMLINK])
+def test_symlinks_where_the_filesystem_cannot_hardlink(dirs, monkeypatch, code):
+    raw_dir, clean_dir = dirs
+    fail_link(monkeypatch, code)
+
+    method = wgs.stage_fasta_file(str(clean_dir), "g_1.fasta", "g 1.fna", str(raw_dir / "g 1.fna"))
+
+    assert method == "symlink"
+    assert os.readlink(clean_dir / "g_1.fasta") == str(raw_dir / "g 1.fna")
+
+
+@pytest.mark.parametrize("code", [errno.ENOENT, errno.EACCES])
+def test_other_link_errors_are_raised(dirs, monkeypatch, code):
+    raw_dir, clean_dir = dirs
+    fail_link(monkeypatch, code)
+
+    with pytest.raises(OSError) as raised:
+        wgs.stage_fasta_file(str(clean_dir), "g_1.fasta", "g 1.fna", str(raw_dir / "g 1.fna"))
+
+    assert raised.value.errno == code
+    assert not os.path.lexists(clean_dir / "g_1.fasta")
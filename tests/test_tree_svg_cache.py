@@ -0,0 +1,137 @@
+"""run-tree-to-svg with a tree image cache shared across jobs."""
+import json
+import os
+import stat
+
+import pytest
+from click.testing import CliRunner
+
+import whole_genome_snp_utils as wgs
+
+MAJORITY = 0.75
+FAKE_RENDERER = """#!/bin/sh
+echo "$1" >> "{calls}"
+echo "<svg><text>$(cat "$1")</text></svg>" > "$1.svg"
+"""
+
+
+@pytest.fixture
+def renderer(tmp_path, monkeypatch):
+    """A stand-in p3x-tree-to-svg on PATH; returns the file logging each tree it renders."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls"
+    script = bin_dir / "p3x-tree-to-svg"
+    script.write_text(FAKE_RENDERER.format(calls=calls))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", "{}{}{}".format(bin_dir, os.pathsep, os.environ["PATH"]))
+    return calls
+
+
+def make_job(job_dir, trees, **config):
+    """A job whose cleaned trees are the given Newick strings, keyed by tree file name."""
+    clean_tree_dir = job_dir / "work" / "clean_trees"
+    clean_tree_dir.mkdir(parents=True)
+    for filename, newick in trees.items():
+        (clean_tree_dir / filename).write_text(newick)
+    data = {"cores": 2, "work_data_dir": str(job_dir / "work"), "output_data_dir": str(job_dir / "output"),
+            "params": {"majority-threshold": MAJORITY}}
+    data.update(config)
+    (job_dir / "config.json").write_text(json.dumps(data))
+    return job_dir
+
+
+def render(job_dir):
+    result = CliRunner().invoke(wgs.cli, ["run-tree-to-svg", str(job_dir / "config.json")])
+    assert result.exit_code == 0, result.stderr
+    return result
+
+
+def rendered(calls):
+    return calls.read_text().splitlines() if calls.exists() else []
+
+
+def test_jobs_share_rendered_images(tmp_path, renderer):
+    cache_dir = tmp_path / "shared_cache"
+    trees = {"tree.SNPs_all.ML.tre": "(a.1,b.2);\n", "tree.core_SNPs.ML.tre": "(a.1,b.2);\n",
+             "tree.core_SNPs.NJ.tre": "(a.1,(b.2,c.3));\n"}
+    first = make_job(tmp_path / "first", trees, tree_svg_cache_dir=str(cache_dir))
+    second = make_job(tmp_path / "second", trees, tree_svg_cache_dir=str(cache_dir))
+
+    render(first)
+    assert len(rendered(renderer)) == 2
+    result = render(second)
+    assert len(rendered(renderer)) == 2
+    assert "0 images rendered, 2 from cache" in result.stderr
+
+    for job_dir in (first, second):
+        assert not (job_dir / "work" / wgs.TREE_SVG_CACHE_DIRNAME).exists()
+        for filename, newick in trees.items():
+            svg = job_dir / "output" / "report_supporting_documents" / (filename + ".svg")
+            assert svg.read_text() == "<svg><text>{}</text></svg>\n".format(newick.strip())
+    assert not [name for name in os.listdir(cache_dir) if name.endswith(".tmp")]
+
+
+def test_without_a_shared_cache_images_stay_in_the_job(tmp_path, renderer):
+    job_dir = make_job(tmp_path / "job", {"tree.SNPs_all.ML.tre": "(a.1,b.2);\n"})
+
+    render(job_dir)
+
+    assert len(os.listdir(job_dir / "work" / wgs.TREE_SVG_CACHE_DIRNAME)) == 1
+    assert (job_dir / "output" / "report_supporting_documents" / "tree.SNPs_all.ML.tre.svg").exists()
+
+
+def test_unwritable_shared_cache_falls_back_to_the_work_directory(tmp_path, renderer, monkeypatch):
+    cache_dir = tmp_path / "shared_cache"
+    cache_dir.mkdir()
+    # Checked through os.access rather than chmod, which root ignores
+    access = wgs.os.access
+    monkeypatch.setattr(wgs.os, "access", lambda path, mode: path != str(cache_dir) and access(path, mode))
+    job_dir = make_job(tmp_path / "job", {"tree.SNPs_all.ML.tre": "(a.1,b.2);\n"}, tree_svg_cache_dir=str(cache_dir))
+
+    result = render(job_dir)
+
+    assert "is not writable; using the work directory" in result.stderr
+    assert (job_dir / "output" / "report_supporting_documents" / "tree.SNPs_all.ML.tre.svg").exists()
+    assert len(os.listdir(job_dir / "work" / wgs.TREE_SVG_CACHE_DIRNAME)) == 1
+    assert not os.listdir(cache_dir)
+
+
+def test_failed_cache_write_only_loses_that_image(tmp_path, renderer, monkeypatch):
+    job_dir = make_job(tmp_path / "job", {"tree.SNPs_all.ML.tre": "(a.1,b.2);\n", "tree.core_SNPs.ML.tre": "(c.3,d.4);\n"},
+                       tree_svg_cache_dir=str(tmp_path / "shared_cache"))
+    move = wgs.shutil.move
+
+    def full_disk(source, destination):
+        if "(c.3" in open(source).read():
+            raise OSError(28, "No space left on device")
+        return move(source, destination)
+
+    monkeypatch.setattr(wgs.shutil, "move", full_disk)
+    result = render(job_dir)
+
+    assert "Could not render tree.core_SNPs.ML.tre: could not store the image" in result.stderr
+    images = json.loads((job_dir / "work" / wgs.TREE_IMAGES_FILENAME).read_text())
+    assert list(images) == ["tree.SNPs_all.ML.tre"]
+    assert not (job_dir / "work" / "clean_trees" / "tree.core_SNPs.ML.tre.svg").exists()
+
+
+def test_shared_cache_evicts_least_recently_used_images(tmp_path, renderer):
+    cache_dir = tmp_path / "shared_cache"
+    jobs = [make_job(tmp_path / "job{}".format(i), {"tree.SNPs_all.ML.tre": "({0}.1,{0}.2);\n".format(name)},
+                     tree_svg_cache_dir=str(cache_dir), tree_svg_cache_max_bytes=80) for i, name in enumerate("abc")]
+    images = [cache_dir / (wgs.sha256_file(str(job_dir / "work" / "clean_trees" / "tree.SNPs_all.ML.tre")) + ".svg")
+              for job_dir in jobs]
+    # Each image is 34 bytes, so two fit
+    render(jobs[0])
+    os.utime(images[0], (1, 1))
+    render(jobs[1])
+    os.utime(images[1], (2, 2))
+    # A cache hit marks the first image recently used again
+    render(jobs[0])
+
+    result = render(jobs[2])
+
+    assert "Evicted cached tree image {}".format(images[1].name.split(".")[0]) in result.stderr
+    assert sorted(os.listdir(cache_dir)) == sorted([images[0].name, images[2].name])
+    assert len(rendered(renderer)) == 3
@@ -0,0 +1,178 @@
+"""upload-output-files against a local directory standing in for the workspace."""
+import json
+import re
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+import whole_genome_snp_utils as wgs
+
+OUTPUT_FILES = {
+    "All_SNPs/all_kSNPdist.report": "g1\tg2\t3\n" * 50,
+    "All_SNPs/SNPs_all_matrix.fasta": ">g1\nACGT\n>g2\nACGA\n",
+    "Core_SNPs/core_kSNPdist.matrix": "2\ng1 0 1\ng2 1 0\n",
+    "Intermediate_Files/COUNT_SNPs": "Number_SNPs: 4\n",
+    "metadata.tsv": "genome_id\tgenome_name\n",
+    "report_supporting_documents/tree.SNPs_all.ML.tre.svg": "<svg></svg>\n" * 20,
+}
+SUMMARY = re.compile(r"Uploaded (\d+) files \((\d+) bytes\) to .* in [\d.]+s \(([\d.]+) MB/s\); (\d+) unchanged, (\d+) failed")
+
+
+@pytest.fixture
+def job(tmp_path):
+    """A finished job's output folder with its manifest, and an empty stand-in workspace folder."""
+    output_dir = tmp_path / "output"
+    for path, content in OUTPUT_FILES.items():
+        (output_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (output_dir / path).write_text(content)
+    (tmp_path / "work").mkdir()
+    (tmp_path / "workspace").mkdir()
+    config = tmp_path / "config.json"
+    config.write_text(json.dumps({"cores": 2, "work_data_dir": str(tmp_path / "work"), "output_data_dir": str(output_dir)}))
+    write_manifest(config)
+    return tmp_path
+
+
+def write_manifest(config):
+    result = CliRunner().invoke(wgs.cli, ["write-output-manifest", str(config)])
+    assert result.exit_code == 0, result.output
+
+
+def upload(job, *args):
+    return CliRunner().invoke(wgs.cli, ["upload-output-files", *args, str(job / "config.json"), str(job / "workspace")])
+
+
+def summary(result):
+    uploaded, size, rate, unchanged, failed = SUMMARY.search(result.stderr).groups()
+    return {"uploaded": int(uploaded), "bytes": int(size), "rate": float(rate),
+            "unchanged": int(unchanged), "failed": int(failed)}
+
+
+def test_uploads_every_manifest_file_concurrently(job, monkeypatch):
+    active = []
+    peak = []
+    lock = threading.Lock()
+    upload_output_file = wgs.upload_output_file
+
+    def tracked(source_path, destination, entry):
+        with lock:
+            active.append(entry["path"])
+            peak.append(len(active))
+        time.sleep(0.05)
+        upload_output_file(source_path, destination, entry)
+        with lock:
+            active.remove(entry["path"])
+
+    monkeypatch.setattr(wgs, "upload_output_file", tracked)
+    result = upload(job, "--workers", "4")
+
+    assert result.exit_code == 0, result.stderr
+    assert max(peak) > 1
+    for path, content in OUTPUT_FILES.items():
+        assert (job / "workspace" / path).read_text() == content
+
+
+def test_reports_uploaded_bytes_and_throughput(job):
+    result = upload(job)
+
+    assert result.exit_code == 0, result.stderr
+    report = summary(result)
+    assert report["uploaded"] == len(OUTPUT_FILES)
+    assert report["bytes"] == sum(len(content.encode()) for content in OUTPUT_FILES.values())
+    assert report["rate"] >= 0
+    assert report["unchanged"] == 0 and report["failed"] == 0
+
+
+def test_retries_a_transient_failure(job, monkeypatch):
+    failures = {"Core_SNPs/core_kSNPdist.matrix": 2}
+    upload_output_file = wgs.upload_output_file
+
+    def flaky(source_path, destination, entry):
+        if failures.get(entry["path"]):
+            failures[entry["path"]] -= 1
+            raise OSError("connection reset")
+        upload_output_file(source_path, destination, entry)
+
+    monkeypatch.setattr(wgs, "upload_output_file", flaky)
+    monkeypatch.setattr(wgs.time, "sleep", lambda seconds: None)
+    result = upload(job)
+
+    assert result.exit_code == 0, result.stderr
+    assert result.stderr.count("Upload of Core_SNPs/core_kSNPdist.matrix failed (connection reset); retrying") == 2
+    assert (job / "workspace" / "Core_SNPs/core_kSNPdist.matrix").read_text() == OUTPUT_FILES["Core_SNPs/core_kSNPdist.matrix"]
+    assert summary(result)["failed"] == 0
+
+
+def test_persistent_failure_exits_and_is_retried_next_run(job, monkeypatch):
+    upload_output_file = wgs.upload_output_file
+
+    def broken(source_path, destination, entry):
+        if entry["path"] == "metadata.tsv":
+            raise OSError("permission denied")
+        upload_output_file(source_path, destination, entry)
+
+    monkeypatch.setattr(wgs, "upload_output_file", broken)
+    monkeypatch.setattr(wgs.time, "sleep", lambda seconds: None)
+    result = upload(job)
+
+    assert result.exit_code == 1
+    assert "Failed to upload metadata.tsv: permission denied" in result.stderr
+    assert summary(result)["failed"] == 1
+
+    monkeypatch.setattr(wgs, "upload_output_file", upload_output_file)
+    result = upload(job)
+    assert result.exit_code == 0, result.stderr
+    assert summary(result)["uploaded"] == 1
+    assert (job / "workspace" / "metadata.tsv").exists()
+
+
+def test_skips_files_unchanged_since_the_last_upload(job):
+    assert upload(job).exit_code == 0
+
+    result = upload(job)
+    assert result.exit_code == 0, result.stderr
+    report = summary(result)
+    assert report["uploaded"] == 0 and report["unchanged"] == len(OUTPUT_FILES)
+
+    (job / "output" / "metadata.tsv").write_text("genome_id\tgenome_name\n1.1\tchanged\n")
+    write_manifest(job / "config.json")
+    result = upload(job)
+    assert result.exit_code == 0, result.stderr
+    report = summary(result)
+    assert report["uploaded"] == 1 and report["unchanged"] == len(OUTPUT_FILES) - 1
+    assert (job / "workspace" / "metadata.tsv").read_text().endswith("changed\n")
+
+
+def test_workspace_copy_maps_only_real_suffixes(monkeypatch):
+    commands = []
+    monkeypatch.setattr(wgs.subprocess, "run", lambda command, **kwargs: commands.append(command))
+
+    wgs.upload_output_file("/out/All_SNPs/all_kSNPdist.report", "ws:/user/job", {"path": "All_SNPs/all_kSNPdist.report", "type": "tsv"})
+    wgs.upload_output_file("/out/Intermediate_Files/COUNT_SNPs", "ws:/user/job", {"path": "Intermediate_Files/COUNT_SNPs", "type": "unspecified"})
+
+    assert commands[0] == ["p3-cp", "-f", "--map-suffix", "report=tsv", "/out/All_SNPs/all_kSNPdist.report",
+                           "ws:/user/job/All_SNPs/all_kSNPdist.report"]
+    assert commands[1] == ["p3-cp", "-f", "/out/Intermediate_Files/COUNT_SNPs", "ws:/user/job/Intermediate_Files/COUNT_SNPs"]
+
+
+def test_shared_state_skips_files_uploaded_by_an_earlier_job(job, tmp_path):
+    config = json.loads((job / "config.json").read_text())
+    config["upload_state_dir"] = str(tmp_path / "upload_state")
+    (job / "config.json").write_text(json.dumps(config))
+    assert upload(job).exit_code == 0
+
+    # A rerun of the job with a fresh work directory
+    (job / "rerun").mkdir()
+    config["work_data_dir"] = str(job / "rerun")
+    (job / "config.json").write_text(json.dumps(config))
+    write_manifest(job / "config.json")
+    result = upload(job)
+
+    assert result.exit_code == 0, result.stderr
+    report = summary(result)
+    assert report["uploaded"] == 0 and report["unchanged"] == len(OUTPUT_FILES)
+    assert not (job / "rerun" / wgs.OUTPUT_UPLOAD_STATE_FILENAME).exists()
+    assert [path.name for path in (tmp_path / "upload_state").iterdir()] == [
+        wgs.hashlib.sha256(str(job / "workspace").encode()).hexdigest() + ".json"]